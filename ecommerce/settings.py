@@ -34,6 +34,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'store.apps.StoreConfig',
     'ckeditor',
     'ckeditor_uploader',
@@ -168,5 +169,97 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Импорт выгрузки 1С: 'bulk' - пакетная загрузка, 'copy' - через COPY
+# в промежуточную таблицу (PostgreSQL), 'orm' - построчная
+IMPORT_BACKEND = os.getenv('IMPORT_BACKEND', 'bulk')
+IMPORT_BATCH_SIZE = 1000
+# Больше одного процесса - выгрузка АТОЛ разбирается параллельно (пакетная
+# загрузка). Только manage.py product_import: процессы воркера Celery - демоны
+# и не могут запускать свои, задача product_import разбирает в одном процессе
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', 1))
+IMPORT_CHUNK_ROWS = 10000
+# Аренда импорта продлевается после каждого записанного пакета
+IMPORT_LEASE_TIME = 60 * 10
+# Задача импорта, заставшая аренду занятой, повторяется через столько секунд,
+# не больше IMPORT_RETRIES раз (полчаса - CELERY_TASK_TIME_LIMIT импорта)
+IMPORT_RETRY_COUNTDOWN = 60
+IMPORT_RETRIES = 30
+# manage.py watch_imports: выгрузка дописана, когда её закрыли после записи
+# (inotify); второй файл пары ждём ещё IMPORT_DEBOUNCE секунд. Без inotify
+# выгрузка считается дописанной, если не менялась IMPORT_POLL_DEBOUNCE секунд
+IMPORT_DEBOUNCE = 5
+IMPORT_POLL_DEBOUNCE = 10 * 60
+# Процессов для обработки изображений в manage.py ingest_images. Задача
+# process_images работает в воркере Celery и обрабатывает их по одному
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', os.cpu_count() or 1))
+# Ширины вариантов WebP/AVIF для srcset, кроме того - исходная ширина
+IMAGE_VARIANT_WIDTHS = (150, 300, 600)
+# Неиспользуемые файлы в MEDIA_ROOT удаляются не раньше чем через сутки
+MEDIA_GC_GRACE = 60 * 60 * 24
+# /media/r/<ширина>x<высота>/<файл>: копии строятся при первом запросе,
+# только этих размеров; кэш копий не больше IMAGE_RESIZE_CACHE_SIZE байт,
+# лишнее раз в IMAGE_RESIZE_EVICT_INTERVAL секунд удаляет celery beat
+IMAGE_RESIZE_SIZES = [(50, 50), (150, 150), (300, 400), (600, 800), (1100, 3000)]
+IMAGE_RESIZE_CACHE_SIZE = 1024 * 1024 * 1024
+IMAGE_RESIZE_EVICT_INTERVAL = 10 * 60
+
+# Попадают в расписание DatabaseScheduler при запуске celery beat
+CELERY_BEAT_SCHEDULE = {
+    'evict-resized-images': {
+        'task': 'store.tasks.evict_resized_images',
+        'schedule': IMAGE_RESIZE_EVICT_INTERVAL,
+    },
+}
+
+# Кэш в два уровня: LRU в памяти процесса (не дольше L1_TIMEOUT секунд)
+# перед Redis, общим для процессов сайта и Celery. Версии пространств
+# (store.cache) читаются прямо из SHARED_CACHE: смену версии импортом или
+# правкой в админке все процессы видят сразу. База Redis - не та, что
+# у Celery: clear() очищает её целиком
+REDIS_CACHE_URL = os.getenv('REDIS_CACHE_URL', 'redis://localhost:6379/1')
+SHARED_CACHE = 'shared'
+CACHES = {
+    'default': {
+        'BACKEND': 'store.cache_backends.TwoTierCache',
+        'LOCATION': SHARED_CACHE,
+        # Память процесса - не больше MAX_BYTES; страницы крупнее
+        # MAX_ITEM_BYTES читаются только из Redis
+        'OPTIONS': {'MAX_ENTRIES': 2000, 'MAX_BYTES': 32 * 1024 * 1024,
+                    'MAX_ITEM_BYTES': 256 * 1024, 'L1_TIMEOUT': 5},
+    },
+    SHARED_CACHE: {
+        'BACKEND': 'store.cache_backends.RedisCache',
+        'LOCATION': REDIS_CACHE_URL,
+        'TIMEOUT': 60 * 60 * 24,
+    },
+}
+# Страницы каталога для анонимных посетителей хранятся не дольше часа,
+# а после импорта или правки каталога строятся заново
+PAGE_CACHE_TIMEOUT = 60 * 60
+# Дорогая запись кэша (страница, список категорий) после импорта или по
+# истечении срока пересчитывается одним процессом под блокировкой на
+# CACHE_LOCK_TIMEOUT секунд. Остальные отдают прежнее значение - оно
+# хранится ещё CACHE_STALE_TIMEOUT секунд, - а если его нет, ждут до
+# CACHE_LOCK_WAIT секунд и только потом считают сами
+CACHE_LOCK_TIMEOUT = 60
+CACHE_LOCK_WAIT = 5
+CACHE_STALE_TIMEOUT = 60 * 60 * 24
+# Строки и карточки товаров в списках, ключ - версия товара
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Поиск товаров: 'postgres' - полнотекстовый (и pg_trgm, если установлен),
+# 'index' - индекс в файле, перестраивается после product_import,
+# 'icontains' - прежний, подстрокой
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'postgres')
+SEARCH_INDEX_FILE = os.path.join(BASE_DIR, 'imported/search.idx')
+# Списки товаров: номера в ссылках у первых KEYSET_NUMBERED_PAGES страниц,
+# дальше - курсор (store.pagination.KeysetPaginator)
+KEYSET_NUMBERED_PAGES = 10
+# Подсказки при наборе (store/autocomplete/): строятся в каждом процессе
+# и обновляются раз в AUTOCOMPLETE_TTL секунд
+AUTOCOMPLETE_MIN_LENGTH = 2
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_TTL = 60 * 5
+
 # EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 # EMAIL_FILE_PATH = '/tmp/emails'
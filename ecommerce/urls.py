@@ -14,6 +14,8 @@ from store.views import (
     EmailView,
     WelcomeView,
     EmailConfirmationView,
+    serve_media,
+    resized_media,
 )
 
 
@@ -50,8 +52,11 @@ urlpatterns = [
     ),
     path('robots.txt', TemplateView.as_view(template_name="store/robots.txt", content_type="text/plain"),),
     path('gitwebhook/', include('git_hook.urls')),
+    # nginx: try_files на готовую копию в MEDIA_ROOT/r/, иначе - сюда
+    path('media/r/<int:width>x<int:height>/<path:name>', resized_media,
+         name='resized_media'),
 ]
 
 # nginx сам пересылает /static и /media, эти директивы нужны для tor hidden services
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+urlpatterns += static(settings.MEDIA_URL, view=serve_media, document_root=settings.MEDIA_ROOT)
@@ -3,7 +3,7 @@ from django.contrib import admin
 from ckeditor.widgets import CKEditorWidget
 
 from store.models import Group, Category, Product, Order, \
-    OrderProduct, Article, Customer
+    OrderProduct, Article, Customer, ImportRun
 
 
 class ProductAdmin(admin.ModelAdmin):
@@ -11,14 +11,14 @@ class ProductAdmin(admin.ModelAdmin):
         ('Товар',
          {'fields': ['article', 'title', 'category', 'price',
                      ('warehouse1', 'warehouse2'),
-                     ('image', 'image_thumb',), 'display', ]}
+                     ('image', 'image_thumb', 'image_status'), 'display', ]}
          ),
     ]
     readonly_fields = ['article', 'title', 'category', 'image_thumb', 'price',
-                       'warehouse1', 'warehouse2', ]
+                       'warehouse1', 'warehouse2', 'image_status', ]
     list_display = ('article', 'title', 'quantity', 'image_thumb',
                     'category', 'price', 'display')
-    list_filter = ['display', 'category', ]
+    list_filter = ['display', 'image_status', 'category', ]
     search_fields = ['article', 'title']
     ordering = ('title', 'category', 'price')
 
@@ -34,7 +34,7 @@ class CategoryProductInline(admin.TabularInline):
 class CategoryAdmin(admin.ModelAdmin):
     fields = ['name', 'parent', ('image', 'image_thumb'), ]
     readonly_fields = ['image_thumb']
-    list_display = ('name', 'image_thumb', 'parent',)
+    list_display = ('name', 'image_thumb', 'parent', 'display_count', 'in_stock_count')
     list_filter = ['parent']
     # inlines = [CategoryProductInline]
     # CategoryProductInline.verbose_name = 'Товар'
@@ -53,7 +53,7 @@ class GroupCategoryInline(admin.TabularInline):
 class GroupAdmin(admin.ModelAdmin):
     fields = ['name', ('image', 'image_thumb'), 'start_page', ]
     readonly_fields = ['image_thumb', ]
-    list_display = ('name', 'image_thumb', 'start_page')
+    list_display = ('name', 'image_thumb', 'start_page', 'display_count', 'in_stock_count')
     # inlines = [GroupCategoryInline]
     # GroupCategoryInline.verbose_name = 'Категория'
 
@@ -116,6 +116,33 @@ class ArticleAdmin(admin.ModelAdmin):
     list_display = ('name', 'title', 'slug',)
 
 
+class ImportRunAdmin(admin.ModelAdmin):
+    fieldsets = [
+        (None, {'fields': ['task', 'status', ('started_at', 'finished_at'),
+                           'duration', 'checkpoint']}),
+        ('Время этапов, с', {'fields': [('parse_time', 'category_time',
+                                          'product_time', 'stock_time',
+                                          'cleanup_time')]}),
+        ('Строки', {'fields': [('rows_read', 'rows_skipped', 'rows_per_second'),
+                               ('inserted', 'updated', 'denied'),
+                               'peak_memory']}),
+    ]
+    readonly_fields = ['task', 'status', 'started_at', 'finished_at', 'duration',
+                       'checkpoint', 'parse_time', 'category_time',
+                       'product_time', 'stock_time', 'cleanup_time',
+                       'rows_read', 'rows_skipped', 'rows_per_second',
+                       'inserted', 'updated', 'denied', 'peak_memory']
+    list_display = ('started_at', 'task', 'status', 'duration', 'rows_read',
+                    'rows_per_second', 'inserted', 'updated', 'denied',
+                    'parse_time', 'category_time', 'product_time',
+                    'stock_time', 'cleanup_time', 'peak_memory')
+    list_filter = ('task', 'status', 'started_at')
+    ordering = ('-started_at',)
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.site_header = "Панель управления магазина Электр{он/ика}"
 # admin.site.unregister(Group)
 admin.site.register(Group, GroupAdmin)
@@ -125,3 +152,4 @@ admin.site.register(Order, OrderAdmin)
 admin.site.register(Article, ArticleAdmin)
 
 admin.site.register(Customer, CustomerAdmin)
+admin.site.register(ImportRun, ImportRunAdmin)
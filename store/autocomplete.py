@@ -0,0 +1,138 @@
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.db import connection
+from django.urls import reverse
+
+from ecommerce import settings
+from store.models import Category, Product
+from store.search_index import words, compact
+
+# Больше любого символа в ключах: верхняя граница диапазона префикса
+PREFIX_END = '\U0010ffff'
+
+
+def prefix_range(keys, prefix):
+    return bisect_left(keys, prefix), bisect_left(keys, prefix + PREFIX_END)
+
+
+class Suggestions:
+    """
+    Отсортированные массивы слов наименований, артикулов и слов категорий
+    для подсказок по началу строки. Товары пронумерованы в порядке
+    наименования, поэтому первые N номеров и есть первые N подсказок.
+    """
+
+    def __init__(self):
+        self.built_at = time.monotonic()
+        self.products = list(Product.objects.filter(display=True)
+                             .order_by('title', 'id')
+                             .values_list('id', 'title', 'article'))
+
+        postings = defaultdict(lambda: array('I'))
+        articles = []
+        for doc, (id, title, article) in enumerate(self.products):
+            for word in set(words(title)):
+                postings[word].append(doc)
+            key = compact(article)
+            if key:
+                articles.append((key, doc))
+        self.word_keys = sorted(postings)
+        self.word_postings = [postings[key] for key in self.word_keys]
+        articles.sort()
+        self.article_keys = [key for key, _ in articles]
+        self.article_docs = array('I', (doc for _, doc in articles))
+
+        self.categories = []
+        for id, name in Category.objects.order_by('name').values_list('id', 'name'):
+            self.categories.append((words(name), id, name))
+
+    def word_docs(self, word):
+        i = bisect_left(self.word_keys, word)
+        if i < len(self.word_keys) and self.word_keys[i] == word:
+            return set(self.word_postings[i])
+        return set()
+
+    def match_titles(self, query_words, limit):
+        """Наименования со всеми словами запроса, последнее - начало слова"""
+        lo, hi = prefix_range(self.word_keys, query_words[-1])
+        required = [self.word_docs(word) for word in query_words[:-1]]
+        found = []
+        previous = None
+        for doc in heapq.merge(*self.word_postings[lo:hi]):
+            if doc == previous:
+                continue
+            previous = doc
+            if all(doc in docs for docs in required):
+                found.append(doc)
+                if len(found) == limit:
+                    break
+        return found
+
+    def match_articles(self, key, limit):
+        lo, hi = prefix_range(self.article_keys, key)
+        return list(self.article_docs[lo:min(hi, lo + limit)])
+
+    def match_categories(self, query_words, limit):
+        last = query_words[-1]
+        found = []
+        for name_words, id, name in self.categories:
+            if all(word in name_words for word in query_words[:-1]) and \
+                    any(word.startswith(last) for word in name_words):
+                found.append((id, name))
+                if len(found) == limit:
+                    break
+        return found
+
+    def suggest(self, query, limit):
+        query_words = words(query)
+        if len(''.join(query_words)) < settings.AUTOCOMPLETE_MIN_LENGTH:
+            return {'products': [], 'articles': [], 'categories': []}
+
+        def product(doc):
+            id, title, article = self.products[doc]
+            return {'title': title, 'article': article,
+                    'url': reverse('product_detail', kwargs={'pk': id})}
+
+        return {
+            'products': [product(doc) for doc in self.match_titles(query_words, limit)],
+            'articles': [product(doc) for doc in
+                         self.match_articles(compact(query), limit)],
+            'categories': [{'name': name,
+                            'url': reverse('category_detail', kwargs={'pk': id})}
+                           for id, name in self.match_categories(query_words, limit)],
+        }
+
+
+_suggestions = None
+_lock = threading.Lock()
+
+
+def refresh():
+    global _suggestions
+    try:
+        _suggestions = Suggestions()
+    finally:
+        # Соединение с базой у потока своё
+        connection.close()
+        _lock.release()
+
+
+def get_suggestions():
+    """
+    Подсказки рабочего процесса. Через AUTOCOMPLETE_TTL секунд они
+    перестраиваются в фоновом потоке, а запросы пока отвечают по прежним.
+    """
+    global _suggestions
+    if _suggestions is None:
+        with _lock:
+            if _suggestions is None:
+                _suggestions = Suggestions()
+    elif time.monotonic() - _suggestions.built_at > settings.AUTOCOMPLETE_TTL \
+            and _lock.acquire(blocking=False):
+        threading.Thread(target=refresh, daemon=True).start()
+    return _suggestions
@@ -0,0 +1,124 @@
+import hashlib
+import time
+import uuid
+
+from django.core.cache import cache, caches
+
+from ecommerce import settings
+
+# Версии пространств имён кэша: ключи строятся с текущей версией, поэтому
+# смена версии делает недоступными сразу все записи пространства, а старые
+# удаляются сами по истечении срока
+CATALOG = 'catalog'
+# Статьи в меню сайта: правка статьи в админке
+ARTICLES = 'articles'
+# Остатки и цены: stock_import каждые несколько минут
+STOCK = 'stock'
+# Строки и карточки товаров: меняется после migrate, с новыми шаблонами
+FRAGMENTS = 'fragments'
+
+
+def versions():
+    """
+    Кэш версий - общий уровень (SHARED_CACHE) мимо памяти процесса:
+    смену версии любым процессом остальные видят со следующего запроса
+    """
+    return caches[settings.SHARED_CACHE]
+
+
+def version_key(namespace):
+    return f'version:{namespace}'
+
+
+def get_version(namespace=CATALOG):
+    return get_versions(namespace)[0]
+
+
+def get_versions(*namespaces):
+    """Версии нескольких пространств одним запросом к кэшу"""
+    shared = versions()
+    found = shared.get_many([version_key(namespace) for namespace in namespaces])
+    result = []
+    for namespace in namespaces:
+        version = found.get(version_key(namespace))
+        if version is None:
+            # Версия вытеснена или ещё не задана: новая, а не 1 - иначе
+            # снова стали бы видны записи, сделанные при прежней версии 1
+            shared.add(version_key(namespace), time.time_ns(), timeout=None)
+            version = shared.get(version_key(namespace))
+        result.append(version)
+    return result
+
+
+def bump_version(namespace=CATALOG):
+    """Сбросить все записи пространства: после импорта, правки в админке"""
+    versions().set(version_key(namespace), time.time_ns(), timeout=None)
+
+
+def is_fresh(entry, version):
+    return entry is not None and entry[0] == version and entry[1] > time.time()
+
+
+def get_or_refresh(key, version, compute, timeout):
+    """
+    Значение из кэша без давки при промахе (stale-while-revalidate).
+    Запись хранится под ключом без версии вместе с версией и сроком
+    свежести. Устаревшую запись (другая версия или истёк срок) пересчитывает
+    один процесс под блокировкой, остальные тем временем отдают прежнее
+    значение, а если его нет - ждут до CACHE_LOCK_WAIT секунд. compute()
+    вернул None - значение не сохраняется.
+    """
+    entry = cache.get(key)
+    if is_fresh(entry, version):
+        return entry[2]
+
+    # Память процесса могла отстать от общего уровня
+    shared = versions()
+    entry = shared.get(key)
+    if is_fresh(entry, version):
+        return entry[2]
+
+    lock, token = f'lock:{key}', uuid.uuid4().hex
+    deadline = time.monotonic() + settings.CACHE_LOCK_WAIT
+    while not shared.add(lock, token, settings.CACHE_LOCK_TIMEOUT):
+        if entry is not None:
+            # Пересчитывает другой процесс: пока - прежнее значение
+            return entry[2]
+        if time.monotonic() > deadline:
+            return compute()
+        time.sleep(0.05)
+        entry = shared.get(key)
+        if entry is not None and entry[0] != version:
+            entry = None
+
+    try:
+        # Пока ждали блокировку, значение мог записать предыдущий владелец
+        entry = shared.get(key)
+        if is_fresh(entry, version):
+            return entry[2]
+        value = compute()
+        if value is not None:
+            cache.set(key, (version, time.time() + timeout, value),
+                      timeout + settings.CACHE_STALE_TIMEOUT)
+        return value
+    finally:
+        if shared.get(lock) == token:
+            shared.delete(lock)
+
+
+def page_version():
+    """Страницы зависят от каталога, остатков и статей меню"""
+    return '.'.join(map(str, get_versions(CATALOG, STOCK, ARTICLES)))
+
+
+def page_key(request, query=(), **params):
+    """
+    Ключ страницы: адрес, параметры запроса из query и настройки просмотра.
+    Прочие параметры (utm_* и т.п.) страницу не меняют и в ключ не входят,
+    иначе каждая ссылка с меткой - отдельная запись в кэше
+    """
+    query = sorted((name, request.GET.getlist(name)) for name in query
+                   if name in request.GET) + sorted(params.items())
+    digest = hashlib.blake2b(f'{request.path}|{query}'.encode(),
+                             digest_size=16).hexdigest()
+    return f'page:{digest}'
@@ -0,0 +1,305 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+
+class RedisCache(BaseCache):
+    """
+    Общий для всех процессов уровень кэша в Redis (в Django 3.1 своего
+    нет). Целые числа хранятся как есть, чтобы работал INCRBY, остальное -
+    pickle. База Redis должна быть отдельной от Celery: clear() её очищает.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(params)
+        self._client = redis.Redis.from_url(server)
+
+    def timeout(self, timeout):
+        """Секунды для Redis: None - бессрочно, 0 и меньше - сразу устарело"""
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else int(timeout)
+
+    def dumps(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        try:
+            return int(data)
+        except ValueError:
+            return pickle.loads(data)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self.timeout(timeout)
+        if timeout is not None and timeout <= 0:
+            return False
+        return bool(self._client.set(key, self.dumps(value), ex=timeout, nx=True))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data = self._client.get(key)
+        return default if data is None else self.loads(data)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self.timeout(timeout)
+        if timeout is not None and timeout <= 0:
+            self._client.delete(key)
+        else:
+            self._client.set(key, self.dumps(value), ex=timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self.timeout(timeout)
+        if timeout is None:
+            return bool(self._client.persist(key)) or bool(self._client.exists(key))
+        return bool(self._client.expire(key, max(timeout, 0)))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self._client.delete(key))
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return {}
+        made = [self.make_key(key, version=version) for key in keys]
+        for key in made:
+            self.validate_key(key)
+        return {key: self.loads(data)
+                for key, data in zip(keys, self._client.mget(made))
+                if data is not None}
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self.timeout(timeout)
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if timeout is not None and timeout <= 0:
+                pipeline.delete(key)
+            else:
+                pipeline.set(key, self.dumps(value), ex=timeout)
+        pipeline.execute()
+        return []
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_key(key, version=version) for key in keys]
+        if keys:
+            self._client.delete(*keys)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self._client.exists(key))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+
+        # Проверка и INCRBY - одной транзакцией: ключ, удалённый между ними,
+        # INCRBY создал бы заново без срока
+        def increment(pipeline):
+            if not pipeline.exists(key):
+                raise ValueError(f"Key '{key}' not found")
+            pipeline.multi()
+            pipeline.incrby(key, delta)
+
+        return self._client.transaction(increment, key)[0]
+
+    def clear(self):
+        self._client.flushdb()
+
+    def close(self, **kwargs):
+        # Пул соединений живёт вместе с процессом
+        pass
+
+
+# Первый уровень - общий для потоков процесса, как у LocMemCache
+_levels = {}
+_levels_lock = threading.Lock()
+
+
+class MemoryLevel:
+    """
+    LRU ограниченного размера: ключ -> (срок, pickle значения). Ограничено и
+    число записей, и их общий объём в байтах; значение больше max_item_bytes
+    (целая страница каталога) в память не кладётся, оно есть в общем уровне.
+    Просроченные записи удаляются при чтении и не реже раза в PURGE_INTERVAL
+    секунд при записи.
+    """
+    PURGE_INTERVAL = 1
+
+    def __init__(self, max_entries, max_bytes, max_item_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.purged_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def purge(self, now):
+        for key in [key for key, (expires, _) in self.entries.items() if expires < now]:
+            self.pop(key)
+        self.purged_at = now
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self.pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, data, timeout):
+        with self.lock:
+            now = time.monotonic()
+            self.pop(key)
+            if now - self.purged_at >= self.PURGE_INTERVAL:
+                self.purge(now)
+            if len(data) > self.max_item_bytes:
+                return
+            self.entries[key] = (now + timeout, data)
+            self.size += len(data)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.pop(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class TwoTierCache(BaseCache):
+    """
+    Кэш в два уровня: небольшой LRU в памяти процесса перед общим уровнем
+    (LOCATION - псевдоним кэша из CACHES, обычно Redis). Запись идёт в оба
+    уровня, чтение - из памяти, затем из общего. Запись в памяти живёт не
+    дольше L1_TIMEOUT секунд, поэтому удаление или перезапись ключа другие
+    процессы увидят с такой задержкой. Ключи с версией пространства
+    (store.cache) не меняются, для них задержки нет: новая версия - новый
+    ключ, а сами версии читаются из общего уровня.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.l2_alias = location
+        self.l1_timeout = options.get('L1_TIMEOUT', 5)
+        with _levels_lock:
+            if location not in _levels:
+                _levels[location] = MemoryLevel(
+                    options.get('MAX_ENTRIES', 1000),
+                    options.get('MAX_BYTES', 32 * 1024 * 1024),
+                    options.get('MAX_ITEM_BYTES', 256 * 1024))
+            self.l1 = _levels[location]
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def l1_key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def remember(self, key, value, timeout, version):
+        timeout = self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+        timeout = self.l1_timeout if timeout is None else min(timeout, self.l1_timeout)
+        if timeout > 0:
+            self.l1.set(self.l1_key(key, version),
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if not self.l2.add(key, value, timeout, version):
+            return False
+        self.remember(key, value, timeout, version)
+        return True
+
+    def get(self, key, default=None, version=None):
+        data = self.l1.get(self.l1_key(key, version))
+        if data is not None:
+            return pickle.loads(data)
+        # Отсутствие ключа не запоминается: иначе add() другого процесса
+        # был бы не виден до L1_TIMEOUT
+        value = self.l2.get(key, version=version)
+        if value is None:
+            return default
+        self.remember(key, value, DEFAULT_TIMEOUT, version)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l2.set(key, value, timeout, version)
+        self.remember(key, value, timeout, version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.l2.touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        self.l1.delete(self.l1_key(key, version))
+        return self.l2.delete(key, version)
+
+    def get_many(self, keys, version=None):
+        found, missing = {}, []
+        for key in keys:
+            data = self.l1.get(self.l1_key(key, version))
+            if data is None:
+                missing.append(key)
+            else:
+                found[key] = pickle.loads(data)
+        if missing:
+            shared = self.l2.get_many(missing, version=version)
+            for key, value in shared.items():
+                self.remember(key, value, DEFAULT_TIMEOUT, version)
+            found.update(shared)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout, version)
+        for key, value in data.items():
+            self.remember(key, value, timeout, version)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        for key in keys:
+            self.l1.delete(self.l1_key(key, version))
+        self.l2.delete_many(keys, version)
+
+    def has_key(self, key, version=None):
+        return self.l1.get(self.l1_key(key, version)) is not None \
+            or self.l2.has_key(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        self.l1.delete(self.l1_key(key, version))
+        return self.l2.incr(key, delta, version)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
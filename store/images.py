@@ -0,0 +1,245 @@
+import fcntl
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+
+from PIL import Image
+from django.db.models import F
+from django.utils._os import safe_join
+
+from ecommerce import settings
+from store.models import Group, Category, Product
+
+# Каталог в MEDIA_ROOT, размер, параметры JPEG. Загруженный оригинал не
+# меняется: его имя - хэш содержимого, и он отдаётся как неизменяемый
+BIG_FOLDER = 'big'
+DERIVATIVES = (
+    (BIG_FOLDER, Product.PRODUCT_BIG, {'quality': 95}),
+    ('card', Product.PRODUCT_CARD, {'quality': 85}),
+    ('thumb', Product.PRODUCT_THUMB, {}),
+)
+
+# Форматы вариантов для <picture> в порядке предпочтения: MIME-тип,
+# расширение, формат Pillow, параметры. Неподдерживаемые Pillow пропускаются
+VARIANT_FORMATS = (
+    ('image/avif', 'avif', 'AVIF', {'quality': 50}),
+    ('image/webp', 'webp', 'WEBP', {'quality': 80, 'method': 4}),
+)
+VARIANT_FOLDER = 'variants'
+MEDIA_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.tmp'}
+# Имена, которые даёт сайт: хэш (store.utils.path_and_rename, group_image,
+# category_image), у вариантов - с шириной. Остальные файлы сборщик не трогает
+GENERATED_NAME = re.compile(r'(group_|category_)?[0-9a-f]{16}(_\d+)?\.\w+(\.tmp)?')
+
+# Кэш копий /media/r/<ширина>x<высота>/<файл>: MEDIA_ROOT/r/..., чтобы nginx
+# отдавал готовые копии сам. Размер кэша держит задача evict_resized_images
+RESIZE_FOLDER = 'r'
+RESIZE_LOCKS = 64
+
+
+def save_image(img, name, format, **options):
+    """Файл пишется во временный и подменяется целиком, чтобы сайт не
+    отдал недописанное изображение"""
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img.save(f'{path}.tmp', format, **options)
+    os.replace(f'{path}.tmp', path)
+
+
+def render_variants(img, name):
+    """
+    Варианты большого изображения в форматах VARIANT_FORMATS по ширинам
+    IMAGE_VARIANT_WIDTHS (не больше исходной). Возвращает манифест для
+    шаблонного тега product_picture.
+    """
+    Image.init()
+    stem = os.path.splitext(name)[0]
+    widths = [width for width in settings.IMAGE_VARIANT_WIDTHS if width < img.width]
+    widths.append(img.width)
+
+    sources = []
+    for mime, ext, format, options in VARIANT_FORMATS:
+        if format not in Image.SAVE:
+            continue
+        srcset = []
+        for width in widths:
+            variant = img.resize((width, round(img.height * width / img.width)),
+                                 Image.ANTIALIAS) if width < img.width else img
+            variant_name = f'{VARIANT_FOLDER}/{stem}_{width}.{ext}'
+            save_image(variant, variant_name, format, **options)
+            srcset.append([width, variant_name])
+        sources.append({'type': mime, 'srcset': srcset})
+
+    return {'width': img.width, 'height': img.height, 'sources': sources}
+
+
+def big_name(name):
+    """Большое изображение всегда JPEG, поэтому имя с расширением .jpg"""
+    return f'{BIG_FOLDER}/{os.path.splitext(name)[0]}.jpg'
+
+
+def render_derivatives(name):
+    """
+    Большое изображение, карточка, миниатюра и варианты для <picture> из
+    файла name в MEDIA_ROOT. Возвращает (текст ошибки или None, манифест).
+    """
+    try:
+        with Image.open(os.path.join(settings.MEDIA_ROOT, name)) as img:
+            img = img.convert('RGB')
+            for folder, size, options in DERIVATIVES:
+                img.thumbnail(size, Image.ANTIALIAS)
+                if folder == BIG_FOLDER:
+                    save_image(img, big_name(name), 'JPEG', **options)
+                    manifest = render_variants(img, name)
+                else:
+                    save_image(img, os.path.join(folder, name), 'JPEG', **options)
+    except (OSError, ValueError) as e:
+        return f'{name}: {e}', {}
+    return None, manifest
+
+
+def process_product_images(ids, workers=1):
+    """
+    Производные изображения товаров, при workers > 1 - в пуле процессов.
+    Статус и манифест пишутся только тем товарам, чьё изображение не
+    сменилось за время обработки. Возвращает число обработанных изображений.
+    """
+    products = list(Product.objects.filter(id__in=ids).exclude(image='')
+                    .values_list('id', 'image', 'image_hash'))
+    if not products:
+        return 0
+
+    # Пул процессов - только вне Celery: manage.py ingest_images --workers
+    workers = min(workers, len(products))
+    with ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            results = pool.map(render_derivatives, [name for _, name, _ in products])
+        else:
+            results = map(render_derivatives, [name for _, name, _ in products])
+        for (id, name, image_hash), (error, manifest) in zip(products, results):
+            if error:
+                print(error)
+            Product.objects.filter(id=id, image_hash=image_hash).update(
+                image_status=Product.IMAGE_FAILED if error else Product.IMAGE_READY,
+                image_variants=manifest,
+                version=F('version') + 1,
+            )
+    return len(products)
+
+
+def collect_garbage(grace=None):
+    """
+    Удаляет изображения в MEDIA_ROOT, big/, card/, thumb/ и variants/, на
+    которые не ссылается ни товар, ни группа, ни категория. Только с именами
+    GENERATED_NAME; файлы моложе grace секунд не трогаются: их ещё может
+    сохранять админка или показывать кэш страниц. Возвращает число удалённых.
+    """
+    grace = settings.MEDIA_GC_GRACE if grace is None else grace
+    names = set()
+    for model in (Group, Category, Product):
+        names.update(model.objects.exclude(image='').exclude(image=None)
+                     .values_list('image', flat=True))
+    stems = {os.path.splitext(name)[0] for name in names}
+
+    deadline = time.time() - grace
+    removed = 0
+    for folder in ('', BIG_FOLDER, 'card', 'thumb', VARIANT_FOLDER):
+        path = os.path.join(settings.MEDIA_ROOT, folder)
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            if not entry.is_file() or not GENERATED_NAME.fullmatch(entry.name) \
+                    or os.path.splitext(entry.name)[1].lower() not in MEDIA_EXTENSIONS \
+                    or entry.stat().st_mtime > deadline:
+                continue
+            if folder == VARIANT_FOLDER:
+                used = entry.name.rsplit('_', 1)[0] in stems
+            elif folder == BIG_FOLDER:
+                used = entry.name.split('.', 1)[0] in stems
+            else:
+                used = entry.name in names
+            if not used:
+                os.remove(entry.path)
+                removed += 1
+    return removed
+
+
+@contextmanager
+def render_lock(key):
+    """
+    Блокировка на построение копии: из RESIZE_LOCKS файлов по хэшу ключа.
+    Файлы блокировок не удаляются, иначе два процесса могут заблокировать
+    разные файлы с одним именем.
+    """
+    folder = os.path.join(settings.MEDIA_ROOT, RESIZE_FOLDER, '.locks')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'{zlib.crc32(key.encode()) % RESIZE_LOCKS}.lock')
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def resized_image(name, width, height):
+    """
+    Путь к копии MEDIA_ROOT/name, уменьшенной до width x height. Копия
+    строится при первом запросе; одновременные запросы одной копии ждут
+    блокировку и получают уже готовый файл.
+    """
+    source = safe_join(settings.MEDIA_ROOT, name)
+    variant = os.path.join(RESIZE_FOLDER, f'{width}x{height}', name)
+    target = safe_join(settings.MEDIA_ROOT, variant)
+
+    if os.path.exists(target):
+        return target
+
+    with render_lock(variant):
+        if not os.path.exists(target):
+            with Image.open(source) as img:
+                format = img.format
+                img.thumbnail((width, height), Image.ANTIALIAS)
+                save_image(img, variant, format,
+                           **({'quality': 85} if format == 'JPEG' else {}))
+    return target
+
+
+def evict_resized(max_size=None):
+    """
+    Удаляет копии, которые дольше всех не запрашивались, пока кэш больше
+    IMAGE_RESIZE_CACHE_SIZE (до 90% от него). Возвращает число удалённых.
+    Давность запроса - время доступа к файлу: его обновляет ядро при чтении
+    и nginx, и сайтом (relatime - не чаще раза в сутки). Поэтому MEDIA_ROOT
+    не монтируется с noatime, иначе вытесняются самые старые копии.
+    """
+    max_size = settings.IMAGE_RESIZE_CACHE_SIZE if max_size is None else max_size
+    files = []
+    for root, dirs, names in os.walk(os.path.join(settings.MEDIA_ROOT, RESIZE_FOLDER)):
+        dirs[:] = [folder for folder in dirs if folder != '.locks']
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    if total <= max_size:
+        return 0
+
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_size * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
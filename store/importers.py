@@ -0,0 +1,614 @@
+import csv
+import io
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
+from itertools import islice
+
+from django.db import connection, transaction
+from django.db.models import F
+from lxml import etree as ET
+from psycopg2.extras import execute_values
+
+from ecommerce import settings
+from store.models import Group, Category, Product
+from store.utils import normalize_article, fingerprint, product_fingerprint, CENT
+
+# Отпечатки товаров, пропавших из выгрузки (Product.VANISHED...)
+VANISHED = Product.VANISHED
+VANISHED_HIDDEN = Product.VANISHED_HIDDEN
+
+CategoryRow = namedtuple('CategoryRow', 'id name fingerprint')
+ProductRow = namedtuple('ProductRow',
+                        'id category_id title article price fingerprint')
+
+
+# Построчный импорт пишет через save(): signals.py на время импорта не
+# пересчитывает счётчики и не сбрасывает кэш, это делается один раз в конце
+_importing = threading.local()
+
+
+@contextmanager
+def importing():
+    _importing.active = True
+    try:
+        yield
+    finally:
+        _importing.active = False
+
+
+def is_importing():
+    return getattr(_importing, 'active', False)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def parse_atol_row(row):
+    """
+    Разбор строки выгрузки АТОЛ. Возвращает CategoryRow, ProductRow или None,
+    если строку нужно пропустить. Некорректные значения поднимают исключение.
+    """
+    if len(row) < 25:  # строка содержит меньше 25  полей - игнорируем
+        return None
+
+    key = row[0]
+    article = row[25]
+    price = row[4]
+    name = row[2]
+    parent = row[15]
+
+    # Удаляем круглые скобки в начале Наименования
+    name = re.sub(r'^\([^)]+\)\s*', '', name)
+
+    if len(name) < 2:  # Длина наименования меньше 2 - игнорируем
+        return None
+    if len(article) == 0 and len(price) == 0:
+        name = re.sub(r'\([^)]+\)\.*', '', name)
+        return CategoryRow(int(key), name, fingerprint(name))
+
+    parent = int(parent)
+    price = Decimal(price).quantize(CENT)
+    return ProductRow(int(key), parent, name, article, price,
+                      product_fingerprint(parent, name, article, price))
+
+
+def parse_atol(f):
+    """
+    Читает выгрузку целиком в компактные записи.
+    Повторяющиеся коды: побеждает последняя строка, как и при построчном импорте.
+    """
+    categories = {}
+    products = {}
+    rows = skipped = 0
+
+    for row in csv.reader(f, delimiter=';'):
+        rows += 1
+        try:
+            record = parse_atol_row(row)
+        except Exception as e:
+            print(f'{e}\n\t{row}')
+            record = None
+
+        if record is None:
+            skipped += 1
+        elif isinstance(record, CategoryRow):
+            categories[record.id] = record
+        else:
+            products[record.id] = record
+
+    return categories, products, {'rows': rows, 'skipped': skipped}
+
+
+def commit_batches(objects, write, batch_size, run=None):
+    """
+    Запись пакетами, каждый пакет в своей транзакции. Контрольная точка
+    запуска импорта пишется в той же транзакции, что и пакет.
+    """
+    for batch in batched(objects, batch_size):
+        with transaction.atomic():
+            write(batch)
+            if run:
+                run.save_checkpoint(batches=run.checkpoint.get('batches', 0) + 1)
+
+
+def load_categories(categories, batch_size, run=None):
+    """
+    Пишутся только новые и изменившиеся категории. Пропавшие из выгрузки
+    не удаляются (вместе с ними удалились бы товары), только попадают в отчёт.
+    """
+    existing = dict(Category.objects.values_list('id', 'fingerprint'))
+
+    new, changed = [], []
+    for c in categories.values():
+        if c.id not in existing:
+            new.append(Category(id=c.id, name=c.name, fingerprint=c.fingerprint))
+        elif existing[c.id] != c.fingerprint:
+            changed.append(Category(id=c.id, name=c.name, fingerprint=c.fingerprint))
+    vanished = existing.keys() - categories.keys() if categories else set()
+
+    commit_batches(new, Category.objects.bulk_create, batch_size, run)
+    commit_batches(changed, lambda batch: Category.objects.bulk_update(
+        batch, ['name', 'fingerprint']), batch_size, run)
+    ids = {c.id for c in new} | {c.id for c in changed} | vanished
+    return {'inserted': len(new), 'updated': len(changed),
+            'unchanged': len(categories) - len(new) - len(changed),
+            'vanished': len(vanished)}, ids
+
+
+def hide_vanished(ids):
+    products = Product.objects.filter(id__in=ids)
+    # Сначала скрытые в админке, пока их не смешали со скрытыми импортом
+    products.filter(display=False).update(fingerprint=VANISHED_HIDDEN)
+    products.filter(display=True).update(display=False, fingerprint=VANISHED,
+                                         version=F('version') + 1)
+
+
+def load_products(products, batch_size, run=None):
+    """
+    Пишутся только новые и изменившиеся товары. Пропавшие из выгрузки
+    снимаются с показа; вернувшиеся в выгрузку выставляются снова, кроме
+    скрытых в админке ещё до того, как пропасть.
+    """
+    existing = dict(Product.objects.values_list('id', 'fingerprint'))
+    category_ids = set(Category.objects.values_list('id', flat=True))
+
+    new, changed, returned = [], [], []
+    skipped = 0
+    for p in products.values():
+        if p.category_id not in category_ids:
+            # Товар ссылается на неизвестную категорию - отбрасываем
+            print(f'Category matching query does not exist.\n\t{p}')
+            skipped += 1
+            continue
+        if existing.get(p.id) == p.fingerprint:
+            continue
+
+        product = Product(id=p.id, category_id=p.category_id, title=p.title,
+                          article=p.article, article_key=normalize_article(p.article),
+                          price=p.price, fingerprint=p.fingerprint)
+        if p.id not in existing:
+            new.append(product)
+        elif existing[p.id] == VANISHED:
+            returned.append(product)
+        else:
+            changed.append(product)
+
+    vanished = {id for id in existing.keys() - products.keys()
+                if existing[id] not in (VANISHED, VANISHED_HIDDEN)} if products else set()
+
+    fields = ['category', 'title', 'article', 'article_key', 'price', 'fingerprint',
+              'version']
+    for product in changed + returned:
+        product.version = F('version') + 1
+    for product in returned:
+        product.display = True
+    commit_batches(new, Product.objects.bulk_create, batch_size, run)
+    commit_batches(changed, lambda batch: Product.objects.bulk_update(
+        batch, fields), batch_size, run)
+    commit_batches(returned, lambda batch: Product.objects.bulk_update(
+        batch, fields + ['display']), batch_size, run)
+    commit_batches(vanished, hide_vanished, batch_size, run)
+
+    changed += returned
+    ids = {p.id for p in new} | {p.id for p in changed} | vanished
+    return {'inserted': len(new), 'updated': len(changed),
+            'unchanged': len(products) - len(new) - len(changed) - skipped,
+            'vanished': len(vanished), 'skipped': skipped}, ids
+
+
+def load_atol(categories, products, stats, batch_size, run=None):
+    timings = stats.setdefault('timings', {})
+
+    started = time.monotonic()
+    stats['categories'], category_ids = load_categories(categories, batch_size, run)
+    timings['categories'] = time.monotonic() - started
+
+    started = time.monotonic()
+    stats['products'], product_ids = load_products(products, batch_size, run)
+    timings['products'] = time.monotonic() - started
+
+    stats['changed'] = {'categories': sorted(category_ids),
+                        'products': sorted(product_ids)}
+    return stats
+
+
+def bulk_load_atol(f, batch_size=None, run=None):
+    """
+    Импорт выгрузки АТОЛ пакетами: файл разбирается в память целиком,
+    затем новые и изменившиеся по отпечатку категории и товары
+    записываются bulk_create/bulk_update, каждый пакет в своей транзакции.
+    Прерванный импорт при повторном запуске пишет только то, что
+    не успел: записанные строки уже совпадают по отпечатку.
+    В stats['changed'] - коды затронутых записей для сброса кэшей.
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    started = time.monotonic()
+
+    categories, products, stats = parse_atol(f)
+    stats['timings'] = {'parse': time.monotonic() - started}
+    load_atol(categories, products, stats, batch_size, run)
+
+    stats['elapsed'] = time.monotonic() - started
+    return stats
+
+
+def iter_stock(file_path):
+    """
+    Потоковый разбор выгрузки остатков: (id, [количества по складам])
+    для каждого <nom>. Разобранные узлы сразу удаляются из дерева,
+    так что память не растёт с размером файла.
+    """
+    nodes = ET.iterparse(file_path, events=('end',), tag='nom',
+                         encoding='cp1251')
+    for _, node in nodes:
+        yield node.get('id'), [scl.get('count') for scl in node.iterfind('whs/scl')]
+
+        node.clear()
+        while node.getprevious() is not None:
+            del node.getparent()[0]
+
+
+def parse_count(value):
+    return max(int(float(value)), 0)
+
+
+STOCK_UPDATE_SQL = f"""
+    UPDATE {Product._meta.db_table} AS p
+       SET warehouse1 = v.warehouse1, warehouse2 = v.warehouse2,
+           version = p.version + 1
+      FROM (VALUES %s) AS v (id, warehouse1, warehouse2)
+     WHERE p.id = v.id
+       AND (p.warehouse1, p.warehouse2) IS DISTINCT FROM (v.warehouse1, v.warehouse2)
+"""
+
+
+def update_stock(rows):
+    """Пакет (id, склад1, склад2) записывается одним UPDATE ... FROM (VALUES ...)"""
+    if rows:
+        with connection.cursor() as cursor:
+            execute_values(cursor, STOCK_UPDATE_SQL, rows, page_size=len(rows))
+
+
+def load_stock(stock, batch_size=None, run=None):
+    """
+    Загрузка остатков пакетами. Возвращает число отброшенных позиций:
+    id, которых нет в каталоге, и узлы без двух складов.
+    Прерванная загрузка продолжается с узла из контрольной точки.
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    known = set(Product.objects.values_list('id', flat=True))
+    done = run.checkpoint.get('done', 0) if run else 0
+    denied = run.checkpoint.get('denied', 0) if run else 0
+
+    for batch in batched(islice(stock, done, None), batch_size):
+        rows = []
+        for id, counts in batch:
+            try:
+                rows.append((int(id), parse_count(counts[0]), parse_count(counts[1])))
+            except (IndexError, TypeError, ValueError):
+                denied += 1
+
+        found = [row for row in rows if row[0] in known]
+        denied += len(rows) - len(found)
+        done += len(batch)
+        with transaction.atomic():
+            update_stock(found)
+            if run:
+                run.save_checkpoint(done=done, denied=denied)
+
+    return denied
+
+
+class CopyStream:
+    """
+    Файлоподобный объект для cursor.copy_expert: строки выгрузки
+    разбираются и отдаются в COPY в формате csv по мере чтения.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.data = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.data) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.data += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+        if size < 0:
+            size = len(self.data)
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+STAGING_TABLE = 'store_import_atol'
+
+STAGING_SQL = f"""
+    CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+        line integer,
+        kind char(1),
+        id integer,
+        parent integer,
+        name text,
+        article text,
+        article_key text,
+        price numeric(9, 2),
+        fingerprint varchar(16)
+    );
+    -- таблица могла остаться от версии без ключа артикула
+    ALTER TABLE {STAGING_TABLE} ADD COLUMN IF NOT EXISTS article_key text;
+"""
+STAGING_COLUMNS = 'line, kind, id, parent, name, article, article_key, price, fingerprint'
+# csv пишет '' и None одинаково, а COPY читает пустое поле как NULL:
+# в текстовых полях пустое поле - пустая строка ('(01) (ВВГ)' - категория без имени)
+STAGING_TEXT_COLUMNS = 'name, article, article_key'
+
+MERGE_CATEGORIES_SQL = f"""
+    INSERT INTO {Category._meta.db_table} AS c (id, name, parent_id, fingerprint,
+                                                image_hash, product_count,
+                                                display_count, in_stock_count)
+    SELECT DISTINCT ON (id) id, name, 1, fingerprint, '', 0, 0, 0
+      FROM {STAGING_TABLE}
+     WHERE kind = 'c'
+     ORDER BY id, line DESC
+        ON CONFLICT (id) DO UPDATE
+       SET name = EXCLUDED.name, fingerprint = EXCLUDED.fingerprint
+     WHERE c.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+ RETURNING id, xmax = 0
+"""
+
+MERGE_PRODUCTS_SQL = f"""
+    INSERT INTO {Product._meta.db_table} AS p
+           (id, category_id, title, article, article_key, price, fingerprint,
+            warehouse1, warehouse2, display, image_hash, image_status,
+            image_variants, version)
+    SELECT DISTINCT ON (s.id) s.id, s.parent, s.name, coalesce(s.article, ''),
+           coalesce(s.article_key, ''), s.price, s.fingerprint, 0, 0, true, '',
+           '{Product.IMAGE_READY}', '{{}}', 1
+      FROM {STAGING_TABLE} s
+      JOIN {Category._meta.db_table} c ON c.id = s.parent
+     WHERE s.kind = 'p'
+     ORDER BY s.id, s.line DESC
+        ON CONFLICT (id) DO UPDATE
+       SET category_id = EXCLUDED.category_id, title = EXCLUDED.title,
+           article = EXCLUDED.article, article_key = EXCLUDED.article_key,
+           price = EXCLUDED.price,
+           fingerprint = EXCLUDED.fingerprint, version = p.version + 1,
+           display = p.display OR p.fingerprint = '{VANISHED}'
+     WHERE p.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+ RETURNING id, xmax = 0
+"""
+
+SKIPPED_PRODUCTS_SQL = f"""
+    SELECT count(DISTINCT s.id)
+      FROM {STAGING_TABLE} s
+     WHERE s.kind = 'p'
+       AND NOT EXISTS (SELECT 1 FROM {Category._meta.db_table} c
+                        WHERE c.id = s.parent)
+"""
+
+VANISHED_CATEGORIES_SQL = f"""
+    SELECT id FROM {Category._meta.db_table} c
+     WHERE NOT EXISTS (SELECT 1 FROM {STAGING_TABLE} s
+                        WHERE s.kind = 'c' AND s.id = c.id)
+"""
+
+VANISHED_PRODUCTS_SQL = f"""
+    UPDATE {Product._meta.db_table} p
+       SET display = false, version = p.version + 1,
+           fingerprint = CASE WHEN p.display THEN '{VANISHED}'
+                              ELSE '{VANISHED_HIDDEN}' END
+     WHERE p.fingerprint NOT IN ('{VANISHED}', '{VANISHED_HIDDEN}')
+       AND NOT EXISTS (SELECT 1 FROM {STAGING_TABLE} s
+                        WHERE s.kind = 'p' AND s.id = p.id)
+ RETURNING id
+"""
+
+
+def staging_rows(f, stats):
+    for line, row in enumerate(csv.reader(f, delimiter=';')):
+        stats['rows'] += 1
+        try:
+            record = parse_atol_row(row)
+        except Exception as e:
+            print(f'{e}\n\t{row}')
+            record = None
+
+        if record is None:
+            stats['skipped'] += 1
+        elif isinstance(record, CategoryRow):
+            yield (line, 'c', record.id, None, record.name, None, None, None,
+                   record.fingerprint)
+        else:
+            yield (line, 'p', record.id, record.category_id, record.title,
+                   record.article, normalize_article(record.article),
+                   record.price, record.fingerprint)
+
+
+def merge_stats(cursor, sql, total):
+    cursor.execute(sql)
+    ids = cursor.fetchall()
+    inserted = sum(1 for id, created in ids if created)
+    return {'inserted': inserted, 'updated': len(ids) - inserted,
+            'unchanged': total - len(ids)}, {id for id, created in ids}
+
+
+def copy_load_atol(f, run=None):
+    """
+    Импорт выгрузки АТОЛ через PostgreSQL COPY: строки потоком загружаются
+    в нежурналируемую промежуточную таблицу и сливаются в категории и товары
+    запросами INSERT ... ON CONFLICT. Всё выполняется в одной транзакции,
+    так что витрина видит либо старый, либо новый каталог.
+    """
+    started = time.monotonic()
+    stats = {'rows': 0, 'skipped': 0, 'timings': {}}
+    timings = stats['timings']
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(STAGING_SQL)
+        cursor.execute(f'TRUNCATE {STAGING_TABLE}')
+        cursor.copy_expert(
+            f'COPY {STAGING_TABLE} ({STAGING_COLUMNS}) FROM STDIN '
+            f'WITH (FORMAT csv, FORCE_NOT_NULL ({STAGING_TEXT_COLUMNS}))',
+            CopyStream(staging_rows(f, stats)),
+        )
+        timings['parse'] = time.monotonic() - started
+        cursor.execute(f"""
+            SELECT count(DISTINCT id) FILTER (WHERE kind = 'c'),
+                   count(DISTINCT id) FILTER (WHERE kind = 'p')
+              FROM {STAGING_TABLE}
+        """)
+        categories, products = cursor.fetchone()
+
+        merge_started = time.monotonic()
+        stats['categories'], category_ids = merge_stats(
+            cursor, MERGE_CATEGORIES_SQL, categories)
+        vanished = set()
+        if categories:
+            cursor.execute(VANISHED_CATEGORIES_SQL)
+            vanished = {id for id, in cursor.fetchall()}
+        stats['categories']['vanished'] = len(vanished)
+        category_ids |= vanished
+        timings['categories'] = time.monotonic() - merge_started
+
+        merge_started = time.monotonic()
+        cursor.execute(SKIPPED_PRODUCTS_SQL)
+        skipped, = cursor.fetchone()
+        stats['products'], product_ids = merge_stats(
+            cursor, MERGE_PRODUCTS_SQL, products - skipped)
+        vanished = set()
+        if products:
+            cursor.execute(VANISHED_PRODUCTS_SQL)
+            vanished = {id for id, in cursor.fetchall()}
+        stats['products'].update(vanished=len(vanished), skipped=skipped)
+        product_ids |= vanished
+        if run:
+            run.save_checkpoint(batches=1)
+        timings['products'] = time.monotonic() - merge_started
+
+    stats['changed'] = {'categories': sorted(category_ids),
+                        'products': sorted(product_ids)}
+    stats['elapsed'] = time.monotonic() - started
+    return stats
+
+
+def file_stamp(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def start_phase(run, phase, file_path):
+    """
+    Этап импорта в контрольной точке запуска. Прерванный этап продолжается,
+    если файл выгрузки тот же, иначе начинается заново.
+    """
+    if run is None or not os.path.exists(file_path):
+        return
+    stamp = file_stamp(file_path)
+    if run.checkpoint.get('phase') != phase or run.checkpoint.get('file') != stamp:
+        run.save_checkpoint(phase=phase, file=stamp, batches=0, done=0, denied=0)
+
+
+def pipelined_load(atol_path, xml_path, workers=None, batch_size=None, run=None):
+    """
+    Параллельный импорт: выгрузка АТОЛ разбирается кусками по
+    IMPORT_CHUNK_ROWS строк в пуле процессов, затем пишутся категории,
+    товары и остатки - потоком, как в xml_import. atol_path=None - только
+    остатки. Процесс воркера Celery - демон и не может запускать свои
+    процессы, поэтому так импортирует только manage.py product_import.
+    """
+    workers = workers or settings.IMPORT_WORKERS
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    started = time.monotonic()
+    stats = {'rows': 0, 'skipped': 0, 'timings': {}}
+
+    if atol_path and os.path.exists(atol_path):
+        start_phase(run, 'atol', atol_path)
+        categories, products = {}, {}
+        with ProcessPoolExecutor(max_workers=workers) as pool, \
+                open(atol_path, 'r', encoding="cp1251", errors='ignore') as f:
+            chunks = pool.map(parse_atol, batched(f, settings.IMPORT_CHUNK_ROWS))
+            for chunk_categories, chunk_products, chunk_stats in chunks:
+                categories.update(chunk_categories)
+                products.update(chunk_products)
+                stats['rows'] += chunk_stats['rows']
+                stats['skipped'] += chunk_stats['skipped']
+        stats['timings']['parse'] = time.monotonic() - started
+        load_atol(categories, products, stats, batch_size, run)
+
+    if os.path.exists(xml_path):
+        start_phase(run, 'stock', xml_path)
+        stock_started = time.monotonic()
+        stats['denied'] = load_stock(iter_stock(xml_path), batch_size, run)
+        stats['timings']['stock'] = time.monotonic() - stock_started
+
+    stats['elapsed'] = time.monotonic() - started
+    return stats
+
+
+COUNTERS = ('product_count', 'display_count', 'in_stock_count')
+
+CATEGORY_COUNTERS_SQL = f"""
+    UPDATE {Category._meta.db_table} c
+       SET product_count = s.total, display_count = s.displayed,
+           in_stock_count = s.in_stock
+      FROM (SELECT c.id, count(p.id) AS total,
+                   count(p.id) FILTER (WHERE p.display) AS displayed,
+                   count(p.id) FILTER (WHERE p.display
+                                         AND p.warehouse1 + p.warehouse2 > 0) AS in_stock
+              FROM {Category._meta.db_table} c
+              LEFT JOIN {Product._meta.db_table} p ON p.category_id = c.id
+             WHERE %(ids)s::integer[] IS NULL OR c.id = ANY(%(ids)s::integer[])
+             GROUP BY c.id) s
+     WHERE c.id = s.id
+       AND (c.product_count, c.display_count, c.in_stock_count)
+           IS DISTINCT FROM (s.total, s.displayed, s.in_stock)
+"""
+
+GROUP_COUNTERS_SQL = f"""
+    UPDATE {Group._meta.db_table} g
+       SET product_count = s.total, display_count = s.displayed,
+           in_stock_count = s.in_stock
+      FROM (SELECT g.id, coalesce(sum(c.product_count), 0) AS total,
+                   coalesce(sum(c.display_count), 0) AS displayed,
+                   coalesce(sum(c.in_stock_count), 0) AS in_stock
+              FROM {Group._meta.db_table} g
+              LEFT JOIN {Category._meta.db_table} c ON c.parent_id = g.id
+             GROUP BY g.id) s
+     WHERE g.id = s.id
+       AND (g.product_count, g.display_count, g.in_stock_count)
+           IS DISTINCT FROM (s.total, s.displayed, s.in_stock)
+"""
+
+
+def refresh_counters(category_ids=None):
+    """
+    Счётчики товаров категорий и групп: всего, выставлено, выставлено и
+    есть на складах. Два запроса на весь каталог или только на категории
+    category_ids (группы - всегда все, их немного); записываются только
+    изменившиеся строки. Возвращает число обновлённых категорий.
+    """
+    ids = None if category_ids is None else list(category_ids)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(CATEGORY_COUNTERS_SQL, {'ids': ids})
+        updated = cursor.rowcount
+        cursor.execute(GROUP_COUNTERS_SQL)
+    return updated
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce import settings
+from store.search_index import build_index
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает файл индекса поиска (SEARCH_BACKEND = "index"); ' \
+           'обычно это делает product_import'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = build_index()
+        self.stdout.write(f'{settings.SEARCH_INDEX_FILE}: {count} товаров, '
+                          f'{time.monotonic() - started:.1f}s')
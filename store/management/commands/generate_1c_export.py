@@ -0,0 +1,99 @@
+import os
+import random
+
+from django.core.management.base import BaseCommand
+
+from ecommerce.settings import BASE_DIR
+
+BRANDS = ['ИЭК', 'ABB', 'Schneider', 'EKF', 'Legrand', 'КЭАЗ', 'DKC']
+CATEGORIES = [
+    'Автоматические выключатели', 'Кабель силовой', 'Провод монтажный',
+    'Розетки и выключатели', 'Светильники', 'Лампы светодиодные',
+    'Щиты и боксы', 'Кабель-каналы', 'Клеммы и зажимы', 'Удлинители',
+    'УЗО и дифавтоматы', 'Контакторы', 'Счетчики электроэнергии',
+]
+ITEMS = [
+    'Автомат ВА47-29 {p}Р {a}А', 'Кабель ВВГнг-LS {p}х{s}', 'Провод ПуГВ {s} белый',
+    'Розетка с з/к {a}А IP44', 'Светильник ДПО {a}Вт 4000К', 'Лампа LED A60 {a}Вт E27',
+    'Щит ЩРН-{a} IP31', 'Кабель-канал {a}х{p}0', 'Клемма WAGO {p}-проводная',
+    'Удлинитель {p} гн. {a}м', 'УЗО ВД1-63 {p}Р {a}А 30мА', 'Контактор КМИ-{a}',
+]
+
+
+def atol_row(key, name, price='', parent='', article=''):
+    """Строка выгрузки АТОЛ: 26 полей, используются 0, 2, 4, 15 и 25"""
+    row = ['1'] * 26
+    row[0], row[2], row[4], row[15], row[25] = \
+        str(key), name, price, str(parent), article
+    row[1] = row[3] = ''
+    return ';'.join(row)
+
+
+def generate(atol_path, xml_path, nominations, per_category, orphans, seed):
+    rnd = random.Random(seed)
+    key = 1
+    product_ids = []
+
+    with open(atol_path, 'w', encoding='cp1251') as f:
+        while len(product_ids) < nominations:
+            category = key
+            key += 1
+            f.write(atol_row(category, f'({category % 100:02d}) '
+                                       f'{rnd.choice(CATEGORIES)} '
+                                       f'({rnd.choice(BRANDS)})...') + '\n')
+            for _ in range(min(rnd.randint(1, per_category * 2),
+                               nominations - len(product_ids))):
+                name = rnd.choice(ITEMS).format(p=rnd.randint(1, 4),
+                                                a=rnd.choice([6, 10, 16, 25, 32]),
+                                                s=rnd.choice(['1,5', '2,5', '4']))
+                if rnd.random() < 0.3:
+                    name = f'({rnd.choice(BRANDS)}) {name}'
+                price = f'{rnd.randint(10, 50000)}.{rnd.randint(0, 99):02d}'
+                f.write(atol_row(key, name, price, category,
+                                 f'{rnd.choice(BRANDS)[:3].upper()}-{key}') + '\n')
+                product_ids.append(key)
+                key += 1
+
+            if rnd.random() < 0.05:
+                # Служебные строки выгрузки, импорт их пропускает
+                f.write(';'.join(['#', 'x']) + '\n')
+
+    stock_ids = product_ids + list(range(key, key + int(nominations * orphans)))
+    rnd.shuffle(stock_ids)
+    with open(xml_path, 'w', encoding='cp1251') as f:
+        f.write('<?xml version="1.0" encoding="windows-1251"?>\n<noms>\n')
+        for id in stock_ids:
+            f.write(f'<nom id="{id}" name="Товар {id}" art="A-{id}"><whs>'
+                    f'<scl count="{rnd.randint(0, 50)}"/>'
+                    f'<scl count="{rnd.randint(0, 50)}"/>'
+                    f'</whs></nom>\n')
+        f.write('</noms>\n')
+
+    return len(product_ids), len(stock_ids)
+
+
+class Command(BaseCommand):
+    help = 'Синтетическая выгрузка 1С (export_atol.txt и export.xml в cp1251) ' \
+           'для проверки и замеров импорта'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nominations', type=int, default=10000,
+                            help='Число товаров: 10000, 100000, 1000000...')
+        parser.add_argument('--per-category', type=int, default=200,
+                            help='Среднее число товаров в категории')
+        parser.add_argument('--orphans', type=float, default=0.02,
+                            help='Доля позиций остатков без товара в каталоге')
+        parser.add_argument('--output', default='imported')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        output = os.path.join(BASE_DIR, options['output'])
+        os.makedirs(output, exist_ok=True)
+        atol_path = os.path.join(output, 'export_atol.txt')
+        xml_path = os.path.join(output, 'export.xml')
+
+        products, stock = generate(atol_path, xml_path, options['nominations'],
+                                   options['per_category'], options['orphans'],
+                                   options['seed'])
+        self.stdout.write(f'{atol_path}: {products} товаров\n'
+                          f'{xml_path}: {stock} позиций остатков')
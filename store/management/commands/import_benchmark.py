@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from ecommerce.settings import BASE_DIR
+from store.importers import bulk_load_atol, copy_load_atol, iter_stock, \
+    load_stock, pipelined_load
+from store.tasks import atol_import
+
+
+def orm_import(atol_path, xml_path, workers):
+    # Построчный atol_import удаляет файл после загрузки - отдаём ему копию
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = shutil.copy(atol_path, tmp)
+        atol_import(copy)
+    load_stock(iter_stock(xml_path))
+
+
+def serial_import(loader):
+    def run(atol_path, xml_path, workers):
+        # То же, что product_import при IMPORT_WORKERS = 1
+        with open(atol_path, 'r', encoding="cp1251", errors='ignore') as f:
+            loader(f)
+        load_stock(iter_stock(xml_path))
+    return run
+
+
+def pipelined_import(atol_path, xml_path, workers):
+    pipelined_load(atol_path, xml_path, workers=workers)
+
+
+BACKENDS = {
+    'orm': orm_import,
+    'bulk': serial_import(bulk_load_atol),
+    'copy': serial_import(copy_load_atol),
+    'pipelined': pipelined_import,
+}
+
+
+def measure(name, atol_path, xml_path, workers, results):
+    """
+    Один прогон в отдельном процессе, чтобы пик памяти не зависел от
+    предыдущих прогонов. Изменения в базе откатываются.
+    """
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries), transaction.atomic():
+        started = time.monotonic()
+        BACKENDS[name](atol_path, xml_path, workers)
+        elapsed = time.monotonic() - started
+        transaction.set_rollback(True)
+
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.send((elapsed, queries, rss / 1024))
+
+
+class Command(BaseCommand):
+    help = 'Замеры импорта выгрузки 1С каждым способом: время, число запросов, ' \
+           'пик памяти. Изменения в базе откатываются после каждого прогона, ' \
+           'файлы не удаляются. Файлы для замеров: generate_1c_export.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--atol', default='imported/export_atol.txt')
+        parser.add_argument('--xml', default='imported/export.xml')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--backend', action='append', choices=BACKENDS,
+                            help='По умолчанию - все, кроме построчного orm')
+
+    def handle(self, *args, **options):
+        atol_path = os.path.join(BASE_DIR, options['atol'])
+        xml_path = os.path.join(BASE_DIR, options['xml'])
+        with open(atol_path, 'rb') as f:
+            rows = sum(1 for _ in f)
+
+        self.stdout.write(f'{atol_path}: {rows} строк, workers={options["workers"]}')
+        self.stdout.write(f'{"":>10}  {"min, с":>8}  {"медиана":>8}  '
+                          f'{"строк/с":>8}  {"запросов":>9}  {"пик RSS, МБ":>11}')
+
+        context = multiprocessing.get_context('fork')
+        for name in options['backend'] or [b for b in BACKENDS if b != 'orm']:
+            timings, queries, rss = [], set(), []
+            for _ in range(options['repeat']):
+                # Дочерний процесс не должен унаследовать открытое соединение
+                connections.close_all()
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=measure, args=(
+                    name, atol_path, xml_path, options['workers'], sender))
+                process.start()
+                # Свой конец закрыт: упавший прогон даёт EOFError, а не вечное ожидание
+                sender.close()
+                try:
+                    elapsed, run_queries, run_rss = receiver.recv()
+                except EOFError:
+                    elapsed = None
+                process.join()
+                if elapsed is None or process.exitcode:
+                    raise CommandError(f'{name}: прогон завершился с кодом '
+                                       f'{process.exitcode}')
+                timings.append(elapsed)
+                queries.add(run_queries)
+                rss.append(run_rss)
+
+            # Число запросов от прогона к прогону не должно меняться
+            queries = '/'.join(map(str, sorted(queries)))
+            best = min(timings)
+            self.stdout.write(
+                f'{name:>10}  {best:8.2f}  {statistics.median(timings):8.2f}  '
+                f'{rows / best:8.0f}  {queries:>9}  {max(rss):11.1f}'
+            )
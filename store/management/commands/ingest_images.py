@@ -0,0 +1,88 @@
+import os
+import shutil
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from ecommerce import settings
+from store.cache import bump_version
+from store.images import process_product_images, collect_garbage
+from store.models import Product
+from store.utils import path_and_rename, file_hash
+
+EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+def path_hash(path):
+    with open(path, 'rb') as f:
+        return file_hash(File(f))
+
+
+class Command(BaseCommand):
+    help = 'Загрузка фотографий товаров из каталога: имя файла - артикул ' \
+           '(ABC-123.jpg). Уже загруженные файлы с тем же содержимым пропускаются'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int, default=settings.IMAGE_WORKERS)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        directory = options['directory']
+        files = {}
+        for entry in os.scandir(directory):
+            article, ext = os.path.splitext(entry.name)
+            if entry.is_file() and ext.lower() in EXTENSIONS:
+                files[article.strip()] = entry.path
+
+        # Один запрос по индексу артикула на все файлы
+        products = defaultdict(list)
+        for product in Product.objects.filter(article__in=files) \
+                .only('id', 'article', 'image', 'image_hash'):
+            products[product.article].append(product)
+        unmatched = sorted(set(files) - set(products))
+
+        paths = [files[article] for article in products]
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            hashes = dict(zip(paths, pool.map(path_hash, paths, chunksize=16)))
+
+        changed = []
+        for article, items in products.items():
+            path = files[article]
+            for product in items:
+                if product.image_hash == hashes[path]:
+                    continue
+                product.image_hash = hashes[path]
+                product.image = path_and_rename(product, os.path.basename(path))
+                target = os.path.join(settings.MEDIA_ROOT, product.image.name)
+                if not os.path.exists(target):
+                    shutil.copyfile(path, target)
+                product.image_status = Product.IMAGE_PENDING
+                product.image_variants = {}
+                product.version = F('version') + 1
+                changed.append(product)
+
+        Product.objects.bulk_update(changed, ['image', 'image_hash', 'image_status',
+                                              'image_variants', 'version'],
+                                    batch_size=settings.IMPORT_BATCH_SIZE)
+        processed = process_product_images([product.id for product in changed],
+                                           options['workers'])
+        # bulk_update - без сигналов: страницы из кэша ещё с заглушками.
+        # Строки и карточки товаров - по версии товара, она уже другая
+        if changed:
+            bump_version()
+        removed = collect_garbage()
+
+        self.stdout.write(
+            f'{len(files)} файлов: {processed} загружено, '
+            f'{sum(map(len, products.values())) - len(changed)} без изменений, '
+            f'{len(unmatched)} без товара, {removed} ненужных файлов удалено, '
+            f'{time.monotonic() - started:.1f}s'
+        )
+        if unmatched:
+            self.stdout.write('Артикулы не найдены: ' + ', '.join(unmatched[:20])
+                              + (' ...' if len(unmatched) > 20 else ''))
@@ -0,0 +1,92 @@
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Count
+
+from store.importers import copy_load_atol
+from store.models import Product
+from store.pagination import KeysetPaginator, encode_cursor
+from store.management.commands.generate_1c_export import generate
+from store.management.commands.search_benchmark import percentile
+
+
+class Command(BaseCommand):
+    help = 'Замеры страниц самой большой категории: OFFSET (Paginator) ' \
+           'и по курсору (KeysetPaginator). С --nominations каталог ' \
+           'генерируется и загружается во временной транзакции'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nominations', type=int, default=0,
+                            help='Сгенерировать каталог: 100000, 1000000...')
+        parser.add_argument('--per-category', type=int, default=20000)
+        parser.add_argument('--pager', type=int, default=50)
+        parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 500])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['nominations']:
+                self.load_catalog(options['nominations'], options['per_category'],
+                                  options['seed'])
+            self.measure(options)
+            transaction.set_rollback(True)
+
+    def load_catalog(self, nominations, per_category, seed):
+        with tempfile.TemporaryDirectory() as tmp:
+            atol_path = os.path.join(tmp, 'export_atol.txt')
+            generate(atol_path, os.path.join(tmp, 'export.xml'),
+                     nominations, per_category, 0, seed)
+            with open(atol_path, 'r', encoding='cp1251') as f:
+                copy_load_atol(f)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Product._meta.db_table}')
+
+    def timed(self, repeat, fetch):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fetch()
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    def measure(self, options):
+        category = Product.objects.values('category_id').annotate(n=Count('id')) \
+            .order_by('-n').first()
+        if category is None:
+            self.stdout.write('Нет товаров')
+            return
+        queryset = Product.objects.filter(category_id=category['category_id']) \
+            .order_by('title', 'id')
+        pager = options['pager']
+        self.stdout.write(f'Категория {category["category_id"]}: {category["n"]} '
+                          f'товаров, по {pager} на странице')
+        self.stdout.write(f'{"страница":>8}  {"":>6}  {"p50, мс":>8}  {"p99, мс":>8}')
+
+        for number in options['pages']:
+            offset = (number - 1) * pager
+            if offset >= category['n']:
+                continue
+            # Как ListView с Paginator: COUNT и OFFSET
+            offset_timings = self.timed(options['repeat'], lambda: list(
+                Paginator(queryset, pager).page(number).object_list))
+
+            # Курсор на страницу - как в ссылке 'вперёд' с предыдущей
+            cursor = None
+            if number > 1:
+                previous = queryset[offset - 1]
+                cursor = encode_cursor({'v': [previous.title, previous.id],
+                                        'n': number, 'f': True})
+            keyset_timings = self.timed(options['repeat'], lambda: list(
+                KeysetPaginator(queryset, pager).page(number, cursor)))
+
+            for name, timings in (('offset', offset_timings),
+                                  ('keyset', keyset_timings)):
+                self.stdout.write(f'{number:>8}  {name:>6}  '
+                                  f'{statistics.median(timings):8.1f}  '
+                                  f'{percentile(timings, 0.99):8.1f}')
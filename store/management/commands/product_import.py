@@ -0,0 +1,21 @@
+from functools import partial
+
+from django.core.management.base import BaseCommand
+
+from ecommerce import settings
+from store.tasks import run_import, product_import_steps, ATOL_FILE, XML_FILE
+
+
+class Command(BaseCommand):
+    help = 'Импорт каталога и остатков из 1С в этом процессе, под той же ' \
+           'арендой ImportRun, что и задача product_import. С --workers ' \
+           'больше 1 выгрузка АТОЛ разбирается в пуле процессов - в задаче ' \
+           'Celery это невозможно: процессы воркера - демоны'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.IMPORT_WORKERS)
+
+    def handle(self, *args, **options):
+        run_import('product_import',
+                   partial(product_import_steps, workers=options['workers']),
+                   [ATOL_FILE, XML_FILE])
@@ -0,0 +1,119 @@
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ecommerce import settings
+from store.importers import copy_load_atol
+from store.models import Product
+from store.search import SEARCH_BACKENDS
+from store.search_index import build_index
+from store.autocomplete import Suggestions
+from store.management.commands.generate_1c_export import generate
+
+
+def sample_queries(count, rnd):
+    """Запросы из наименований и артикулов каталога: слово, начало слова
+    (поиск при наборе), два слова, артикул"""
+    products = list(Product.objects.order_by('?').values_list('title', 'article')[:count])
+    queries = []
+    for title, article in products:
+        words = [word for word in re.findall(r'\w+', title) if len(word) > 3]
+        if not words:
+            continue
+        word = rnd.choice(words)
+        queries.append(rnd.choice([
+            word,
+            word[:rnd.randint(3, len(word))],
+            ' '.join(words[:2]),
+            article,
+        ]))
+    return queries
+
+
+def percentile(timings, p):
+    return sorted(timings)[min(len(timings) - 1, int(len(timings) * p))]
+
+
+class Command(BaseCommand):
+    help = 'Замеры поиска товаров каждым способом (SEARCH_BACKENDS): задержка ' \
+           'запроса страницы результатов с подсчётом. С --nominations каталог ' \
+           'генерируется и загружается во временной транзакции'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nominations', type=int, default=0,
+                            help='Сгенерировать каталог: 100000, 1000000...')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--page', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        index_file = settings.SEARCH_INDEX_FILE
+        with transaction.atomic(), tempfile.TemporaryDirectory() as tmp:
+            if options['nominations']:
+                self.load_catalog(options['nominations'], options['seed'])
+            # Индекс для замера - во временном файле, рабочий не трогаем
+            settings.SEARCH_INDEX_FILE = os.path.join(tmp, 'search.idx')
+            started = time.monotonic()
+            build_index()
+            self.stdout.write(f'Индекс: {time.monotonic() - started:.1f}s, '
+                              f'{os.path.getsize(settings.SEARCH_INDEX_FILE) >> 10} КБ')
+            try:
+                self.measure(options)
+            finally:
+                settings.SEARCH_INDEX_FILE = index_file
+            transaction.set_rollback(True)
+
+    def load_catalog(self, nominations, seed):
+        with tempfile.TemporaryDirectory() as tmp:
+            atol_path = os.path.join(tmp, 'export_atol.txt')
+            generate(atol_path, os.path.join(tmp, 'export.xml'),
+                     nominations, 200, 0, seed)
+            with open(atol_path, 'r', encoding='cp1251') as f:
+                copy_load_atol(f)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT gin_clean_pending_list('store_product_search_gin')")
+            cursor.execute(f'ANALYZE {Product._meta.db_table}')
+
+    def measure(self, options):
+        queries = sample_queries(options['queries'], random.Random(options['seed']))
+        self.stdout.write(f'{Product.objects.count()} товаров, {len(queries)} запросов')
+        self.stdout.write(f'{"":>10}  {"p50, мс":>8}  {"p95, мс":>8}  '
+                          f'{"p99, мс":>8}  {"найдено":>8}')
+
+        for name, search in SEARCH_BACKENDS.items():
+            timings = []
+            found = 0
+            for query in queries:
+                started = time.perf_counter()
+                # Как ListView: число результатов и первая страница
+                queryset = search(query)
+                found += queryset.count()
+                list(queryset[:options['page']])
+                timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(
+                f'{name:>10}  {statistics.median(timings):8.1f}  '
+                f'{percentile(timings, 0.95):8.1f}  {percentile(timings, 0.99):8.1f}  '
+                f'{found / len(queries):8.0f}'
+            )
+
+        # Подсказки при наборе: каждое начало запроса от 2 символов
+        started = time.monotonic()
+        suggestions = Suggestions()
+        self.stdout.write(f'Подсказки: построены за {time.monotonic() - started:.1f}s')
+        timings = []
+        for query in queries:
+            for length in range(2, len(query) + 1):
+                started = time.perf_counter()
+                suggestions.suggest(query[:length], 10)
+                timings.append((time.perf_counter() - started) * 1000)
+        self.stdout.write(
+            f'{"suggest":>10}  {statistics.median(timings):8.2f}  '
+            f'{percentile(timings, 0.95):8.2f}  {percentile(timings, 0.99):8.2f}'
+        )
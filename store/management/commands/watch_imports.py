@@ -0,0 +1,176 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce import settings
+from ecommerce.settings import BASE_DIR
+from store.tasks import ATOL_FILE, XML_FILE, product_import, stock_import
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+EVENT_HEADER = struct.Struct('iIII')
+
+# Состояние выгрузки: дописана и закрыта (или переложена в каталог целиком),
+# ещё пишется, неизвестно (опрос каталога, файл лежал до запуска)
+CLOSED = 'closed'
+OPEN = 'open'
+UNKNOWN = 'unknown'
+
+
+class Inotify:
+    """Минимальная обёртка над inotify(7) через ctypes: только Linux"""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0 or libc.inotify_add_watch(
+                self.fd, os.fsencode(directory),
+                IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify is not available')
+
+    def wait(self, timeout):
+        """Файлы, изменившиеся за timeout секунд: имя -> CLOSED или OPEN"""
+        names = {}
+        if select.select([self.fd], [], [], timeout)[0]:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0').decode()
+                # IN_CREATE - загрузка только началась
+                names[name] = CLOSED if mask & (IN_CLOSE_WRITE | IN_MOVED_TO) else OPEN
+                offset += length
+        return names
+
+
+class Poller:
+    """Запасной вариант без inotify: опрос каталога"""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return dict.fromkeys(os.listdir(self.directory), UNKNOWN)
+
+
+def file_stamp(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Uploads:
+    """
+    Выгрузки, ждущие импорта. Закрытая после записи (CLOSED) готова, когда
+    debounce секунд не было других событий: выгрузка АТОЛ и остатки
+    приходят парой и уходят одной задачей. Открытая (OPEN) не готова никогда,
+    сколько бы не менялась: оборванная загрузка по FTP не должна снять с
+    показа товары, не дошедшие до файла. Только если о закрытии узнать
+    неоткуда (UNKNOWN), файл готов, когда его размер и время не менялись
+    poll_debounce секунд.
+    """
+
+    def __init__(self, files, debounce, poll_debounce, clock=time.monotonic):
+        self.files = files
+        self.debounce = debounce
+        self.poll_debounce = poll_debounce
+        self.clock = clock
+        # путь -> (состояние, размер и время файла, когда изменилось)
+        self.pending = {}
+        self.enqueued = {}
+
+    def event(self, path, state):
+        if path not in self.files:
+            return
+        stamp = file_stamp(path)
+        if stamp is None:
+            self.pending.pop(path, None)
+            return
+        if self.enqueued.get(path) == stamp:
+            return
+        previous = self.pending.get(path)
+        if state == UNKNOWN and previous and previous[1] == stamp:
+            # Опрос видит тот же файл: отсчёт не начинается заново
+            return
+        self.pending[path] = (state, stamp, self.clock())
+
+    def ready(self):
+        """Готовые к импорту файлы (путь -> размер и время) или пустой словарь"""
+        if not self.pending:
+            return {}
+        now = self.clock()
+        for path, (state, stamp, since) in list(self.pending.items()):
+            current = file_stamp(path)
+            if current is None:
+                del self.pending[path]
+                return {}
+            if current != stamp:
+                # После закрытия файл снова пишут: ждём следующего закрытия
+                self.pending[path] = (OPEN if state == CLOSED else state, current, now)
+                return {}
+            if state == OPEN or now - since < (
+                    self.debounce if state == CLOSED else self.poll_debounce):
+                return {}
+        ready = {path: stamp for path, (_, stamp, _) in self.pending.items()}
+        self.enqueued.update(ready)
+        self.pending = {}
+        return ready
+
+
+class Command(BaseCommand):
+    help = 'Следит за каталогом imported/ и ставит импорт в очередь Celery, ' \
+           'как только выгрузка 1С дописана до конца'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debounce', type=float,
+                            default=settings.IMPORT_DEBOUNCE,
+                            help='Сколько секунд ждать второй файл после закрытия первого')
+        parser.add_argument('--poll-debounce', type=float,
+                            default=settings.IMPORT_POLL_DEBOUNCE,
+                            help='Без inotify: сколько секунд файл должен не меняться')
+        parser.add_argument('--poll', action='store_true',
+                            help='Опрашивать каталог вместо inotify')
+
+    def handle(self, *args, **options):
+        files = {os.path.join(BASE_DIR, name) for name in (ATOL_FILE, XML_FILE)}
+        directory = os.path.dirname(next(iter(files)))
+        debounce = options['debounce']
+
+        watcher = None
+        if not options['poll']:
+            try:
+                watcher = Inotify(directory)
+            except (OSError, AttributeError) as e:
+                self.stderr.write(f'{e}, опрашиваем каталог')
+        watcher = watcher or Poller(directory, debounce)
+        self.stdout.write(f'{type(watcher).__name__}: {directory}')
+
+        uploads = Uploads(files, debounce, options['poll_debounce'])
+        # Файлы, уже лежащие в каталоге при запуске, тоже обрабатываются
+        for path in files:
+            uploads.event(path, UNKNOWN)
+        while True:
+            for name, state in watcher.wait(debounce if uploads.pending else 60).items():
+                uploads.event(os.path.join(directory, name), state)
+
+            ready = uploads.ready()
+            if not ready:
+                continue
+
+            task = product_import \
+                if os.path.join(BASE_DIR, ATOL_FILE) in ready else stock_import
+            # Занятую другим импортом аренду задача переждёт сама (self.retry)
+            task.delay()
+            self.stdout.write(f'{task.name}: {", ".join(sorted(ready))}')
@@ -0,0 +1,217 @@
+# Generated by Django 3.1.11 on 2026-10-18 16:56
+
+from django.conf import settings
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.manager
+import django.utils.timezone
+import store.utils
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Article',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255, verbose_name='Заголовок')),
+                ('name', models.CharField(max_length=50, verbose_name='Пункт меню')),
+                ('slug', models.SlugField(unique=True)),
+                ('content', models.TextField(null=True, verbose_name='Текст страницы')),
+            ],
+            options={
+                'verbose_name': 'Страница',
+                'verbose_name_plural': '4. Страницы',
+                'ordering': ('id',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, verbose_name='Категория')),
+                ('image', models.ImageField(blank=True, help_text='Изображение размером 350x130 пикселей', null=True, upload_to=store.utils.category_image, verbose_name='Изображение')),
+                ('image_hash', models.CharField(blank=True, default='', editable=False, max_length=16)),
+                ('fingerprint', models.CharField(blank=True, default='', editable=False, max_length=16)),
+                ('product_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='Товаров')),
+                ('display_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='Выставлено')),
+                ('in_stock_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='В наличии')),
+            ],
+            options={
+                'verbose_name': 'Категория',
+                'verbose_name_plural': '5. Категории',
+                'ordering': ('name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Customer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now=True, verbose_name='Дата подключения клиента')),
+                ('code', models.CharField(blank=True, max_length=200, null=True, verbose_name='Код подтверждения email')),
+                ('is_confirmed', models.BooleanField(default=False, verbose_name='email подтвержден')),
+                ('first_name', models.CharField(blank=True, max_length=50, verbose_name='Имя')),
+                ('last_name', models.CharField(blank=True, max_length=50, verbose_name='Фамилия')),
+                ('patronymic', models.CharField(blank=True, max_length=50, verbose_name='Отчество')),
+                ('phone', models.CharField(blank=True, max_length=20, verbose_name='Телефон')),
+            ],
+            options={
+                'verbose_name': 'Покупатель',
+                'verbose_name_plural': '2. Покупатели',
+                'ordering': ('last_name', 'first_name'),
+            },
+        ),
+        migrations.CreateModel(
+            name='Group',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, verbose_name='Группа')),
+                ('image', models.ImageField(blank=True, help_text='Изображение размером 350x130 пикселей', null=True, upload_to=store.utils.group_image, verbose_name='Изображение')),
+                ('image_hash', models.CharField(blank=True, default='', editable=False, max_length=16)),
+                ('start_page', models.BooleanField(default=False, verbose_name='Разместить на стартовой')),
+                ('product_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='Товаров')),
+                ('display_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='Выставлено')),
+                ('in_stock_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='В наличии')),
+            ],
+            options={
+                'verbose_name': 'Группа',
+                'verbose_name_plural': '6. Группы',
+                'ordering': ('id',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=50, verbose_name='Задача')),
+                ('status', models.CharField(choices=[('running', 'Выполняется'), ('finished', 'Завершен'), ('failed', 'Прерван')], default='running', max_length=20, verbose_name='Статус')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Начало')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Окончание')),
+                ('lease_owner', models.CharField(blank=True, max_length=32)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('checkpoint', models.JSONField(blank=True, default=dict, verbose_name='Контрольная точка')),
+                ('parse_time', models.FloatField(default=0, verbose_name='Разбор')),
+                ('category_time', models.FloatField(default=0, verbose_name='Категории')),
+                ('product_time', models.FloatField(default=0, verbose_name='Товары')),
+                ('stock_time', models.FloatField(default=0, verbose_name='Остатки')),
+                ('cleanup_time', models.FloatField(default=0, verbose_name='Удаление файлов')),
+                ('rows_read', models.PositiveIntegerField(default=0, verbose_name='Строк')),
+                ('rows_skipped', models.PositiveIntegerField(default=0, verbose_name='Пропущено')),
+                ('inserted', models.PositiveIntegerField(default=0, verbose_name='Добавлено')),
+                ('updated', models.PositiveIntegerField(default=0, verbose_name='Изменено')),
+                ('denied', models.PositiveIntegerField(default=0, verbose_name='Не найдено по ID')),
+                ('peak_memory', models.FloatField(default=0, verbose_name='Пик памяти за запуск, МБ')),
+            ],
+            options={
+                'verbose_name': 'Импорт из 1С',
+                'verbose_name_plural': '7. Импорт из 1С',
+                'ordering': ('-started_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session', models.CharField(max_length=50)),
+                ('total_products', models.PositiveIntegerField(default=0, verbose_name='Товары')),
+                ('total_price_net', models.DecimalField(decimal_places=2, default=0, max_digits=9, verbose_name='Общая сумма')),
+                ('status', models.CharField(choices=[('cart', 'Корзина'), ('new', 'Оформлен клиентом'), ('approved', 'Подтвержден'), ('processed', 'Обработан'), ('is_ready', 'Готов к выдаче'), ('finished', 'Завершен'), ('canceled', 'Отменен')], default='cart', max_length=100, verbose_name='Статус заказа')),
+                ('comment', models.TextField(blank=True, null=True, verbose_name='Комментарий к заказу')),
+                ('remark', models.CharField(blank=True, help_text='Служебные примечания, клиенту недоступны', max_length=255, null=True, verbose_name='Примечания от магазина')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата заказа')),
+                ('first_name', models.CharField(blank=True, max_length=50, verbose_name='Имя')),
+                ('last_name', models.CharField(blank=True, max_length=50, verbose_name='Фамилия')),
+                ('patronymic', models.CharField(blank=True, max_length=50, verbose_name='Отчество')),
+                ('phone', models.CharField(blank=True, max_length=20, verbose_name='Телефон')),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='store.customer', verbose_name='Покупатель')),
+            ],
+            options={
+                'verbose_name': 'Заказ',
+                'verbose_name_plural': '1. Заказы',
+            },
+            managers=[
+                ('orders', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('article', models.CharField(db_index=True, max_length=50, verbose_name='Артикул')),
+                ('article_key', models.CharField(blank=True, db_index=True, default='', editable=False, max_length=50)),
+                ('title', models.CharField(max_length=255, verbose_name='Наименование')),
+                ('image', models.ImageField(blank=True, help_text='Файл jpg', null=True, upload_to=store.utils.path_and_rename, verbose_name='Изображение')),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=9, verbose_name='Цена')),
+                ('warehouse1', models.PositiveIntegerField(default=0, verbose_name='Склад ЭЛЕКТРОН')),
+                ('warehouse2', models.PositiveIntegerField(default=0, verbose_name='Склад ЭЛЕКТРИКА')),
+                ('display', models.BooleanField(default=True, verbose_name='Выставлять')),
+                ('fingerprint', models.CharField(blank=True, default='', editable=False, max_length=16)),
+                ('image_hash', models.CharField(blank=True, default='', editable=False, max_length=16)),
+                ('image_status', models.CharField(choices=[('pending', 'Обрабатывается'), ('ready', 'Готово'), ('failed', 'Ошибка')], default='ready', editable=False, max_length=10, verbose_name='Обработка изображения')),
+                ('image_variants', models.JSONField(blank=True, default=dict, editable=False)),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(editable=False, null=True)),
+                ('version', models.PositiveIntegerField(default=1, editable=False)),
+                ('category', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='store.category', verbose_name='Категория')),
+            ],
+            options={
+                'verbose_name': 'Товар',
+                'verbose_name_plural': '3. Товары',
+                'ordering': ('category', 'title'),
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderProduct',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('qty', models.PositiveIntegerField(default=1, verbose_name='шт')),
+                ('final_price', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Общая цена')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_products', to='store.order', verbose_name='Корзина')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='store.product', verbose_name='Товар')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='products',
+            field=models.ManyToManyField(blank=True, related_name='related_cart', to='store.OrderProduct', verbose_name='Перечень'),
+        ),
+        migrations.AddConstraint(
+            model_name='importrun',
+            constraint=models.UniqueConstraint(condition=models.Q(status='running'), fields=('status',), name='single_running_import'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='orders',
+            field=models.ManyToManyField(related_name='related_order', to='store.Order', verbose_name='Заказы клиента'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='parent',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='store.group', verbose_name='Группа'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='store_product_search_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'title', 'id'], name='store_product_category_title'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['title', 'id'], name='store_product_title_id'),
+        ),
+    ]
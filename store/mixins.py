@@ -1,19 +1,38 @@
+from django.contrib import messages
 from django.core.cache import cache
+from django.core.paginator import InvalidPage
+from django.db.models import QuerySet
+from django.http import Http404, HttpResponse
 from django.views.generic import View
 from django.contrib.auth import logout
 
+from ecommerce import settings
 from .models import Order, Customer, Article
+from .cache import page_key, page_version, get_or_refresh, get_version, ARTICLES
+from .pagination import KeysetPaginator, NumberedPaginator
+
+
+def article_menu():
+    """Статьи для меню сайта, общие для всех процессов до правки статьи"""
+    return cache.get_or_set(f'article_menu:{get_version(ARTICLES)}',
+                            lambda: list(Article.objects.all()),
+                            timeout=60 * 60 * 24)
 
 
 class CartMixin(View):
     customer = None
+    # Страница без корзины посетителя, общая для всех (PageCacheMixin)
+    shared_page = False
 
     def __init__(self):
         super().__init__()
-        self.articles = cache.get_or_set('article_menu',
-                                         Article.objects.all(), timeout=600)
+        self.articles = article_menu()
 
     def dispatch(self, request, *args, **kwargs):
+        if self.shared_page:
+            # Значок корзины страница загрузит сама: CartBadgeView
+            self.cart = None
+            return super().dispatch(request, *args, **kwargs)
 
         if request.user.is_authenticated:
             try:
@@ -46,3 +65,66 @@ class RequiredFieldsMixin:
             for key in self.fields:
                 if key in fields_required:
                     self.fields[key].required = True
+
+
+class KeysetPaginationMixin:
+    """Постраничный вывод ListView через KeysetPaginator: ?page= или ?cursor="""
+    paginator_class = NumberedPaginator
+
+    def get_paginate_count(self):
+        """Готовое число строк списка; None - посчитать запросом, если нужно"""
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        if not isinstance(queryset, QuerySet):
+            # Результаты поиска по индексу уже в памяти, OFFSET им не страшен
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(queryset, page_size, self.get_paginate_count())
+        try:
+            page = paginator.page(self.request.GET.get('page'),
+                                  self.request.GET.get('cursor'))
+        except InvalidPage as e:
+            raise Http404(f'Неверная страница: {e}')
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+class PageCacheMixin(View):
+    """
+    Кэш страниц каталога для анонимных посетителей. Ключ - адрес и параметры,
+    запись помечена версиями каталога (store.cache), поэтому после импорта
+    все страницы строятся заново, каждую - один процесс (get_or_refresh).
+    Страница в кэше не содержит корзины посетителя. Ставится перед
+    CartMixin: при попадании корзина не читается вовсе.
+    """
+    # Параметры запроса, которые читает view: только они входят в ключ
+    page_cache_query = ()
+    # Настройки просмотра из сессии, от которых зависит страница
+    page_cache_session = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated \
+                or len(messages.get_messages(request)) \
+                or any(name in request.GET for name in self.page_cache_session):
+            # Свои сообщения, вход или смена настроек просмотра - без кэша
+            return super().dispatch(request, *args, **kwargs)
+
+        key = page_key(request, self.page_cache_query,
+                       **{name: request.session.get(name)
+                          for name in self.page_cache_session})
+        dispatch = super().dispatch
+        response = None
+
+        def render():
+            nonlocal response
+            self.shared_page = request.shared_page = True
+            response = dispatch(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                if hasattr(response, 'render'):
+                    response.render()
+                return response.content
+
+        # После импорта страницу строит один процесс, остальные отдают прежнюю
+        content = get_or_refresh(key, page_version(), render,
+                                 settings.PAGE_CACHE_TIMEOUT)
+        return response if response is not None else HttpResponse(content)
@@ -1,13 +1,22 @@
-import os
-from PIL import Image
-from django.db import models
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction, connection, IntegrityError
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import mark_safe
 
 from ecommerce import settings
-from store.utils import path_and_rename, group_image, category_image
+from store.cache import get_or_refresh, get_version, CATALOG
+from store.utils import path_and_rename, group_image, category_image, \
+    file_hash, reuse_stored_file, normalize_article, fingerprint, product_fingerprint, \
+    memory_usage
 
 NO_IMAGE_URL = '/static/img/no_image.png'
 NO_IMAGE_THUMB = '/static/img/no_image_thumb.png'
@@ -26,8 +35,18 @@ class Group(models.Model):
     image = models.ImageField(verbose_name='Изображение', blank=True,
                               null=True, upload_to=group_image,
                               help_text='Изображение размером 350x130 пикселей')
+    image_hash = models.CharField(max_length=16, blank=True, default='',
+                                  editable=False)
     start_page = models.BooleanField(verbose_name='Разместить на стартовой', default=False,
                                      blank=False, null=False)
+    # Счётчики товаров, обновляются после импорта и правки товара в админке:
+    # store.importers.refresh_counters
+    product_count = models.PositiveIntegerField(verbose_name='Товаров', default=0,
+                                                editable=False)
+    display_count = models.PositiveIntegerField(verbose_name='Выставлено', default=0,
+                                                editable=False)
+    in_stock_count = models.PositiveIntegerField(verbose_name='В наличии', default=0,
+                                                 editable=False)
 
     def __str__(self):
         return self.name
@@ -37,9 +56,9 @@ class Group(models.Model):
 
     def save(self, *args, **kwargs):
         image = self.image
-        if image:
-            img = Image.open(image)
-            img.save(os.path.join(settings.MEDIA_ROOT, image.name))
+        if image and not image._committed:
+            self.image_hash = file_hash(image)
+            reuse_stored_file(image)
 
         super().save(*args, **kwargs)
 
@@ -60,6 +79,11 @@ class CategoryManager(models.Manager):
         return super().get_queryset()
 
     def get_category_list(self):
+        # После импорта список строит один процесс, остальные отдают прежний
+        return get_or_refresh('category_list', get_version(CATALOG),
+                              self.build_category_list, settings.PAGE_CACHE_TIMEOUT)
+
+    def build_category_list(self):
         q = self.get_queryset().annotate()
         data = [
             dict(name=c.name, url=c.get_absolute_url()) for c in q
@@ -83,6 +107,18 @@ class Category(models.Model):
     image = models.ImageField(verbose_name='Изображение', blank=True,
                               null=True, upload_to=category_image,
                               help_text='Изображение размером 350x130 пикселей')
+    image_hash = models.CharField(max_length=16, blank=True, default='',
+                                  editable=False)
+    fingerprint = models.CharField(max_length=16, blank=True, default='',
+                                   editable=False)
+    # Счётчики товаров, обновляются после импорта и правки товара в админке:
+    # store.importers.refresh_counters
+    product_count = models.PositiveIntegerField(verbose_name='Товаров', default=0,
+                                                editable=False)
+    display_count = models.PositiveIntegerField(verbose_name='Выставлено', default=0,
+                                                editable=False)
+    in_stock_count = models.PositiveIntegerField(verbose_name='В наличии', default=0,
+                                                 editable=False)
 
     def __str__(self):
         return self.name
@@ -91,10 +127,14 @@ class Category(models.Model):
         return reverse('category_detail', kwargs={'pk': self.pk})
 
     def save(self, *args, **kwargs):
+        # Наименование изменили в админке: следующий импорт запишет его из 1С
+        if self.fingerprint and self.fingerprint != fingerprint(self.name):
+            self.fingerprint = ''
+
         image = self.image
-        if image:
-            img = Image.open(image)
-            img.save(os.path.join(settings.MEDIA_ROOT, image.name))
+        if image and not image._committed:
+            self.image_hash = file_hash(image)
+            reuse_stored_file(image)
 
         super().save(*args, **kwargs)
 
@@ -114,16 +154,40 @@ class Product(models.Model):
         verbose_name = 'Товар'
         verbose_name_plural = '3. Товары'
         ordering = ('category', 'title')
+        indexes = [
+            GinIndex(fields=['search_vector'], name='store_product_search_gin'),
+            # Страницы списков по (title, id): store.pagination.KeysetPaginator
+            models.Index(fields=['category', 'title', 'id'],
+                         name='store_product_category_title'),
+            models.Index(fields=['title', 'id'], name='store_product_title_id'),
+        ]
 
     PRODUCT_BIG = (1100, 3000)
     PRODUCT_CARD = (300, 400)
     PRODUCT_THUMB = (50, 50)
     MAX_IMAGE_SIZE = 4145728
 
+    # Отпечатки товаров, пропавших из выгрузки: снят с показа импортом -
+    # вернувшись, выставляется снова; уже был скрыт в админке - остаётся скрытым
+    VANISHED = '-'
+    VANISHED_HIDDEN = '~'
+
+    IMAGE_PENDING = 'pending'
+    IMAGE_READY = 'ready'
+    IMAGE_FAILED = 'failed'
+    IMAGE_STATUSES = (
+        (IMAGE_PENDING, 'Обрабатывается'),
+        (IMAGE_READY, 'Готово'),
+        (IMAGE_FAILED, 'Ошибка'),
+    )
+
     category = models.ForeignKey(Category, verbose_name='Категория',
                                  null=False, blank=False, default=1,
                                  on_delete=models.CASCADE)
-    article = models.CharField(max_length=50, verbose_name='Артикул')
+    article = models.CharField(max_length=50, verbose_name='Артикул', db_index=True)
+    # Артикул без регистра, разделителей и кириллицы: store.utils.normalize_article
+    article_key = models.CharField(max_length=50, blank=True, default='',
+                                   db_index=True, editable=False)
     title = models.CharField(max_length=255, verbose_name='Наименование')
     image = models.ImageField(verbose_name='Изображение', blank=True,
                               null=True, upload_to=path_and_rename,
@@ -134,10 +198,33 @@ class Product(models.Model):
     warehouse2 = models.PositiveIntegerField(verbose_name='Склад ЭЛЕКТРИКА', default=0)
     display = models.BooleanField(verbose_name='Выставлять', default=True,
                                   blank=False, null=False)
+    # Хэш полей из выгрузки АТОЛ: при импорте пишутся только изменившиеся товары
+    fingerprint = models.CharField(max_length=16, blank=True, default='',
+                                   editable=False)
+    image_hash = models.CharField(max_length=16, blank=True, default='',
+                                  editable=False)
+    image_status = models.CharField(max_length=10, choices=IMAGE_STATUSES,
+                                    default=IMAGE_READY, editable=False,
+                                    verbose_name='Обработка изображения')
+    # Варианты WebP/AVIF по ширинам для <picture>: store.images.render_variants
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Заполняет триггер в базе: store.search.install_search
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Растёт при каждом изменении товара: ключ кэша его строки и карточки
+    # в списках (templatetags/store_fragments.py). Импорт, остатки и
+    # обработка изображений увеличивают версию сами, в обход save()
+    version = models.PositiveIntegerField(default=1, editable=False)
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        # Категория до правки: её счётчики тоже пересчитываются (signals.py)
+        product.loaded_category_id = product.__dict__.get('category_id')
+        return product
+
     @property
     def quantity(self):
         return sum([self.warehouse1, self.warehouse2])
@@ -146,36 +233,49 @@ class Product(models.Model):
         return reverse('product_detail', kwargs={'pk': self.pk})
 
     def save(self, *args, **kwargs):
+        self.article_key = normalize_article(self.article)
+        self.version += 1
+        # Поля из выгрузки изменили в админке: отпечаток больше не совпадает,
+        # и следующий импорт снова запишет товар из 1С
+        if self.fingerprint not in ('', self.VANISHED, self.VANISHED_HIDDEN) \
+                and self.fingerprint != product_fingerprint(
+                    self.category_id, self.title, self.article, self.price):
+            self.fingerprint = ''
+
+        # Производные изображения строит задача process_images (signals.py),
+        # и только если загружен файл с новым содержимым
         image = self.image
-        if image:
-            img = Image.open(image)
-
-            ext = image.name.split('.')[-1]
-            filename = f'{self.category.pk}_{self.pk}.{ext}'
-
-            img.thumbnail(self.PRODUCT_BIG, Image.ANTIALIAS)
-            img.save(os.path.join(settings.MEDIA_ROOT, filename),
-                     'JPEG', quality=95)
-
-            img.thumbnail(self.PRODUCT_CARD, Image.ANTIALIAS)
-            img.save(os.path.join(settings.MEDIA_ROOT, 'card', filename),
-                     'JPEG', quality=85)
-
-            img.thumbnail(self.PRODUCT_THUMB)
-            img.save(os.path.join(settings.MEDIA_ROOT, 'thumb', filename))
+        image_hash = self.image_hash
+        if not image:
+            image_hash = ''
+        elif not image._committed:
+            image_hash = file_hash(image)
+
+        if image_hash != self.image_hash:
+            self.image_hash = image_hash
+            self.image_status = self.IMAGE_PENDING if image_hash else self.IMAGE_READY
+            self.image_variants = {}
+        if image and not image._committed:
+            reuse_stored_file(image)
 
         super().save(*args, **kwargs)
 
+    @property
+    def image_ready(self):
+        return bool(self.image) and self.image_status == self.IMAGE_READY
+
     def image_thumb(self):
-        img_src = f"/media/thumb/{self.image}" if self.image else NO_IMAGE_THUMB
         return mark_safe(
-            f'<img src="{img_src}" width="50" height="50" />'
+            f'<img src="{self.thumb_name()}" width="50" height="50" />'
         )
 
     image_thumb.short_description = 'Изображение'
 
+    def thumb_name(self):
+        return f"/media/thumb/{self.image}" if self.image_ready else NO_IMAGE_THUMB
+
     def image_name(self):
-        return f"/media/card/{self.image}" if self.image else NO_IMAGE_URL
+        return f"/media/card/{self.image}" if self.image_ready else NO_IMAGE_URL
 
 
 class Customer(models.Model):
@@ -368,3 +468,183 @@ class Article(models.Model):
 
     def __str__(self):
         return self.title
+
+
+class LeaseLost(Exception):
+    """Аренда импорта истекла и перехвачена другим процессом"""
+
+
+class ImportRunManager(models.Manager):
+
+    def acquire(self, task):
+        """
+        Захватывает аренду импорта. Если предыдущий запуск той же задачи
+        умер, не дойдя до конца, продолжает его с контрольной точки.
+        Возвращает None, если импорт уже выполняется.
+        """
+        now = timezone.now()
+        lease_expires = now + timedelta(seconds=settings.IMPORT_LEASE_TIME)
+        try:
+            with transaction.atomic():
+                run = self.select_for_update().filter(
+                    status=ImportRun.STATUS_RUNNING
+                ).first()
+                if run and run.lease_expires > now:
+                    return None
+                if run and run.task != task:
+                    run.status = ImportRun.STATUS_FAILED
+                    run.finished_at = now
+                    run.save()
+                    run = None
+
+                run = run or self.model(task=task)
+                run.lease_owner = uuid.uuid4().hex
+                run.lease_expires = lease_expires
+                run.save()
+                return run
+        except IntegrityError:
+            # Другой процесс успел создать запуск одновременно с нами
+            return None
+
+
+class ImportRun(models.Model):
+
+    class Meta:
+        verbose_name = 'Импорт из 1С'
+        verbose_name_plural = '7. Импорт из 1С'
+        ordering = ('-started_at',)
+        constraints = [
+            models.UniqueConstraint(fields=['status'],
+                                    condition=models.Q(status='running'),
+                                    name='single_running_import'),
+        ]
+
+    STATUS_RUNNING = 'running'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_FINISHED, 'Завершен'),
+        (STATUS_FAILED, 'Прерван'),
+    )
+
+    task = models.CharField(max_length=50, verbose_name='Задача')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default=STATUS_RUNNING, verbose_name='Статус')
+    started_at = models.DateTimeField(default=timezone.now,
+                                      verbose_name='Начало')
+    finished_at = models.DateTimeField(null=True, blank=True,
+                                       verbose_name='Окончание')
+    lease_owner = models.CharField(max_length=32, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # Этап, на котором остановился импорт, и прогресс внутри этапа
+    checkpoint = models.JSONField(default=dict, blank=True,
+                                  verbose_name='Контрольная точка')
+
+    # Время этапов в секундах
+    parse_time = models.FloatField(default=0, verbose_name='Разбор')
+    category_time = models.FloatField(default=0, verbose_name='Категории')
+    product_time = models.FloatField(default=0, verbose_name='Товары')
+    stock_time = models.FloatField(default=0, verbose_name='Остатки')
+    cleanup_time = models.FloatField(default=0, verbose_name='Удаление файлов')
+
+    rows_read = models.PositiveIntegerField(default=0, verbose_name='Строк')
+    rows_skipped = models.PositiveIntegerField(default=0, verbose_name='Пропущено')
+    inserted = models.PositiveIntegerField(default=0, verbose_name='Добавлено')
+    updated = models.PositiveIntegerField(default=0, verbose_name='Изменено')
+    denied = models.PositiveIntegerField(default=0,
+                                         verbose_name='Не найдено по ID')
+    # RSS процесса импорта с дочерними, замеры раз в секунду за этот запуск:
+    # ImportRun.heartbeat
+    peak_memory = models.FloatField(default=0, verbose_name='Пик памяти за запуск, МБ')
+    objects = ImportRunManager()
+
+    def __str__(self):
+        return f'{self.task} {self.started_at:%d.%m.%Y %H:%M}'
+
+    def duration(self):
+        if self.finished_at:
+            return round((self.finished_at - self.started_at).total_seconds(), 1)
+
+    duration.short_description = 'Длительность, с'
+
+    def rows_per_second(self):
+        busy = self.parse_time + self.category_time + self.product_time
+        if busy:
+            return round(self.rows_read / busy)
+
+    rows_per_second.short_description = 'Строк/с'
+
+    def _update(self, **fields):
+        updated = ImportRun.objects.filter(
+            pk=self.pk, lease_owner=self.lease_owner,
+            status=self.STATUS_RUNNING,
+        ).update(**fields)
+        if not updated:
+            raise LeaseLost(f'Import run {self.pk} lease is lost')
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def renew(self):
+        self._update(lease_expires=timezone.now() + timedelta(
+            seconds=settings.IMPORT_LEASE_TIME))
+
+    @contextmanager
+    def heartbeat(self, interval=None, sample_interval=1):
+        """
+        Продлевает аренду из отдельного потока, пока выполняется тело with:
+        разбор выгрузки и COPY в одной транзакции долго не пишут контрольных
+        точек. Поток пишет своим соединением с базой, мимо транзакции импорта.
+        Заодно раз в sample_interval секунд замеряет память для peak_memory.
+        """
+        interval = interval or settings.IMPORT_LEASE_TIME / 3
+        self.peak_rss = max(getattr(self, 'peak_rss', 0), memory_usage())
+        stop = threading.Event()
+
+        def beat():
+            renewed = time.monotonic()
+            try:
+                while not stop.wait(min(interval, sample_interval)):
+                    self.peak_rss = max(self.peak_rss, memory_usage())
+                    if time.monotonic() - renewed >= interval:
+                        self.renew()
+                        renewed = time.monotonic()
+            except LeaseLost:
+                # Импорт узнает об этом сам при следующей записи
+                pass
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def save_checkpoint(self, **checkpoint):
+        """
+        Записывает контрольную точку и продлевает аренду. Вызывается в той же
+        транзакции, что и запись пакета, поэтому точка не опережает данные.
+        """
+        self._update(checkpoint={**self.checkpoint, **checkpoint},
+                     lease_expires=timezone.now() + timedelta(
+                         seconds=settings.IMPORT_LEASE_TIME))
+
+    def record(self, **values):
+        """Прибавляет время этапов и счётчики строк"""
+        self._update(**{name: models.F(name) + round(value, 3)
+                        for name, value in values.items()})
+        self.refresh_from_db(fields=list(values))
+
+    def release(self):
+        """Импорт прерван ошибкой: следующий запуск сразу продолжит его"""
+        self._update(lease_expires=timezone.now())
+
+    def finish(self):
+        # Пик за этот запуск, а не ru_maxrss - пик за всю жизнь воркера Celery
+        peak_memory = max(getattr(self, 'peak_rss', 0), memory_usage())
+        self._update(status=self.STATUS_FINISHED, finished_at=timezone.now(),
+                     lease_owner='', peak_memory=round(peak_memory / 1024 / 1024, 1))
@@ -0,0 +1,232 @@
+import base64
+import json
+
+from django.core.paginator import Paginator, Page, InvalidPage, \
+    PageNotAnInteger, EmptyPage
+from django.db.models import Q
+
+from ecommerce import settings
+
+DEFAULT_ORDERING = ('title', 'id')
+
+
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values, number, forward = data['v'], int(data['n']), bool(data['f'])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidPage('Неверный курсор')
+    if not isinstance(values, list) or number < 1:
+        raise InvalidPage('Неверный курсор')
+    return values, number, forward
+
+
+def keyset_ordering(queryset):
+    """
+    Порядок страниц: явный order_by запроса, если он заканчивается на id,
+    иначе (title, id). Поле id делает порядок строк однозначным.
+    """
+    ordering = tuple(queryset.query.order_by)
+    if ordering and ordering[-1].lstrip('-') in ('id', 'pk'):
+        return ordering
+    return DEFAULT_ORDERING
+
+
+def after(ordering, values, forward=True):
+    """
+    Условие 'строка после (до) строки с этими значениями' для порядка
+    ordering: a >= x AND ((a > x) OR (a = x AND b > y) OR ...). Граница
+    по первому полю даёт базе начать чтение индекса прямо с курсора.
+    """
+    condition = Q(pk__in=[])
+    equal = {}
+    bound = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'gt' if field.startswith('-') != forward else 'lt'
+        if not equal:
+            bound = Q(**{f'{name}__{lookup}e': value})
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    return bound & condition
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else f'-{field}'
+                 for field in ordering)
+
+
+class PageLinks:
+    """
+    Параметры ссылок на соседние страницы для шаблонов: 'page=N' или
+    'cursor=...'. Общие для KeysetPage и NumberedPage, чтобы шаблону
+    было всё равно, какой пагинатор выдал страницу.
+    """
+
+    @property
+    def query(self):
+        return f'page={self.number}'
+
+    @property
+    def next_query(self):
+        return f'page={self.next_page_number()}'
+
+    @property
+    def previous_query(self):
+        return f'page={self.previous_page_number()}'
+
+    @property
+    def last_query(self):
+        return f'page={self.paginator.num_pages}'
+
+
+class NumberedPage(PageLinks, Page):
+    pass
+
+
+class NumberedPaginator(Paginator):
+    """Обычный Paginator со ссылками PageLinks - для списков в памяти"""
+
+    def _get_page(self, *args, **kwargs):
+        return NumberedPage(*args, **kwargs)
+
+
+class KeysetPage(PageLinks):
+    """
+    Страница списка для шаблонов, как django.core.paginator.Page. Ссылки
+    на страницы дальше KEYSET_NUMBERED_PAGES идут по курсору, ближние -
+    по номеру.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next, cursor=None):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self.cursor = cursor
+        self._has_next = has_next
+
+    def __repr__(self):
+        return f'<Page {self.number}>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def link(self, number, values, forward):
+        if number <= self.paginator.numbered_pages:
+            return f'page={number}'
+        return 'cursor=' + encode_cursor({'v': values, 'n': number, 'f': forward})
+
+    def values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.paginator.ordering]
+
+    @property
+    def query(self):
+        return f'cursor={self.cursor}' if self.cursor else f'page={self.number}'
+
+    @property
+    def next_query(self):
+        return self.link(self.number + 1, self.values(self.object_list[-1]), True)
+
+    @property
+    def previous_query(self):
+        return self.link(self.number - 1, self.values(self.object_list[0]), False)
+
+    @property
+    def last_query(self):
+        # Пустой курсор назад - строки с конца списка
+        return self.link(self.paginator.num_pages, [], False)
+
+
+class KeysetPaginator:
+    """
+    Постраничный вывод без OFFSET: страница по курсору выбирается условием
+    по (title, id) от последней строки предыдущей, по индексу, и стоит
+    одинаково на первой и на пятисотой странице. Номер страницы (?page=)
+    читается через OFFSET, шаблоны дают такие ссылки только на первые
+    страницы. Общее число строк (COUNT) считается, только если его
+    спросят - или передаётся готовым в count.
+    """
+
+    def __init__(self, queryset, per_page, count=None, numbered_pages=None):
+        self.ordering = keyset_ordering(queryset)
+        self.queryset = queryset.order_by(*self.ordering)
+        self.per_page = int(per_page)
+        self._count = count
+        self.numbered_pages = settings.KEYSET_NUMBERED_PAGES \
+            if numbered_pages is None else numbered_pages
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count = self.queryset.count()
+        return self._count
+
+    @property
+    def num_pages(self):
+        return Paginator(range(self.count), self.per_page).num_pages
+
+    def page(self, number=None, cursor=None):
+        if cursor:
+            return self.cursor_page(cursor, *decode_cursor(cursor))
+
+        try:
+            number = int(number or 1)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('Номер страницы - не число')
+        if number < 1:
+            raise EmptyPage('Номер страницы меньше 1')
+        offset = (number - 1) * self.per_page
+        rows = list(self.queryset[offset:offset + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('Страница пуста')
+        return KeysetPage(rows[:self.per_page], number, self,
+                          len(rows) > self.per_page)
+
+    def cursor_page(self, cursor, values, number, forward):
+        if forward:
+            if len(values) != len(self.ordering):
+                raise InvalidPage('Неверный курсор')
+            rows = list(self.queryset.filter(after(self.ordering, values))
+                        [:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page], number, self,
+                              len(rows) > self.per_page, cursor)
+
+        # Назад: строки до курсора в обратном порядке, затем разворот.
+        # Без значений - последняя страница с неполным остатком строк
+        queryset, size, has_next = self.queryset, self.per_page, True
+        if values:
+            if len(values) != len(self.ordering):
+                raise InvalidPage('Неверный курсор')
+            queryset = queryset.filter(after(self.ordering, values, False))
+        else:
+            size, has_next = self.count - (number - 1) * self.per_page, False
+            if size <= 0:
+                raise EmptyPage('Страница пуста')
+        rows = list(queryset.order_by(*reverse_ordering(self.ordering))[:size])
+        rows.reverse()
+        return KeysetPage(rows, number, self, has_next, cursor)
@@ -0,0 +1,159 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, \
+    TrigramSimilarity
+from django.db import connection, DatabaseError, transaction
+from django.db.models import F, Q, Value, FloatField
+from django.db.models.functions import Cast
+
+from ecommerce import settings
+from store.models import Product
+from store.search_index import index_search, get_index
+from store.utils import normalize_article
+
+# Поисковый вектор товара поддерживается триггером в базе, поэтому он
+# верен после любого способа записи: ORM, bulk_create, COPY при импорте.
+# Наименование - с русской морфологией, артикул - без морфологии, частями
+# и целиком без разделителей. Дефисы заменяются пробелами, иначе парсер
+# читает '-29' в 'ВА47-29' как отрицательное число
+SEARCH_TRIGGER_SQL = f"""
+    CREATE OR REPLACE FUNCTION store_product_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('russian', regexp_replace(
+                coalesce(NEW.title, ''), '[^[:alnum:]]+', ' ', 'g')), 'A') ||
+            setweight(to_tsvector('simple', regexp_replace(
+                coalesce(NEW.article, ''), '[^[:alnum:]]+', ' ', 'g')), 'B') ||
+            setweight(to_tsvector('simple', regexp_replace(
+                coalesce(NEW.article, ''), '[^[:alnum:]]+', '', 'g')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS store_product_search_vector ON {Product._meta.db_table};
+    CREATE TRIGGER store_product_search_vector
+        BEFORE INSERT OR UPDATE OF title, article, search_vector
+        ON {Product._meta.db_table}
+        FOR EACH ROW EXECUTE FUNCTION store_product_search_vector();
+
+    UPDATE {Product._meta.db_table} SET search_vector = NULL
+     WHERE search_vector IS NULL;
+"""
+
+# Нечёткий поиск и подстрока в артикуле по индексу: нужен pg_trgm.
+# article__icontains - это UPPER("article"::text) LIKE UPPER(...), индекс
+# по самому article для него не годится, нужен по upper(article)
+TRIGRAM_SQL = f"""
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS store_product_title_trgm
+        ON {Product._meta.db_table} USING gin (title gin_trgm_ops);
+    DROP INDEX IF EXISTS store_product_article_trgm;
+    CREATE INDEX IF NOT EXISTS store_product_article_upper_trgm
+        ON {Product._meta.db_table} USING gin (upper(article) gin_trgm_ops);
+"""
+
+_trigram = None
+ARTICLE_KEY_BATCH = 5000
+
+
+def install_search():
+    """Триггер поискового вектора и индексы pg_trgm, вызывается после migrate"""
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_TRIGGER_SQL)
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(TRIGRAM_SQL)
+    except DatabaseError as e:
+        print(f'pg_trgm is not available, fuzzy search is off: {e}')
+
+
+def fill_article_keys():
+    """Ключи артикулов товаров, записанных до появления поля article_key"""
+    filled, last = 0, 0
+    while True:
+        products = list(Product.objects.filter(article_key='', id__gt=last)
+                        .exclude(article='').order_by('id')
+                        .only('id', 'article')[:ARTICLE_KEY_BATCH])
+        if not products:
+            return filled
+        for product in products:
+            product.article_key = normalize_article(product.article)
+        Product.objects.bulk_update(products, ['article_key'])
+        filled += len(products)
+        last = products[-1].id
+
+
+def trigram_available():
+    global _trigram
+    if _trigram is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram = cursor.fetchone() is not None
+    return _trigram
+
+
+def prefix_query(query):
+    """
+    tsquery по всем словам запроса, последнее слово - как префикс: поиск
+    при наборе находит 'автомат' по 'авто'. None, если слов нет.
+    """
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    raw = ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+    return SearchQuery(raw, config='russian', search_type='raw')
+
+
+def icontains_search(query):
+    """Прежний поиск: подстрока в наименовании или артикуле"""
+    return Product.objects.filter(
+        Q(title__icontains=query) | Q(article__icontains=query), display=True
+    )
+
+
+def postgres_search(query):
+    """
+    Полнотекстовый поиск по GIN-индексу search_vector, с pg_trgm - ещё
+    нечёткое совпадение наименования и подстрока в артикуле. Сначала
+    самые релевантные.
+    """
+    tsquery = prefix_query(query)
+    condition = Q(pk__in=[])
+    rank = Value(0, output_field=FloatField())
+    if tsquery is not None:
+        condition |= Q(search_vector=tsquery)
+        rank = SearchRank(F('search_vector'), tsquery)
+    if trigram_available():
+        condition |= Q(title__trigram_similar=query) | Q(article__icontains=query)
+        rank = rank + TrigramSimilarity('title', query)
+    # float8: значение ранга из курсора страницы должно совпасть точно
+    return Product.objects.filter(condition, display=True) \
+        .annotate(rank=Cast(rank, FloatField())).order_by('-rank', 'title', 'id')
+
+
+def article_search(query):
+    """Товары, артикул которых совпадает с запросом после нормализации"""
+    key = normalize_article(query or '')
+    if not key:
+        return Product.objects.none()
+    return Product.objects.filter(article_key=key, display=True).order_by('title', 'id')
+
+
+def file_index_search(query):
+    """Поиск по индексу в файле; пока индекс не построен - postgres_search"""
+    if get_index() is None:
+        return postgres_search(query)
+    return index_search(query)
+
+
+SEARCH_BACKENDS = {
+    'icontains': icontains_search,
+    'postgres': postgres_search,
+    'index': file_index_search,
+}
+
+
+def search_products(query):
+    if not query:
+        return Product.objects.none()
+    return SEARCH_BACKENDS[settings.SEARCH_BACKEND](query)
@@ -0,0 +1,242 @@
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from ecommerce import settings
+from store.models import Product
+
+# Файл индекса: заголовок и разделы из массивов uint32 и строк UTF-8.
+# Товары пронумерованы в порядке (title, id), в списках вхождений - номера
+# товаров по возрастанию, поэтому результат сразу отсортирован по наименованию
+MAGIC = b'PRODIDX1'
+SECTIONS = (
+    'ids',                                 # номер товара -> Product.id
+    'article_offsets', 'articles',         # артикул без разделителей
+    'term_offsets', 'terms',               # слова наименований, по алфавиту
+    'term_posting_offsets', 'term_postings',
+    'gram_offsets', 'grams',               # триграммы артикулов, по алфавиту
+    'gram_posting_offsets', 'gram_postings',
+)
+HEADER = struct.Struct(f'<8s{len(SECTIONS) * 2}Q')
+GRAM = 3
+
+
+def words(text):
+    return re.findall(r'\w+', text.lower().replace('ё', 'е'))
+
+
+def compact(article):
+    return ''.join(words(article))
+
+
+def grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def build_index(file_path=None):
+    """
+    Строит индекс по выставленным товарам и атомарно подменяет файл:
+    рабочие процессы сайта увидят новый индекс при следующем запросе.
+    Возвращает число товаров в индексе.
+    """
+    file_path = file_path or settings.SEARCH_INDEX_FILE
+    ids = array('I')
+    articles = []
+    terms = defaultdict(lambda: array('I'))
+    article_grams = defaultdict(lambda: array('I'))
+
+    products = Product.objects.filter(display=True).order_by('title', 'id') \
+        .values_list('id', 'title', 'article')
+    for doc, (id, title, article) in enumerate(products.iterator()):
+        ids.append(id)
+        key = compact(article)
+        articles.append(key)
+        for term in set(words(title)):
+            terms[term].append(doc)
+        for gram in grams(key):
+            article_grams[gram].append(doc)
+
+    sections = {'ids': ids.tobytes()}
+    sections['article_offsets'], sections['articles'] = pack_strings(articles)
+    for name, postings in (('term', terms), ('gram', article_grams)):
+        keys = sorted(postings)
+        sections[f'{name}_offsets'], sections[f'{name}s'] = pack_strings(keys)
+        offsets, data = array('I', [0]), array('I')
+        for key in keys:
+            data.extend(postings[key])
+            offsets.append(len(data))
+        sections[f'{name}_posting_offsets'] = offsets.tobytes()
+        sections[f'{name}_postings'] = data.tobytes()
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(f'{file_path}.tmp', 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        layout = []
+        for name in SECTIONS:
+            layout += [f.tell(), len(sections[name])]
+            f.write(sections[name])
+            f.write(b'\0' * (-f.tell() % 4))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, *layout))
+    os.replace(f'{file_path}.tmp', file_path)
+    return len(ids)
+
+
+def pack_strings(strings):
+    offsets, blob = array('I', [0]), bytearray()
+    for string in strings:
+        blob += string.encode()
+        offsets.append(len(blob))
+    return offsets.tobytes(), bytes(blob)
+
+
+class Strings:
+    """Последовательность строк в mmap: для bisect без загрузки в память"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+
+class Postings:
+    """Слова или триграммы со списками вхождений"""
+
+    def __init__(self, keys, offsets, postings):
+        self.keys = keys
+        self.offsets = offsets
+        self.postings = postings
+
+    def docs(self, i):
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def get(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return set(self.docs(i))
+        return set()
+
+    def prefix(self, key):
+        """Все вхождения слов, начинающихся с key"""
+        docs = set()
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i].startswith(key):
+            docs.update(self.docs(i))
+            i += 1
+        return docs
+
+
+class SearchIndex:
+    """Индекс в файле, отображённом в память: общий для всех процессов"""
+
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            self.stamp = os.fstat(f.fileno()).st_mtime_ns
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, *layout = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{file_path}: not a search index')
+
+        view = memoryview(self.mmap)
+        sections = {}
+        for name, offset, size in zip(SECTIONS, layout[::2], layout[1::2]):
+            section = view[offset:offset + size]
+            sections[name] = section if name in ('articles', 'terms', 'grams') \
+                else section.cast('I')
+
+        self.ids = sections['ids']
+        self.articles = Strings(sections['article_offsets'], sections['articles'])
+        self.terms = Postings(Strings(sections['term_offsets'], sections['terms']),
+                              sections['term_posting_offsets'],
+                              sections['term_postings'])
+        self.grams = Postings(Strings(sections['gram_offsets'], sections['grams']),
+                              sections['gram_posting_offsets'],
+                              sections['gram_postings'])
+
+    def search(self, query):
+        """
+        Product.id в порядке наименования. Все слова запроса должны быть в
+        наименовании, последнее - как начало слова; или запрос целиком -
+        подстрока артикула.
+        """
+        query_words = words(query)
+        if not query_words:
+            return []
+
+        docs = self.terms.prefix(query_words[-1])
+        for word in query_words[:-1]:
+            if not docs:
+                break
+            docs &= self.terms.get(word)
+
+        key = compact(query)
+        if len(key) >= GRAM:
+            candidates = None
+            for gram in grams(key):
+                found = self.grams.get(gram)
+                candidates = found if candidates is None else candidates & found
+                if not candidates:
+                    break
+            docs |= {doc for doc in candidates if key in self.articles[doc]}
+
+        return [self.ids[doc] for doc in sorted(docs)]
+
+
+_index = None
+
+
+def get_index():
+    """
+    Индекс рабочего процесса; перечитывается, если файл перестроен.
+    None, пока файла нет.
+    """
+    global _index
+    try:
+        stamp = os.stat(settings.SEARCH_INDEX_FILE).st_mtime_ns
+    except FileNotFoundError:
+        _index = None
+        return None
+    if _index is None or _index.stamp != stamp:
+        _index = SearchIndex(settings.SEARCH_INDEX_FILE)
+    return _index
+
+
+class SearchResults:
+    """
+    Результаты для пагинатора ListView: число - из индекса, из базы
+    читается только показываемая страница. Снятые с показа после
+    построения индекса на ней пропускаются
+    """
+    model = Product
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self):
+        return len(self.ids)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        ids = self.ids[key]
+        products = Product.objects.filter(display=True).in_bulk(ids)
+        return [products[id] for id in ids if id in products]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def index_search(query):
+    return SearchResults(get_index().search(query))
@@ -1,7 +1,16 @@
-from django.db.models.signals import post_save
+import os
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, post_migrate
 from django.dispatch import receiver
-from store.models import Order
-from store.tasks import send_order_is_ready_email
+
+from ecommerce import settings
+from store.cache import bump_version, FRAGMENTS, ARTICLES
+from store.models import Order, Product, Group, Category, Article
+from store.importers import refresh_counters, is_importing
+from store.search import install_search, fill_article_keys
+from store.search_index import build_index
+from store.tasks import send_order_is_ready_email, process_images
 
 
 @receiver(post_save, sender=Order)
@@ -11,3 +20,60 @@ def count_subcategory_items(sender, instance, **kwargs):
             'order': instance,
         }
         send_order_is_ready_email(instance)
+
+
+@receiver(post_save, sender=Product)
+def process_product_image(sender, instance, **kwargs):
+    # Сохранение в админке не ждёт обработки изображения
+    if instance.image_status == Product.IMAGE_PENDING:
+        transaction.on_commit(lambda: process_images.delay([instance.pk]))
+
+
+@receiver(post_migrate)
+def install_product_search(sender, **kwargs):
+    # Триггер поискового вектора и индексы pg_trgm - вне моделей
+    if sender.name == 'store':
+        install_search()
+        fill_article_keys()
+        # Поиск по индексу в файле: до первого импорта индекса ещё нет
+        if settings.SEARCH_BACKEND == 'index' \
+                and not os.path.exists(settings.SEARCH_INDEX_FILE):
+            build_index()
+        refresh_counters()
+        # Обновление сайта: строки товаров из кэша могли быть по старым шаблонам
+        bump_version(FRAGMENTS)
+
+
+@receiver([post_save, post_delete], sender=Group)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+def reset_page_cache(sender, **kwargs):
+    # Правка каталога в админке: страницы из кэша устарели. Построчный
+    # импорт меняет версию сам, один раз в конце (tasks.update_counters)
+    if is_importing():
+        return
+    transaction.on_commit(bump_version)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def refresh_product_counters(sender, instance, **kwargs):
+    # Правка товара в админке: счётчики его категорий и их групп. Импорт
+    # пересчитывает весь каталог сам, один раз в конце (tasks.update_counters)
+    if is_importing():
+        return
+    ids = {instance.category_id, getattr(instance, 'loaded_category_id', None)}
+    transaction.on_commit(lambda: refresh_counters(ids - {None}))
+
+
+@receiver([post_save, post_delete], sender=Category)
+def refresh_category_counters(sender, instance, **kwargs):
+    # Категорию перенесли в другую группу или удалили
+    if is_importing():
+        return
+    transaction.on_commit(lambda: refresh_counters([instance.pk]))
+
+
+@receiver([post_save, post_delete], sender=Article)
+def reset_article_menu(sender, **kwargs):
+    # Меню статей есть на всех страницах: ключи страниц тоже с версией статей
+    transaction.on_commit(lambda: bump_version(ARTICLES))
@@ -1,125 +1,279 @@
+import json
 import os
-import re
 import time
 from ecommerce.settings import BASE_DIR, SITE_URL
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
-from store.models import Category, Product
-from lxml import etree as ET
+from ecommerce import settings
+from store.models import Category, Product, ImportRun, LeaseLost
+from store.importers import bulk_load_atol, copy_load_atol, iter_stock, \
+    load_stock, pipelined_load, start_phase, refresh_counters, parse_atol_row, \
+    importing, CategoryRow
+from store.images import process_product_images, collect_garbage, evict_resized
+from store.search_index import build_index
+from store.cache import bump_version, CATALOG, STOCK
 import csv
 from ecommerce.celery import celery_app
 
 
-def file_older_than(filepath, age):
-    return time.time() - os.path.getmtime(filepath) > age
+# Путь к файлу от корня проекта
+ATOL_FILE = 'imported/export_atol.txt'
+XML_FILE = 'imported/export.xml'
+CHANGED_FILE = os.path.join(BASE_DIR, 'imported/changed.json')
 
 
-def atol_import(file_name):
+def remove_imported(file_path, run=None):
+    started = time.monotonic()
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        print(f'No file to process ({file_path})')
+    if run:
+        run.record(cleanup_time=time.monotonic() - started)
+
+
+def record_stats(run, stats):
+    """Итоги загрузки выгрузки АТОЛ в запись ImportRun"""
+    if run is None:
+        return
+    timings = stats.get('timings', {})
+    categories = stats.get('categories', {})
+    products = stats.get('products', {})
+    run.record(
+        parse_time=timings.get('parse', 0),
+        category_time=timings.get('categories', 0),
+        product_time=timings.get('products', 0),
+        stock_time=timings.get('stock', 0),
+        rows_read=stats['rows'],
+        rows_skipped=stats['skipped'] + products.get('skipped', 0),
+        inserted=categories.get('inserted', 0) + products.get('inserted', 0),
+        updated=categories.get('updated', 0) + products.get('updated', 0),
+        denied=stats.get('denied', 0),
+    )
+
+
+def print_rate(file_name, rows, elapsed):
+    rate = rows / elapsed if elapsed else 0
+    print(f'{file_name}: {rows} rows in {elapsed:.1f}s ({rate:.0f} rows/s)')
+
+
+def atol_import(file_name, run=None):
     file_path = os.path.join(BASE_DIR, file_name)
 
     if os.path.exists(file_path):
-        with open(file_path, 'r', encoding="cp1251", errors='ignore') as f:
+        started = time.monotonic()
+        rows = skipped = inserted = updated = 0
+        with open(file_path, 'r', encoding="cp1251", errors='ignore') as f, importing():
             reader = csv.reader(f, delimiter=';')
             print(f'{file_name} import started')
 
             for row in reader:
-                if len(row) < 25:  # строка содержит меньше 25  полей - игнорируем
-                    continue
+                rows += 1
+                if run and rows % settings.IMPORT_BATCH_SIZE == 0:
+                    run.renew()
                 try:
-                    key = row[0]
-                    article = row[25]
-                    price = row[4]
-                    name = row[2]
-                    parent = row[15]
-
-                    # Удаляем круглые скобки в начале Наименования
-                    name = re.sub(r'^\([^)]+\)\s*', '', name)
-
-                    if len(name) < 2:  # Длина наименования меньше 2 - игнорируем
+                    record = parse_atol_row(row)
+                    if record is None:
+                        skipped += 1
                         continue
-                    if len(article) == 0 and len(price) == 0:
-                        name = re.sub(r'\([^)]+\)\.*', '', name)
-                        category, created = Category.objects.get_or_create(id=key)
-                        category.name = name
+                    # Отпечатки - как у пакетной загрузки: при смене способа
+                    # импорта следующий не перепишет весь каталог
+                    if isinstance(record, CategoryRow):
+                        category, created = Category.objects.get_or_create(id=record.id)
+                        category.name = record.name
+                        category.fingerprint = record.fingerprint
                         category.save()
                     else:
-                        category = Category.objects.get(id=parent)
-                        product, created = Product.objects.get_or_create(id=key, category=category)
-                        product.title = name
-                        product.article = article
-                        product.price = float(price)
+                        category = Category.objects.get(id=record.category_id)
+                        product, created = Product.objects.get_or_create(id=record.id, category=category)
+                        product.title = record.title
+                        product.article = record.article
+                        product.price = record.price
+                        product.fingerprint = record.fingerprint
                         product.save()
                         # print(f'OK\t{product.id}, {product.title}')
+                    # Построчно пишется каждая строка: уже бывшие - обновлены
+                    if created:
+                        inserted += 1
+                    else:
+                        updated += 1
 
                 except Exception as e:
                     print(f'{e}\n\t{row}')
-        try:
-            os.remove(file_path)
-        except FileExistsError:
-            print(f'No file to process ({file_path})')
+                    skipped += 1
+        elapsed = time.monotonic() - started
+        print_rate(file_name, rows, elapsed)
+        # Построчный импорт не разделяет разбор и запись по этапам
+        record_stats(run, {'rows': rows, 'skipped': skipped,
+                           'products': {'inserted': inserted, 'updated': updated},
+                           'timings': {'products': elapsed}})
+        remove_imported(file_path, run)
 
 
-def xml_import(file_name):
+def save_changed_ids(changed):
+    """Коды изменившихся записей для выборочного сброса кэшей"""
+    with open(CHANGED_FILE, 'w') as f:
+        json.dump(changed, f)
+
+
+def bulk_atol_import(file_name, loader=bulk_load_atol, run=None):
     file_path = os.path.join(BASE_DIR, file_name)
+
     if os.path.exists(file_path):
-        parser = ET.XMLParser(encoding='cp1251')
-        root = ET.parse(file_path, parser).getroot()
+        start_phase(run, 'atol', file_path)
+        with open(file_path, 'r', encoding="cp1251", errors='ignore') as f:
+            print(f'{file_name} {loader.__name__} started')
+            stats = loader(f, run=run)
 
-        denied = 0
+        print(f"Категории: {stats['categories']}, товары: {stats['products']}")
+        save_changed_ids(stats['changed'])
+        print_rate(file_name, stats['rows'], stats['elapsed'])
+        record_stats(run, stats)
+        remove_imported(file_path, run)
 
+
+def copy_atol_import(file_name, run=None):
+    bulk_atol_import(file_name, loader=copy_load_atol, run=run)
+
+
+# Способы загрузки выгрузки АТОЛ, выбираются settings.IMPORT_BACKEND
+ATOL_BACKENDS = {
+    'orm': atol_import,
+    'bulk': bulk_atol_import,
+    'copy': copy_atol_import,
+}
+
+
+def xml_import(file_name, run=None):
+    file_path = os.path.join(BASE_DIR, file_name)
+    if os.path.exists(file_path):
+        start_phase(run, 'stock', file_path)
         print(f'{file_name} import started')
-        for node in root.findall('nom'):
-            name = node.get('name')
-            id = node.get('id')
-            # article = node.get('art')
-            whs = []
-            for sub in node.findall('whs/scl'):
-                whs.append(sub.get("count"))
-
-            try:
-                product = Product.objects.get(id=id)
-                product.warehouse1 = whs[0]
-                product.warehouse2 = whs[1]
-                product.save()
-                # print(f'OK\tid: {id}, name: {name}, whs: {whs}')
-            except Exception as e:
-                denied += 1
-                # Товары, которых не оказалось в alol файле (без категорий) отбрасываются
-                # print(f'{e}\n\t{id} {name}: {whs}')
+        started = time.monotonic()
+        # Товары, которых не оказалось в alol файле (без категорий) отбрасываются
+        denied = load_stock(iter_stock(file_path), run=run)
 
         if denied:
             print('Не найдено по ID:', denied)
-        try:
-            os.remove(file_path)
-        except FileExistsError:
-            print(f'No file to process ({file_path})')
+        if run:
+            run.record(stock_time=time.monotonic() - started, denied=denied)
+        remove_imported(file_path, run)
 
 
-@celery_app.task
-def product_import():
-    """TODO: записывать результат в файл"""
-    LOCK_TIME = 60 * 120
-    lock_file = os.path.join(BASE_DIR, 'imported/.importlock')
+def pipelined_import(atol_name, xml_name, run=None, workers=None):
+    atol_path = os.path.join(BASE_DIR, atol_name) if atol_name else None
+    xml_path = os.path.join(BASE_DIR, xml_name)
+
+    print(f'{atol_name}, {xml_name} pipelined import started')
+    stats = pipelined_load(atol_path, xml_path, workers=workers, run=run)
+
+    if 'changed' in stats:
+        print(f"Категории: {stats['categories']}, товары: {stats['products']}")
+        save_changed_ids(stats['changed'])
+    if stats.get('denied'):
+        print('Не найдено по ID:', stats['denied'])
+    print_rate(atol_name or xml_name, stats['rows'], stats['elapsed'])
+    record_stats(run, stats)
+
+    for file_path in filter(None, (atol_path, xml_path)):
+        remove_imported(file_path, run)
+
+
+def run_import(task, steps, files):
     """
-    Файл блокироваки процесса. Если процесс был запущен более чем 2 часа
-    назад, значит он умер. Удалить файл блокировки
+    Выполняет импорт под арендой ImportRun. Аренда продлевается с каждым
+    записанным пакетом и, пока процесс жив, из потока ImportRun.heartbeat -
+    в том числе во время разбора и COPY. Если процесс умер, следующий
+    запуск через IMPORT_LEASE_TIME продолжит импорт с контрольной точки.
+    Возвращает False, если аренду держит другой импорт.
     """
-    if os.path.exists(lock_file):
-        if file_older_than(lock_file, LOCK_TIME):
-            os.remove(lock_file)
-        else:
-            print('Import is still being processed...')
-            return
-
-    open(lock_file, 'a').close()
-
-    # Путь к файлу от корня проекта
-    atol_import('imported/export_atol.txt')
-    xml_import('imported/export.xml')
+    if not any(os.path.exists(os.path.join(BASE_DIR, name)) for name in files):
+        print(f'No file to process ({", ".join(files)})')
+        return True
+
+    run = ImportRun.objects.acquire(task)
+    if run is None:
+        print('Import is still being processed...')
+        return False
+
     try:
-        os.remove(lock_file)
-    except FileExistsError:
-        print(f'No lock file: ({lock_file})')
+        with run.heartbeat():
+            steps(run)
+        run.finish()
+    except LeaseLost as e:
+        print(e)
+    except Exception:
+        run.release()
+        raise
+    return True
+
+
+def update_counters(namespace=CATALOG):
+    started = time.monotonic()
+    print_rate('counters', refresh_counters(), time.monotonic() - started)
+    # Каталог или остатки изменились: страницы из кэша строятся заново
+    bump_version(namespace)
+
+
+def product_import_steps(run, workers=1):
+    # Этап остатков в контрольной точке - выгрузка АТОЛ уже загружена
+    atol_file = None if run.checkpoint.get('phase') == 'stock' else ATOL_FILE
+
+    # Пул процессов - только вне Celery: manage.py product_import --workers
+    if workers > 1:
+        pipelined_import(atol_file, XML_FILE, run, workers)
+    else:
+        if atol_file:
+            ATOL_BACKENDS[settings.IMPORT_BACKEND](atol_file, run=run)
+        xml_import(XML_FILE, run)
+
+    update_counters()
+    if settings.SEARCH_BACKEND == 'index':
+        started = time.monotonic()
+        print_rate('search index', build_index(), time.monotonic() - started)
+
+
+@celery_app.task(bind=True, max_retries=settings.IMPORT_RETRIES)
+def product_import(self):
+    """Импорт каталога и остатков из 1С, итоги - в ImportRun"""
+    if not run_import('product_import', product_import_steps, [ATOL_FILE, XML_FILE]):
+        # Идёт другой импорт: новая выгрузка загрузится после него, а не
+        # с очередным запуском по расписанию
+        raise self.retry(countdown=settings.IMPORT_RETRY_COUNTDOWN)
+
+
+@celery_app.task(bind=True, max_retries=settings.IMPORT_RETRIES)
+def stock_import(self):
+    """Только остатки по складам: можно запускать по расписанию каждые несколько минут"""
+    def steps(run):
+        xml_import(XML_FILE, run)
+        # Остатки меняют число товаров в наличии
+        update_counters(STOCK)
+
+    if not run_import('stock_import', steps, [XML_FILE]):
+        raise self.retry(countdown=settings.IMPORT_RETRY_COUNTDOWN)
+
+
+@celery_app.task
+def process_images(ids):
+    """Производные изображения товаров: большое, карточка, миниатюра"""
+    started = time.monotonic()
+    count = process_product_images(ids)
+    bump_version()
+    print(f'{count} images in {time.monotonic() - started:.1f}s')
+    collect_media_garbage.delay()
+
+
+@celery_app.task
+def collect_media_garbage():
+    """Удаляет файлы изображений, на которые больше никто не ссылается"""
+    print(f'{collect_garbage()} unused media files removed')
+
+
+@celery_app.task
+def evict_resized_images():
+    """Держит кэш уменьшенных копий /media/r/ в пределах IMAGE_RESIZE_CACHE_SIZE"""
+    print(f'{evict_resized()} resized images evicted')
 
 
 def send_confirmation_email(email, code):
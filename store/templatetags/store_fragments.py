@@ -0,0 +1,29 @@
+from django import template
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from ecommerce import settings
+from store.cache import get_version, FRAGMENTS
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_fragments(products, template_name):
+    """
+    Строки или карточки товаров списка из кэша: ключ - шаблон, id и версия
+    товара, поэтому изменённый товар получает новую запись. Вся страница -
+    один get_many, шаблон рисуется только для товаров, которых в кэше нет.
+    """
+    prefix = f'fragment:{get_version(FRAGMENTS)}:{template_name}'
+    products = {f'{prefix}:{product.id}:{product.version}': product
+                for product in products}
+    fragments = cache.get_many(products)
+
+    missing = {key: render_to_string(template_name, {'product': product})
+               for key, product in products.items() if key not in fragments}
+    if missing:
+        cache.set_many(missing, settings.FRAGMENT_CACHE_TIMEOUT)
+        fragments.update(missing)
+    return mark_safe(''.join(fragments[key] for key in products))
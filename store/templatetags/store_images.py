@@ -0,0 +1,38 @@
+from django import template
+from django.forms.utils import flatatt
+from django.utils.html import format_html, format_html_join
+
+from ecommerce import settings
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_picture(product, sizes='100vw', **attrs):
+    """
+    <picture> с вариантами WebP/AVIF из манифеста товара (image_variants),
+    без обращения к диску. Пока вариантов нет - просто <img> с карточкой
+    или заглушкой. Остальные аргументы - атрибуты <img>, css_class - class.
+    """
+    attrs.setdefault('alt', product.title)
+    attrs.setdefault('loading', 'lazy')
+    if 'css_class' in attrs:
+        attrs['class'] = attrs.pop('css_class')
+
+    manifest = product.image_variants if product.image_ready else {}
+    if manifest:
+        attrs.setdefault('width', manifest['width'])
+        attrs.setdefault('height', manifest['height'])
+    img = format_html('<img src="{}"{}>', product.image_name(), flatatt(attrs))
+
+    if not manifest.get('sources'):
+        return img
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((source['type'],
+          ', '.join(f'{settings.MEDIA_URL}{name} {width}w'
+                    for width, name in source['srcset']),
+          sizes)
+         for source in manifest['sources'])
+    )
+    return format_html('<picture>{}{}</picture>', sources, img)
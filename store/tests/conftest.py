@@ -0,0 +1,57 @@
+import multiprocessing
+
+import pytest
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+
+def pytest_configure(config):
+    # Два уровня, как на сайте, но общий уровень - в памяти вместо Redis.
+    # До создания тестовой базы: post_migrate уже меняет версии в кэше
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'store.cache_backends.TwoTierCache',
+            'LOCATION': settings.SHARED_CACHE,
+            'OPTIONS': {'MAX_ENTRIES': 100, 'L1_TIMEOUT': 5},
+        },
+        settings.SHARED_CACHE: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@pytest.fixture
+def daemon_process():
+    """
+    Вызов в процессе-демоне, как в воркере Celery (prefork): такой процесс
+    не может запускать свои процессы. Возвращает repr исключения или None.
+    Нужна база с transaction=True - данные теста видны другому процессу
+    """
+    context = multiprocessing.get_context('fork')
+
+    def call(func, *args):
+        errors = context.Queue()
+
+        def target():
+            try:
+                func(*args)
+                errors.put(None)
+            except BaseException as e:
+                errors.put(repr(e))
+            finally:
+                connections.close_all()
+
+        connections.close_all()
+        process = context.Process(target=target, daemon=True)
+        process.start()
+        error = errors.get(timeout=60)
+        process.join()
+        return error
+
+    return call
@@ -0,0 +1,304 @@
+import threading
+import time
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.db.models import F
+from django.test import RequestFactory
+
+from ecommerce import settings as project_settings
+from store.cache import get_version, bump_version, get_or_refresh, page_key, ARTICLES, STOCK
+from store.cache_backends import MemoryLevel, RedisCache
+from store.importers import load_stock
+from store.mixins import article_menu
+from store.models import Group, Category, Product, Order, Customer, Article
+from store.templatetags.store_fragments import product_fragments
+
+
+class TestTwoTierCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, settings):
+        self.shared = caches[settings.SHARED_CACHE]
+
+    def test_memory_level_in_front_of_shared(self):
+        cache.set('key', 'value')
+        assert self.shared.get('key') == 'value'
+        # Другой процесс переписал ключ: память процесса отвечает прежним
+        self.shared.set('key', 'other')
+        assert cache.get('key') == 'value'
+        cache.delete('key')
+        assert cache.get('key') is None and self.shared.get('key') is None
+
+    def test_memory_level_is_bounded(self):
+        cache.set_many({f'key{n}': n for n in range(150)})
+        self.shared.clear()
+        found = cache.get_many([f'key{n}' for n in range(150)])
+        # В памяти последние MAX_ENTRIES записей
+        assert sorted(found.values()) == list(range(50, 150))
+
+    def test_get_many_reads_shared_level(self):
+        self.shared.set_many({'a': 1, 'b': 2})
+        assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+        self.shared.clear()
+        assert cache.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+
+    def test_versions_bypass_memory_level(self):
+        version = get_version(STOCK)
+        assert get_version(STOCK) == version
+        # Смена версии в другом процессе видна сразу
+        self.shared.set(f'version:{STOCK}', version + 1, timeout=None)
+        assert get_version(STOCK) == version + 1
+
+
+class TestMemoryLevel:
+
+    def test_bounded_by_bytes(self):
+        level = MemoryLevel(max_entries=100, max_bytes=250, max_item_bytes=200)
+        for n in range(5):
+            level.set(f'key{n}', bytes(100), 5)
+        assert level.size == 200
+        assert [level.get(f'key{n}') is not None for n in range(5)] == \
+            [False, False, False, True, True]
+        # Целая страница - только в общем уровне
+        level.set('page', bytes(201), 5)
+        assert level.get('page') is None and level.size == 200
+        level.set('key4', b'x', 5)
+        assert level.size == 101
+
+    def test_expired_entries_are_purged_on_set(self, monkeypatch):
+        level = MemoryLevel(max_entries=100, max_bytes=1000, max_item_bytes=1000)
+        level.set('old', bytes(100), 1)
+        now = time.monotonic()
+        monkeypatch.setattr(time, 'monotonic', lambda: now + 2)
+        level.set('new', bytes(100), 5)
+        assert list(level.entries) == ['new'] and level.size == 100
+
+
+class TestRedisCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        fakeredis = pytest.importorskip('fakeredis')
+        self.cache = RedisCache('redis://localhost:6379/1', {'TIMEOUT': 60})
+        self.cache._client = fakeredis.FakeRedis()
+
+    def test_values(self):
+        self.cache.set('page', {'content': 'Кабель'})
+        self.cache.set('count', 5)
+        assert self.cache.get('page') == {'content': 'Кабель'}
+        assert self.cache.get_many(['page', 'count', 'none']) == \
+            {'page': {'content': 'Кабель'}, 'count': 5}
+        assert self.cache.get('none', 'default') == 'default'
+        self.cache.delete_many(['page', 'count'])
+        assert not self.cache.has_key('page')
+
+    def test_add_and_timeouts(self):
+        assert self.cache.add('lock', 'a', 10)
+        assert not self.cache.add('lock', 'b', 10)
+        assert self.cache.get('lock') == 'a'
+        assert 0 < self.cache._client.ttl(self.cache.make_key('lock')) <= 10
+        self.cache.set('lock', 'c', 0)
+        assert not self.cache.has_key('lock')
+        self.cache.set('version', 1, None)
+        assert self.cache._client.ttl(self.cache.make_key('version')) == -1
+
+    def test_incr(self):
+        self.cache.set('version', 1, 30)
+        assert self.cache.incr('version') == 2
+        assert self.cache.incr('version', 10) == 12
+        # Срок ключа сохраняется
+        assert self.cache._client.ttl(self.cache.make_key('version')) > 0
+        with pytest.raises(ValueError):
+            self.cache.incr('none')
+        assert not self.cache.has_key('none')
+
+
+class TestGetOrRefresh:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, settings):
+        self.shared = caches[settings.SHARED_CACHE]
+        self.calls = 0
+
+    def compute(self, value='new', delay=0):
+        def compute():
+            self.calls += 1
+            time.sleep(delay)
+            return value
+        return compute
+
+    def test_fresh_value_is_not_recomputed(self):
+        assert get_or_refresh('key', 1, self.compute(), 60) == 'new'
+        assert get_or_refresh('key', 1, self.compute('other'), 60) == 'new'
+        assert self.calls == 1
+
+    def test_stale_value_while_other_process_refreshes(self):
+        get_or_refresh('key', 1, self.compute('old'), 60)
+        self.shared.add('lock:key', 'other', 60)
+        assert get_or_refresh('key', 2, self.compute(), 60) == 'old'
+        self.shared.delete('lock:key')
+        assert get_or_refresh('key', 2, self.compute(), 60) == 'new'
+        assert self.calls == 2
+
+    def test_expired_value_is_refreshed(self):
+        get_or_refresh('key', 1, self.compute('old'), 0)
+        assert get_or_refresh('key', 1, self.compute(), 60) == 'new'
+
+    def test_none_is_not_stored(self):
+        assert get_or_refresh('key', 1, self.compute(None), 60) is None
+        assert get_or_refresh('key', 1, self.compute(), 60) == 'new'
+
+    def test_waits_for_lock_without_stale_value(self, monkeypatch):
+        monkeypatch.setattr(project_settings, 'CACHE_LOCK_WAIT', 0)
+        self.shared.add('lock:key', 'other', 60)
+        # Блокировка не снята за CACHE_LOCK_WAIT - считает сам
+        assert get_or_refresh('key', 1, self.compute(), 60) == 'new'
+
+    def test_concurrent_misses_compute_once(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            get_or_refresh('key', 1, self.compute(delay=0.2), 60)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ['new'] * 5
+        assert self.calls == 1
+
+
+@pytest.mark.django_db
+class TestPageCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        Product.objects.create(id=11, category_id=10, title='Кабель ВВГ',
+                               article='VVG', price=1)
+        self.url = '/store/category/10/'
+
+    def rename(self, title):
+        # Как импорт: update() без сигналов, версия каталога прежняя
+        Product.objects.filter(id=11).update(title=title, version=F('version') + 1)
+
+    def test_version(self):
+        version = get_version()
+        assert get_version() == version
+        bump_version()
+        assert get_version() != version
+
+    def test_page_is_cached_until_version_changes(self, client):
+        assert 'Кабель ВВГ' in client.get(self.url).content.decode()
+        self.rename('Провод ПВС')
+        assert 'Кабель ВВГ' in client.get(self.url).content.decode()
+        bump_version()
+        assert 'Провод ПВС' in client.get(self.url).content.decode()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_admin_save_resets_cache(self, client):
+        client.get(self.url)
+        # Версия меняется после фиксации транзакции
+        product = Product.objects.get(id=11)
+        product.title = 'Провод ПВС'
+        product.save()
+        assert 'Провод ПВС' in client.get(self.url).content.decode()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_article_menu(self, client):
+        Article.objects.create(title='Доставка', name='Доставка', slug='delivery')
+        assert [article.name for article in article_menu()] == ['Доставка']
+        version = get_version(ARTICLES)
+        client.get(self.url)
+        Article.objects.create(title='Оплата', name='Оплата', slug='payment')
+        assert get_version(ARTICLES) != version
+        assert 'Оплата' in client.get(self.url).content.decode()
+
+    def test_stale_page_while_other_process_renders(self, client):
+        client.get(self.url)
+        self.rename('Провод ПВС')
+        bump_version()
+        # Страницу уже строит другой процесс
+        key = page_key(RequestFactory().get(self.url), ('page', 'cursor'),
+                       view=None, pager=None)
+        caches[project_settings.SHARED_CACHE].add(f'lock:{key}', 'other', 60)
+        assert 'Кабель ВВГ' in client.get(self.url).content.decode()
+
+    def test_category_list(self):
+        assert Category.objects.get_category_list() == \
+               [{'name': 'Кабель', 'url': '/store/category/10/'}]
+        Category.objects.filter(id=10).update(name='Провод')
+        assert Category.objects.get_category_list()[0]['name'] == 'Кабель'
+        bump_version()
+        assert Category.objects.get_category_list()[0]['name'] == 'Провод'
+
+    def test_view_settings_are_part_of_key(self, client):
+        assert 'table-product-list' in client.get(self.url).content.decode()
+        # Смена вида пишется в сессию и не берётся из кэша
+        content = client.get(self.url, {'view': 'tiles'}).content.decode()
+        assert 'table-product-list' not in content
+        assert 'table-product-list' not in client.get(self.url).content.decode()
+
+    def test_unused_parameters_are_not_part_of_key(self, client):
+        client.get(self.url)
+        self.rename('Провод ПВС')
+        # Метки из рассылки - та же страница из кэша
+        content = client.get(self.url, {'utm_source': 'mail', 'x': '1'}).content.decode()
+        assert 'Кабель ВВГ' in content
+        assert 'Провод ПВС' in client.get(self.url, {'page': '1'}).content.decode()
+
+    def test_shared_page_has_no_cart(self, client):
+        cart = Order.carts.create(session='cart1')
+        session = client.session
+        session['cart'] = 'cart1'
+        session.save()
+        content = client.get(self.url).content.decode()
+        assert 'cart/badge/' in content
+        data = client.get('/store/cart/badge/').json()
+        assert data == {'count': cart.products.count(), 'total': ''}
+
+    def test_logged_in_users_are_not_cached(self, client):
+        user = User.objects.create_user('buyer', password='12345')
+        Customer.objects.create(user=user)
+        client.force_login(user)
+        client.get(self.url)
+        self.rename('Провод ПВС')
+        content = client.get(self.url).content.decode()
+        assert 'Провод ПВС' in content
+        assert 'cart/badge/' not in content
+
+
+@pytest.mark.django_db
+class TestFragmentCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        for id in (11, 12):
+            Product.objects.create(id=id, category_id=10, title=f'Кабель {id}',
+                                   article=f'K-{id}', price=1, warehouse1=1)
+
+    def render(self, template_name='item_row.html'):
+        return product_fragments(Product.objects.order_by('id'), template_name)
+
+    def test_fragments_follow_product_version(self):
+        html = self.render()
+        assert html.count('<tr>') == 2
+        assert html.index('Кабель 11') < html.index('Кабель 12')
+
+        # Без смены версии строка берётся из кэша
+        Product.objects.filter(id=12).update(title='Провод 12')
+        assert 'Кабель 12' in self.render()
+
+        product = Product.objects.get(id=12)
+        product.save()
+        html = self.render()
+        assert 'Провод 12' in html and 'Кабель 11' in html
+
+    def test_stock_bumps_version(self):
+        self.render('item_card.html')
+        load_stock([('11', ['0', '0'])])
+        assert 'Нет в наличии' in self.render('item_card.html')
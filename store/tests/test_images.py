@@ -0,0 +1,275 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import Http404
+
+from ecommerce import settings as project_settings
+from ecommerce.celery import celery_app
+from store import tasks, views
+from store.cache import get_version
+from store.images import process_product_images, collect_garbage, \
+    resized_image, evict_resized, VARIANT_FORMATS
+from store.models import Group, Category, Product, NO_IMAGE_URL
+from store.templatetags.store_images import product_picture
+from store.views import serve_media, resized_media
+
+
+def jpeg(color):
+    data = io.BytesIO()
+    Image.new('RGB', (800, 600), color).save(data, 'JPEG')
+    return SimpleUploadedFile('photo.jpg', data.getvalue(), 'image/jpeg')
+
+
+@pytest.mark.django_db
+class TestProductImages:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, tmp_path, settings, monkeypatch):
+        settings.MEDIA_ROOT = str(tmp_path)
+        monkeypatch.setattr(project_settings, 'MEDIA_ROOT', str(tmp_path))
+        self.media = tmp_path
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        self.product = Product.objects.create(id=11, category_id=10, article='VVG',
+                                              title='Кабель ВВГ', price=1)
+
+    def test_upload_is_processed_later(self):
+        self.product.image = jpeg('red')
+        self.product.save()
+
+        assert self.product.image_status == Product.IMAGE_PENDING
+        assert len(self.product.image_hash) == 16
+        assert self.product.image.name == f'{self.product.image_hash}.jpg'
+        assert self.product.image_name() == NO_IMAGE_URL
+        name = self.product.image.name
+        assert not (self.media / 'card' / name).exists()
+
+        assert process_product_images([11], workers=1) == 1
+        product = Product.objects.get(id=11)
+        assert product.image_status == Product.IMAGE_READY
+        assert product.image_name() == f'/media/card/{name}'
+        with Image.open(self.media / 'card' / name) as card:
+            assert card.size == (300, 225)
+        with Image.open(self.media / 'thumb' / name) as thumb:
+            assert thumb.size == (50, 38)
+
+    def test_original_is_not_changed(self):
+        data = io.BytesIO()
+        Image.new('RGB', (2000, 1500), 'red').save(data, 'PNG')
+        self.product.image = SimpleUploadedFile('photo.png', data.getvalue(), 'image/png')
+        self.product.save()
+        name = self.product.image.name
+
+        process_product_images([11], workers=1)
+        # Под неизменяемым URL с хэшем - всё тот же загруженный файл
+        assert (self.media / name).read_bytes() == data.getvalue()
+        with Image.open(self.media / 'big' / f'{self.product.image_hash}.jpg') as big:
+            assert (big.format, big.size) == ('JPEG', (1100, 825))
+
+    def test_variant_manifest(self):
+        self.product.image = jpeg('red')
+        self.product.save()
+        process_product_images([11], workers=1)
+
+        Image.init()
+        manifest = Product.objects.get(id=11).image_variants
+        assert (manifest['width'], manifest['height']) == (800, 600)
+        assert [source['type'] for source in manifest['sources']] == [
+            mime for mime, _, format, _ in VARIANT_FORMATS if format in Image.SAVE]
+        for source in manifest['sources']:
+            assert [width for width, _ in source['srcset']] == [150, 300, 600, 800]
+            for _, name in source['srcset']:
+                assert (self.media / name).exists()
+
+    def test_picture_tag(self):
+        assert product_picture(self.product) == \
+            f'<img src="{NO_IMAGE_URL}" alt="Кабель ВВГ" loading="lazy">'
+
+        self.product.image = '10_11.jpg'
+        self.product.image_variants = {'width': 800, 'height': 600, 'sources': [
+            {'type': 'image/webp', 'srcset': [[300, 'variants/10_11_300.webp'],
+                                              [800, 'variants/10_11_800.webp']]},
+        ]}
+        assert product_picture(self.product, sizes='300px', css_class='card') == (
+            '<picture><source type="image/webp" srcset="/media/variants/10_11_300.webp '
+            '300w, /media/variants/10_11_800.webp 800w" sizes="300px">'
+            '<img src="/media/card/10_11.jpg" alt="Кабель ВВГ" class="card" '
+            'height="600" loading="lazy" width="800"></picture>'
+        )
+
+    def test_unchanged_image_is_not_processed(self):
+        self.product.image = jpeg('red')
+        self.product.save()
+        process_product_images([11], workers=1)
+
+        product = Product.objects.get(id=11)
+        product.price = 2
+        product.save()
+        assert product.image_status == Product.IMAGE_READY
+
+        product.image = jpeg('red')
+        product.save()
+        assert product.image_status == Product.IMAGE_READY
+        assert sorted(path.name for path in self.media.glob('*.jpg')) == \
+            [product.image.name]
+
+    def test_broken_image(self):
+        self.product.image = SimpleUploadedFile('photo.jpg', b'not an image')
+        self.product.save()
+
+        process_product_images([11], workers=1)
+        assert Product.objects.get(id=11).image_status == Product.IMAGE_FAILED
+
+    def test_ingest_images(self, tmp_path_factory):
+        photos = tmp_path_factory.mktemp('photos')
+        (photos / 'VVG.jpg').write_bytes(jpeg('red').read())
+        (photos / 'UNKNOWN.jpg').write_bytes(jpeg('blue').read())
+        (photos / 'notes.txt').write_text('-')
+
+        version = get_version()
+        call_command('ingest_images', str(photos), workers=1)
+        # Страницы из кэша строятся заново, уже с фотографией
+        assert get_version() != version
+        product = Product.objects.get(id=11)
+        name = product.image.name
+        assert name == f'{product.image_hash}.jpg'
+        assert product.image_status == Product.IMAGE_READY
+        assert (self.media / 'card' / name).exists()
+
+        (self.media / 'card' / name).unlink()
+        version = get_version()
+        call_command('ingest_images', str(photos), workers=1)
+        assert not (self.media / 'card' / name).exists()
+        assert get_version() == version
+
+    def test_collect_garbage(self):
+        self.product.image = jpeg('red')
+        self.product.save()
+        process_product_images([11], workers=1)
+        old = self.product.image.name
+
+        self.product.image = jpeg('blue')
+        self.product.save()
+        process_product_images([11], workers=1)
+        new = self.product.image.name
+        (self.media / 'card' / 'notes.txt').write_text('-')
+        (self.media / 'logo.png').write_bytes(b'-')
+
+        assert collect_garbage() == 0
+        assert collect_garbage(grace=0) == 4
+        assert not (self.media / old).exists()
+        assert not (self.media / 'big' / old).exists()
+        assert not (self.media / 'thumb' / old).exists()
+        assert (self.media / new).exists()
+        assert (self.media / 'big' / new).exists()
+        assert (self.media / 'card' / new).exists()
+        # Файлы не с именами сайта не удаляются
+        assert (self.media / 'card' / 'notes.txt').exists()
+        assert (self.media / 'logo.png').exists()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestProcessImagesTask:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, tmp_path, settings, monkeypatch):
+        settings.MEDIA_ROOT = str(tmp_path)
+        monkeypatch.setattr(project_settings, 'MEDIA_ROOT', str(tmp_path))
+        monkeypatch.setattr(celery_app.conf, 'task_always_eager', True)
+        self.media = tmp_path
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        Image.new('RGB', (800, 600), 'red').save(tmp_path / 'photo.jpg', 'JPEG')
+        # Без сигнала: задачу запускает тест
+        Product.objects.bulk_create([
+            Product(id=id, category_id=10, article=f'VVG{id}', title='Кабель ВВГ',
+                    price=1, image='photo.jpg', image_status=Product.IMAGE_PENDING)
+            for id in (11, 12)
+        ])
+
+    def test_task_in_celery_worker_process(self, daemon_process):
+        # Процесс воркера Celery - демон: пул процессов в нём не создать
+        assert daemon_process(tasks.process_images, [11, 12]) is None
+        assert set(Product.objects.values_list('image_status', flat=True)) \
+            == {Product.IMAGE_READY}
+        assert (self.media / 'card' / 'photo.jpg').exists()
+
+
+@pytest.mark.django_db
+class TestGroupImage:
+
+    def test_same_image_is_not_saved_again(self, tmp_path, settings, rf):
+        settings.MEDIA_ROOT = str(tmp_path)
+        group = Group.objects.create(id=1, name='Group1', image=jpeg('red'))
+        assert group.image.name == f'group_{group.image_hash}.jpg'
+
+        group.image = jpeg('red')
+        group.save()
+        assert [path.name for path in tmp_path.iterdir()] == [group.image.name]
+
+        response = serve_media(rf.get('/'), group.image.name, str(tmp_path))
+        assert response['Cache-Control'] == 'public, max-age=31536000, immutable'
+
+
+class TestResizedMedia:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(project_settings, 'MEDIA_ROOT', str(tmp_path))
+        (tmp_path / 'photo.jpg').write_bytes(jpeg('red').read())
+        self.media = tmp_path
+
+    def test_resized_once(self):
+        path = resized_image('photo.jpg', 150, 150)
+        with Image.open(path) as img:
+            assert img.size == (150, 113)
+        mtime = self.media.joinpath(path).stat().st_mtime_ns
+        assert resized_image('photo.jpg', 150, 150) == path
+        assert self.media.joinpath(path).stat().st_mtime_ns == mtime
+
+    def test_evict_least_recently_used(self):
+        old = resized_image('photo.jpg', 150, 150)
+        new = resized_image('photo.jpg', 50, 50)
+        os.utime(old, (1, 1))
+        assert evict_resized(max_size=int(os.path.getsize(new) / 0.9) + 1) == 1
+        assert not os.path.exists(old)
+        assert os.path.exists(new)
+
+    def test_hit_does_not_evict(self, monkeypatch):
+        # Вытеснение - задача celery beat, а не обход r/ в запросе
+        path = resized_image('photo.jpg', 150, 150)
+        monkeypatch.setattr(project_settings, 'IMAGE_RESIZE_CACHE_SIZE', 0)
+        assert resized_image('photo.jpg', 50, 50)
+        assert os.path.exists(path)
+        tasks.evict_resized_images()
+        assert not os.path.exists(path)
+
+    def test_evicted_before_open(self, rf, monkeypatch):
+        calls = []
+
+        def evicted(name, width, height):
+            # Первая копия удалена до открытия, вторая построена заново
+            path = resized_image(name, width, height)
+            if not calls:
+                os.remove(path)
+            calls.append(path)
+            return path
+
+        monkeypatch.setattr(views, 'resized_image', evicted)
+        assert resized_media(rf.get('/'), 300, 400, 'photo.jpg').status_code == 200
+        assert len(calls) == 2
+        with pytest.raises(Http404):
+            resized_media(rf.get('/'), 300, 400, 'missing.jpg')
+
+    def test_view(self, rf):
+        request = rf.get('/')
+        response = resized_media(request, 300, 400, 'photo.jpg')
+        assert response.status_code == 200
+        assert 'immutable' not in response.get('Cache-Control', '')
+        for args in ((301, 400, 'photo.jpg'), (300, 400, 'missing.jpg')):
+            with pytest.raises(Http404):
+                resized_media(request, *args)
@@ -0,0 +1,495 @@
+import io
+import os
+import resource
+import time
+from datetime import timedelta
+
+import pytest
+from celery.exceptions import Retry
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from store import tasks
+from store.cache import get_version
+from store.importers import parse_atol_row, bulk_load_atol, copy_load_atol, \
+    iter_stock, load_stock, pipelined_load, refresh_counters, CategoryRow, ProductRow
+from store.management.commands.watch_imports import Uploads, Inotify, \
+    CLOSED, OPEN, UNKNOWN
+from store.models import Group, Category, Product, ImportRun, LeaseLost
+from store.tasks import atol_import
+
+
+def atol_row(key, name, price='', parent='', article=''):
+    row = [''] * 26
+    row[0], row[2], row[4], row[15], row[25] = key, name, price, parent, article
+    return row
+
+
+def atol_file(*rows):
+    return io.StringIO('\n'.join(';'.join(row) for row in rows))
+
+
+def stock_file(path, *noms):
+    nodes = ''.join(
+        f'<nom id="{id}" name="Товар"><whs>'
+        + ''.join(f'<scl count="{count}"/>' for count in counts)
+        + '</whs></nom>'
+        for id, counts in noms
+    )
+    path.write_bytes(f'<?xml version="1.0" encoding="windows-1251"?>'
+                     f'<noms>{nodes}</noms>'.encode('cp1251'))
+    return str(path)
+
+
+class TestParseAtolRow:
+
+    def test_short_row(self):
+        assert parse_atol_row(['1'] * 24) is None
+
+    def test_short_name(self):
+        assert parse_atol_row(atol_row('1', 'A')) is None
+
+    def test_category(self):
+        row = atol_row('10', '(01) Кабель (ВВГ)...')
+        category = parse_atol_row(row)
+        assert isinstance(category, CategoryRow)
+        assert (category.id, category.name) == (10, 'Кабель ')
+
+    def test_product(self):
+        row = atol_row('11', '(01) Кабель ВВГ 3х1,5', '12.5', '10', 'VVG-3')
+        product = parse_atol_row(row)
+        assert isinstance(product, ProductRow)
+        assert product.title == 'Кабель ВВГ 3х1,5'
+        assert product.category_id == 10
+        assert str(product.price) == '12.50'
+
+
+@pytest.mark.django_db
+class TestBulkLoadAtol:
+
+    @pytest.fixture(autouse=True, params=[bulk_load_atol, copy_load_atol])
+    def setup_class(self, request):
+        self.load = request.param
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Old name')
+        Product.objects.create(id=11, category_id=10, title='Old',
+                               article='OLD', price=1)
+
+    rows = (
+        atol_row('10', 'Кабель'),
+        atol_row('20', 'Автоматы'),
+        atol_row('11', 'Кабель ВВГ', '12.5', '10', 'VVG'),
+        atol_row('21', 'Автомат 16А', '300', '20', 'BA-16'),
+        atol_row('22', 'Без категории', '1', '99', 'X'),
+    )
+
+    def test_insert_and_update(self):
+        version = Product.objects.get(id=11).version
+        stats = self.load(atol_file(*self.rows))
+
+        assert stats['rows'] == 5
+        assert stats['categories'] == {'inserted': 1, 'updated': 1,
+                                       'unchanged': 0, 'vanished': 0}
+        assert stats['products'] == {'inserted': 1, 'updated': 1, 'unchanged': 0,
+                                     'vanished': 0, 'skipped': 1}
+        assert stats['changed'] == {'categories': [10, 20], 'products': [11, 21]}
+        assert Category.objects.get(id=10).name == 'Кабель'
+        assert Product.objects.get(id=11).article == 'VVG'
+        assert Product.objects.get(id=21).category_id == 20
+        assert Product.objects.get(id=21).article_key == 'ba16'
+        assert Product.objects.get(id=11).version == version + 1
+        assert not Product.objects.filter(id=22).exists()
+
+    def test_unchanged_rows_are_skipped(self):
+        self.load(atol_file(*self.rows))
+        version = Product.objects.get(id=11).version
+        stats = self.load(atol_file(*self.rows))
+
+        assert stats['categories']['unchanged'] == 2
+        assert stats['products']['unchanged'] == 2
+        assert stats['changed'] == {'categories': [], 'products': []}
+        assert Product.objects.get(id=11).version == version
+
+    def test_vanished_products(self):
+        self.load(atol_file(*self.rows))
+        stats = self.load(atol_file(*self.rows[:3]))
+        assert stats['changed']['products'] == [21]
+        assert not Product.objects.get(id=21).display
+
+        stats = self.load(atol_file(*self.rows))
+        assert stats['changed']['products'] == [21]
+        assert Product.objects.get(id=21).display
+
+    def test_empty_category_name(self):
+        # Наименование из одних скобок: после их удаления - пустое
+        stats = self.load(atol_file(*self.rows, atol_row('30', '(01) (ВВГ)')))
+        assert stats['categories']['inserted'] == 2
+        assert Category.objects.get(id=30).name == ''
+
+    def test_hidden_product_stays_hidden_after_return(self):
+        self.load(atol_file(*self.rows))
+        product = Product.objects.get(id=21)
+        product.display = False
+        product.save()
+        self.load(atol_file(*self.rows[:3]))
+        self.load(atol_file(*self.rows))
+        assert not Product.objects.get(id=21).display
+
+    def test_admin_edit_is_overwritten_by_import(self):
+        self.load(atol_file(*self.rows))
+        product = Product.objects.get(id=11)
+        product.title = 'Правка в админке'
+        product.save()
+        category = Category.objects.get(id=10)
+        category.name = 'Правка'
+        category.save()
+        # Правка полей не из выгрузки отпечаток не сбрасывает
+        product = Product.objects.get(id=21)
+        product.display = False
+        product.save()
+        assert Product.objects.get(id=21).fingerprint
+
+        stats = self.load(atol_file(*self.rows))
+        assert stats['changed'] == {'categories': [10], 'products': [11]}
+        assert Product.objects.get(id=11).title == 'Кабель ВВГ'
+        assert Category.objects.get(id=10).name == 'Кабель'
+
+    def test_orm_backend_writes_fingerprints(self, tmp_path):
+        path = tmp_path / 'export_atol.txt'
+        path.write_bytes('\n'.join(';'.join(row) for row in self.rows).encode('cp1251'))
+        run = ImportRun.objects.acquire('product_import')
+        atol_import(str(path), run)
+        stats = self.load(atol_file(*self.rows))
+        assert stats['changed'] == {'categories': [], 'products': []}
+        # Как у пакетной загрузки: новые, обновлённые и отброшенные строки
+        run.refresh_from_db()
+        assert (run.rows_read, run.inserted, run.updated, run.rows_skipped) == (5, 2, 2, 1)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestProductImport:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, tmp_path, monkeypatch):
+        Group.objects.create(id=1, name='Group1')
+        self.atol_path = tmp_path / 'export_atol.txt'
+        self.atol_path.write_bytes('\n'.join(';'.join(row) for row in (
+            atol_row('10', 'Кабель'),
+            atol_row('11', 'Кабель ВВГ', '12.5', '10', 'VVG'),
+        )).encode('cp1251'))
+        self.xml_path = stock_file(tmp_path / 'export.xml', ('11', ('3', '4')))
+        monkeypatch.setattr(tasks, 'ATOL_FILE', str(self.atol_path))
+        monkeypatch.setattr(tasks, 'XML_FILE', self.xml_path)
+        monkeypatch.setattr(tasks, 'CHANGED_FILE', str(tmp_path / 'changed.json'))
+
+    def test_task_in_celery_worker_process(self, daemon_process):
+        # Процесс воркера Celery - демон: пул процессов в нём не создать
+        assert daemon_process(tasks.product_import) is None
+        product = Product.objects.get(id=11)
+        assert (product.title, product.warehouse1) == ('Кабель ВВГ', 3)
+        assert ImportRun.objects.get().status == ImportRun.STATUS_FINISHED
+
+    def test_task_retries_while_lease_is_busy(self):
+        # Выгрузку положили во время другого импорта: задача повторится
+        ImportRun.objects.acquire('stock_import')
+        with pytest.raises(Retry):
+            tasks.product_import()
+        assert not Product.objects.exists()
+
+    def test_pipelined_load(self):
+        stats = pipelined_load(str(self.atol_path), self.xml_path, workers=2)
+        assert stats['products']['inserted'] == 1
+        assert Product.objects.get(id=11).warehouse2 == 4
+
+
+@pytest.mark.django_db
+class TestLoadStock:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        Product.objects.create(id=11, category_id=10, title='Кабель ВВГ',
+                               article='VVG', price=1)
+
+    def test_iter_stock(self, tmp_path):
+        path = stock_file(tmp_path / 'export.xml', ('11', ('3', '4')), ('12', ('1',)))
+        assert list(iter_stock(path)) == [('11', ['3', '4']), ('12', ['1'])]
+
+    def test_load_stock(self, tmp_path):
+        path = stock_file(tmp_path / 'export.xml',
+                          ('11', ('3', '4.000')), ('12', ('1', '1')), ('13', ('1',)))
+        assert load_stock(iter_stock(path), batch_size=2) == 2
+        product = Product.objects.get(id=11)
+        assert (product.warehouse1, product.warehouse2) == (3, 4)
+
+
+@pytest.mark.django_db
+class TestRefreshCounters:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Group.objects.create(id=2, name='Пустая')
+        Category.objects.create(id=10, name='Кабель')
+        Category.objects.create(id=20, name='Автоматы')
+        for id, category_id, display, warehouse1, warehouse2 in (
+            (11, 10, True, 3, 0),
+            (12, 10, True, 0, 0),
+            (13, 10, False, 5, 5),
+            (21, 20, True, 0, 1),
+        ):
+            Product.objects.create(id=id, category_id=category_id, title='Товар',
+                                   article=str(id), price=1, display=display,
+                                   warehouse1=warehouse1, warehouse2=warehouse2)
+
+    def counters(self, obj):
+        obj.refresh_from_db()
+        return obj.product_count, obj.display_count, obj.in_stock_count
+
+    def test_refresh(self):
+        assert refresh_counters() == 2
+        assert self.counters(Category.objects.get(id=10)) == (3, 2, 1)
+        assert self.counters(Category.objects.get(id=20)) == (1, 1, 1)
+        assert self.counters(Group.objects.get(id=1)) == (4, 3, 2)
+        assert self.counters(Group.objects.get(id=2)) == (0, 0, 0)
+
+    def test_only_changed_rows_are_written(self):
+        refresh_counters()
+        assert refresh_counters() == 0
+        Product.objects.filter(id=21).update(warehouse2=0)
+        assert refresh_counters() == 1
+        assert self.counters(Group.objects.get(id=1)) == (4, 3, 1)
+
+    def test_selected_categories(self):
+        assert refresh_counters([20]) == 1
+        assert self.counters(Category.objects.get(id=10)) == (0, 0, 0)
+        assert self.counters(Group.objects.get(id=1)) == (1, 1, 1)
+        assert refresh_counters([]) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+class TestCountersFollowAdmin:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Group.objects.create(id=2, name='Group2')
+        Category.objects.create(id=10, name='Кабель')
+        Category.objects.create(id=20, name='Автоматы', parent_id=2)
+        Product.objects.create(id=11, category_id=10, title='Товар', article='11',
+                               price=1, warehouse1=3)
+
+    def counters(self, model, id):
+        obj = model.objects.get(id=id)
+        return obj.product_count, obj.display_count, obj.in_stock_count
+
+    def test_product_edits(self):
+        assert self.counters(Category, 10) == (1, 1, 1)
+        product = Product.objects.create(id=12, category_id=10, title='Товар',
+                                         article='12', price=1)
+        assert self.counters(Category, 10) == (2, 2, 1)
+
+        product.display = False
+        product.save()
+        assert self.counters(Category, 10) == (2, 1, 1)
+        assert self.counters(Group, 1) == (2, 1, 1)
+
+        # Перенос в другую категорию: пересчитываются обе
+        product = Product.objects.get(id=11)
+        product.category_id = 20
+        product.save()
+        assert self.counters(Category, 10) == (1, 0, 0)
+        assert self.counters(Category, 20) == (1, 1, 1)
+        assert self.counters(Group, 2) == (1, 1, 1)
+
+        product.delete()
+        assert self.counters(Category, 20) == (0, 0, 0)
+        assert self.counters(Group, 2) == (0, 0, 0)
+
+    def test_orm_import_does_not_recount_per_row(self, tmp_path):
+        path = tmp_path / 'export_atol.txt'
+        rows = [atol_row('10', 'Кабель')] + [
+            atol_row(str(id), 'Кабель ВВГ', '1', '10', f'VVG{id}') for id in range(12, 22)]
+        path.write_bytes('\n'.join(';'.join(row) for row in rows).encode('cp1251'))
+        version = get_version()
+        with CaptureQueriesContext(connection) as queries:
+            atol_import(str(path))
+        assert Product.objects.count() == 11
+        assert not [query for query in queries.captured_queries
+                    if query['sql'].lstrip().startswith('UPDATE store_')]
+        # Кэш страниц не сбрасывается на каждой строке
+        assert get_version() == version
+        # Счётчики - один раз после импорта
+        tasks.update_counters()
+        assert self.counters(Category, 10) == (11, 11, 1)
+
+    def test_category_moved_to_another_group(self):
+        category = Category.objects.get(id=10)
+        category.parent_id = 2
+        category.save()
+        assert self.counters(Group, 1) == (0, 0, 0)
+        assert self.counters(Group, 2) == (1, 1, 1)
+
+
+@pytest.mark.django_db
+class TestImportRun:
+
+    def test_lease(self):
+        run = ImportRun.objects.acquire('product_import')
+        assert run
+        assert ImportRun.objects.acquire('product_import') is None
+
+        run.finish()
+        assert ImportRun.objects.acquire('product_import')
+
+    def test_resume_after_lease_expired(self):
+        run = ImportRun.objects.acquire('product_import')
+        run.save_checkpoint(phase='stock', done=10)
+        ImportRun.objects.filter(pk=run.pk).update(
+            lease_expires=timezone.now() - timedelta(seconds=1))
+
+        resumed = ImportRun.objects.acquire('product_import')
+        assert resumed.pk == run.pk
+        assert resumed.checkpoint == {'phase': 'stock', 'done': 10}
+        with pytest.raises(LeaseLost):
+            run.renew()
+
+    def test_peak_memory_of_this_run(self):
+        # Прежний большой импорт в том же воркере: ru_maxrss помнит его пик
+        data = b'x' * (200 * 1024 * 1024)
+        del data
+        run = ImportRun.objects.acquire('product_import')
+        with run.heartbeat(sample_interval=0.05):
+            time.sleep(0.2)
+        run.finish()
+        run.refresh_from_db()
+        lifetime = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        assert 0 < run.peak_memory < lifetime - 100
+
+    def test_other_task_does_not_resume(self):
+        run = ImportRun.objects.acquire('stock_import')
+        run.release()
+
+        assert ImportRun.objects.acquire('product_import').pk != run.pk
+        assert ImportRun.objects.get(pk=run.pk).status == ImportRun.STATUS_FAILED
+
+    def test_load_stock_resumes_from_checkpoint(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        for id in (11, 12):
+            Product.objects.create(id=id, category_id=10, title='Кабель ВВГ',
+                                   article='VVG', price=1)
+        run = ImportRun.objects.acquire('stock_import')
+        run.save_checkpoint(done=1, denied=0)
+
+        stock = [('11', ['1', '1']), ('12', ['2', '2']), ('13', ['3', '3'])]
+        assert load_stock(stock, batch_size=1, run=run) == 1
+        assert Product.objects.get(id=11).warehouse1 == 0
+        assert Product.objects.get(id=12).warehouse1 == 2
+        assert run.checkpoint == {'done': 3, 'denied': 1}
+
+
+@pytest.mark.django_db(transaction=True)
+class TestImportRunHeartbeat:
+
+    def test_lease_is_renewed_during_long_transaction(self):
+        run = ImportRun.objects.acquire('product_import')
+        ImportRun.objects.filter(pk=run.pk).update(
+            lease_expires=timezone.now() + timedelta(seconds=1))
+
+        with run.heartbeat(interval=0.05):
+            # Как COPY: одна длинная транзакция без контрольных точек
+            with transaction.atomic():
+                time.sleep(1.2)
+            assert ImportRun.objects.acquire('product_import') is None
+
+        run.refresh_from_db()
+        assert run.lease_expires > timezone.now() + timedelta(seconds=60)
+
+    def test_lost_lease_stops_heartbeat(self):
+        run = ImportRun.objects.acquire('product_import')
+        ImportRun.objects.filter(pk=run.pk).update(lease_owner='other')
+        with run.heartbeat(interval=0.05):
+            time.sleep(0.2)
+        with pytest.raises(LeaseLost):
+            run.renew()
+
+
+class TestWatchImports:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, tmp_path):
+        self.now = 0
+        self.atol = str(tmp_path / 'export_atol.txt')
+        self.xml = str(tmp_path / 'export.xml')
+        self.uploads = Uploads({self.atol, self.xml}, debounce=5, poll_debounce=600,
+                               clock=lambda: self.now)
+
+    def write(self, path, data):
+        with open(path, 'a') as f:
+            f.write(data)
+
+    def test_open_upload_is_never_imported(self):
+        # FTP-загрузка оборвалась: файл создан, но не закрыт
+        self.write(self.atol, 'начало')
+        self.uploads.event(self.atol, OPEN)
+        self.now = 3600
+        assert self.uploads.ready() == {}
+
+        self.write(self.atol, 'конец')
+        self.uploads.event(self.atol, CLOSED)
+        self.now += 4
+        assert self.uploads.ready() == {}
+        self.now += 1
+        assert list(self.uploads.ready()) == [self.atol]
+        # Тот же файл ещё раз не ставится
+        self.uploads.event(self.atol, CLOSED)
+        assert self.uploads.pending == {}
+
+    def test_pair_is_one_import(self):
+        self.write(self.atol, '-')
+        self.uploads.event(self.atol, CLOSED)
+        self.now = 3
+        self.write(self.xml, '-')
+        self.uploads.event(self.xml, CLOSED)
+        self.now = 6
+        assert self.uploads.ready() == {}
+        self.now = 8
+        assert set(self.uploads.ready()) == {self.atol, self.xml}
+
+    def test_written_again_after_close(self):
+        self.write(self.atol, '-')
+        self.uploads.event(self.atol, CLOSED)
+        self.write(self.atol, '--')
+        self.now = 10
+        assert self.uploads.ready() == {}
+        self.now = 3600
+        assert self.uploads.ready() == {}
+
+    def test_poll_waits_until_file_stops_changing(self):
+        self.write(self.xml, '-')
+        self.uploads.event(self.xml, UNKNOWN)
+        self.now = 500
+        self.write(self.xml, '-')
+        assert self.uploads.ready() == {}
+        self.now = 1000
+        self.uploads.event(self.xml, UNKNOWN)
+        assert self.uploads.ready() == {}
+        self.now = 1100
+        assert list(self.uploads.ready()) == [self.xml]
+
+    def test_inotify_events(self, tmp_path):
+        try:
+            watcher = Inotify(str(tmp_path))
+        except (OSError, AttributeError):
+            pytest.skip('inotify is not available')
+        f = open(self.atol, 'w')
+        assert watcher.wait(1) == {'export_atol.txt': OPEN}
+        f.write('-')
+        f.close()
+        assert watcher.wait(1) == {'export_atol.txt': CLOSED}
+        (tmp_path / 'upload.tmp').write_text('-')
+        watcher.wait(1)
+        os.rename(tmp_path / 'upload.tmp', self.xml)
+        assert watcher.wait(1) == {'export.xml': CLOSED}
@@ -0,0 +1,90 @@
+from urllib.parse import parse_qsl
+
+import pytest
+from django.core.paginator import InvalidPage
+
+from store.importers import refresh_counters
+from store.models import Group, Category, Product
+from store.pagination import KeysetPaginator
+from store.search import postgres_search
+
+
+@pytest.mark.django_db
+class TestKeysetPaginator:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        # Одинаковые наименования: порядок страниц держится на id
+        for id in range(11, 34):
+            Product.objects.create(id=id, category_id=10, article=f'K-{id}',
+                                   title=f'Кабель ВВГ {id % 4}', price=1)
+        self.queryset = Product.objects.filter(category_id=10)
+        self.expected = list(self.queryset.order_by('title', 'id')
+                             .values_list('id', flat=True))
+
+    def paginator(self):
+        return KeysetPaginator(self.queryset, 5, numbered_pages=2)
+
+    def open(self, paginator, query):
+        params = dict(parse_qsl(query))
+        return paginator.page(params.get('page'), params.get('cursor'))
+
+    def ids(self, page):
+        return [product.id for product in page]
+
+    def test_walk_forward_and_back(self):
+        paginator = self.paginator()
+        page = paginator.page()
+        pages = [page]
+        while page.has_next():
+            page = self.open(paginator, page.next_query)
+            pages.append(page)
+        assert [page.number for page in pages] == [1, 2, 3, 4, 5]
+        assert sum(map(self.ids, pages), []) == self.expected
+        # Ближние страницы - по номеру, дальние - по курсору
+        assert pages[0].next_query == 'page=2'
+        assert pages[1].next_query.startswith('cursor=')
+
+        while page.has_previous():
+            page = self.open(paginator, page.previous_query)
+            assert self.ids(page) == self.ids(pages[page.number - 1])
+        assert page.number == 1
+
+    def test_last_page(self):
+        paginator = self.paginator()
+        page = self.open(paginator, paginator.page().last_query)
+        assert (page.number, page.has_next()) == (5, False)
+        assert self.ids(page) == self.expected[20:]
+
+    def test_numbered_page(self):
+        page = self.paginator().page(4)
+        assert self.ids(page) == self.expected[15:20]
+
+    def test_invalid_page(self):
+        with pytest.raises(InvalidPage):
+            self.paginator().page(cursor='garbage')
+        with pytest.raises(InvalidPage):
+            self.paginator().page(10)
+
+    def test_ranked_search(self):
+        queryset = postgres_search('кабель ввг')
+        paginator = KeysetPaginator(queryset, 5, numbered_pages=1)
+        page = paginator.page()
+        found = self.ids(page)
+        while page.has_next():
+            page = self.open(paginator, page.next_query)
+            found += self.ids(page)
+        assert found == [product.id for product in queryset]
+
+    def test_view(self, client):
+        Product.objects.filter(id=self.expected[0]).update(display=False)
+        refresh_counters()
+        response = client.get('/store/category/10/', {'pager': 5})
+        page = response.context['page_obj']
+        # Число страниц - по счётчику категории, снятый с показа товар не виден
+        assert page.paginator.count == 22
+        assert self.ids(page) == self.expected[1:6]
+        response = client.get('/store/category/10/', {'cursor': 'garbage'})
+        assert response.status_code == 404
@@ -0,0 +1,235 @@
+import os
+
+import pytest
+from django.apps import apps
+from django.db import connection
+
+from ecommerce import settings as project_settings
+from store import autocomplete
+from store.models import Group, Category, Product
+from store.search import search_products, postgres_search, icontains_search, \
+    article_search, fill_article_keys, trigram_available
+from store.search_index import build_index, get_index, index_search
+from store.signals import install_product_search
+from store.utils import normalize_article
+
+
+@pytest.mark.django_db
+class TestProductSearch:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Автоматы')
+        for id, title, article in (
+            (11, 'Автоматический выключатель ВА47-29 1Р 16А', 'MVA20-1-016-C'),
+            (12, 'Кабель силовой ВВГнг-LS 3х1,5', 'VVG-315'),
+            (13, 'Кабель-канал 25х16 белый', 'KK-2516'),
+        ):
+            Product.objects.create(id=id, category_id=10, title=title,
+                                   article=article, price=1)
+
+    def ids(self, queryset):
+        return [product.id for product in queryset]
+
+    def test_morphology(self):
+        assert self.ids(postgres_search('автоматы')) == [11]
+        assert self.ids(postgres_search('выключателя 16А')) == [11]
+
+    def test_prefix(self):
+        assert set(self.ids(postgres_search('каб'))) == {12, 13}
+        assert self.ids(postgres_search('кабель сил')) == [12]
+
+    def test_article(self):
+        assert self.ids(postgres_search('VVG-315')) == [12]
+        assert self.ids(postgres_search('vvg315')) == [12]
+        assert self.ids(postgres_search('ВА47-29')) == [11]
+
+    def test_vector_follows_updates(self):
+        product = Product.objects.get(id=13)
+        product.title = 'Гофротруба ПВХ 20 мм'
+        product.save()
+        assert self.ids(postgres_search('гофротрубы')) == [13]
+        assert self.ids(postgres_search('кабель-канал')) == []
+
+    def test_empty_query(self):
+        assert self.ids(search_products('')) == []
+        assert self.ids(search_products(None)) == []
+        assert self.ids(postgres_search('!!!')) == []
+
+    def test_icontains(self):
+        assert self.ids(icontains_search('ВВГ')) == [12]
+
+    def test_trigram_indexes_are_used(self):
+        if not trigram_available():
+            pytest.skip('pg_trgm is not installed')
+        # Каждая ветка OR - по своему индексу, без чтения всей таблицы
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = postgres_search('VVG').explain()
+        assert 'store_product_article_upper_trgm' in plan
+        assert 'Seq Scan on store_product' not in plan
+
+
+@pytest.mark.django_db
+class TestSearchIndex:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(project_settings, 'SEARCH_INDEX_FILE',
+                            str(tmp_path / 'search.idx'))
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Кабель')
+        for id, title, article in (
+            (11, 'Кабель силовой ВВГнг-LS 3х1,5', 'VVG-315'),
+            (12, 'Кабель-канал 25х16 белый', 'KK-2516'),
+            (13, 'Ёлочная гирлянда', 'NY-1'),
+        ):
+            Product.objects.create(id=id, category_id=10, title=title,
+                                   article=article, price=1)
+        assert build_index() == 3
+
+    def by_title(self, *ids):
+        return list(Product.objects.filter(id__in=ids).order_by('title', 'id')
+                    .values_list('id', flat=True))
+
+    def test_words(self):
+        index = get_index()
+        # Порядок наименований - как в базе, он зависит от правил сортировки
+        assert index.search('кабель') == self.by_title(11, 12)
+        assert index.search('кабель сил') == [11]
+        assert index.search('елочная') == [13]
+        assert index.search('провод') == []
+        assert index.search('') == []
+
+    def test_article_substring(self):
+        index = get_index()
+        assert index.search('vvg315') == [11]
+        assert index.search('2516') == [12]
+        assert index.search('vvg316') == []
+
+    def test_rebuilt_index_is_reloaded(self):
+        assert get_index().search('гофротруба') == []
+        Product.objects.filter(id=12).update(title='Гофротруба ПВХ 20 мм')
+        build_index()
+        assert get_index().search('гофротруба') == [12]
+
+    def test_results_page(self):
+        results = index_search('кабель')
+        assert results.count() == 2
+        assert [product.id for product in results[1:2]] == self.by_title(11, 12)[1:]
+        assert [product.id for product in results] == self.by_title(11, 12)
+
+    def test_index_not_built_yet(self, monkeypatch):
+        monkeypatch.setattr(project_settings, 'SEARCH_BACKEND', 'index')
+        os.remove(project_settings.SEARCH_INDEX_FILE)
+        assert get_index() is None
+        assert [product.id for product in search_products('гирлянда')] == [13]
+
+        install_product_search(apps.get_app_config('store'))
+        assert get_index().search('гирлянда') == [13]
+
+
+@pytest.mark.django_db
+class TestAutocomplete:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self, monkeypatch):
+        monkeypatch.setattr(autocomplete, '_suggestions', None)
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Автоматические выключатели')
+        Category.objects.create(id=20, name='Кабель силовой')
+        for id, title, article, display in (
+            (11, 'Автомат ВА47-29 1Р 16А', 'MVA20-1-016', True),
+            (12, 'Автомат ВА47-29 3Р 25А', 'MVA20-3-025', True),
+            (13, 'Автомат снятый с продажи', 'OLD-1', False),
+            (21, 'Кабель ВВГнг-LS 3х1,5', 'VVG-315', True),
+        ):
+            Product.objects.create(id=id, category_id=10, title=title,
+                                   article=article, price=1, display=display)
+
+    def titles(self, items, key='title'):
+        return [item[key] for item in items]
+
+    def test_prefix(self, client):
+        data = client.get('/store/autocomplete/', {'q': 'авто'}).json()
+        assert self.titles(data['products']) == ['Автомат ВА47-29 1Р 16А',
+                                                 'Автомат ВА47-29 3Р 25А']
+        assert data['products'][0]['url'] == '/store/product/11/'
+        assert self.titles(data['categories'], 'name') == ['Автоматические выключатели']
+
+    def test_several_words(self, client):
+        data = client.get('/store/autocomplete/', {'q': 'автомат 3р 2'}).json()
+        assert self.titles(data['products']) == ['Автомат ВА47-29 3Р 25А']
+
+    def test_article(self, client):
+        data = client.get('/store/autocomplete/', {'q': 'mva20-1'}).json()
+        assert self.titles(data['articles'], 'article') == ['MVA20-1-016']
+
+    def test_limit_and_short_query(self, client):
+        data = client.get('/store/autocomplete/', {'q': 'автомат', 'limit': 1}).json()
+        assert len(data['products']) == 1
+        data = client.get('/store/autocomplete/', {'q': 'а'}).json()
+        assert data['products'] == data['categories'] == []
+
+
+@pytest.mark.django_db
+class TestArticleLookup:
+
+    @pytest.fixture(autouse=True)
+    def setup_class(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Автоматы')
+        for id, title, article in (
+            (11, 'Автомат ВА47-29 1Р 16А', 'ВА47-29/16'),
+            (12, 'Кабель ВВГнг-LS 3х1,5', 'VVG-315'),
+            (13, 'Кабель ВВГнг-LS 3х1,5 (бухта)', 'VVG-315'),
+        ):
+            Product.objects.create(id=id, category_id=10, title=title,
+                                   article=article, price=1)
+
+    def test_normalize_article(self):
+        assert normalize_article('ВА47-29/16') == 'ba472916'
+        assert normalize_article(' ba 47 29 16 ') == 'ba472916'
+        assert normalize_article('МС_3х1.5') == normalize_article('MC3X15')
+        assert normalize_article('--') == ''
+
+    def test_key_follows_save(self):
+        assert Product.objects.get(id=11).article_key == 'ba472916'
+        product = Product.objects.get(id=12)
+        product.article = 'NYM-315'
+        product.save()
+        assert [p.id for p in article_search('nym 315')] == [12]
+
+    def test_fill_article_keys(self):
+        Product.objects.update(article_key='')
+        assert fill_article_keys() == 3
+        assert fill_article_keys() == 0
+        assert Product.objects.get(id=12).article_key == 'vvg315'
+
+    def test_single_product_redirects(self, client):
+        response = client.get('/store/search/', {'p': 'ba 47-29 16'})
+        assert response.status_code == 302
+        assert response.url == '/store/product/11/'
+
+    def test_shared_article_lists_its_products(self, client):
+        response = client.get('/store/search/', {'p': 'vvg315'})
+        assert response.status_code == 200
+        assert [p.id for p in response.context['object_list']] == [12, 13]
+
+    def test_hidden_products_are_not_found(self, client, monkeypatch, tmp_path):
+        Product.objects.filter(id=13).update(display=False)
+        assert [p.id for p in article_search('vvg315')] == [12]
+        assert client.get('/store/search/', {'p': 'vvg315'}).url == '/store/product/12/'
+        response = client.get('/store/product/13/')
+        assert response.status_code == 200
+        assert 'Товар снят с продажи' in response.content.decode()
+
+        assert [p.id for p in postgres_search('бухта')] == []
+        assert [p.id for p in icontains_search('бухта')] == []
+        monkeypatch.setattr(project_settings, 'SEARCH_INDEX_FILE',
+                            str(tmp_path / 'search.idx'))
+        assert build_index() == 2
+        Product.objects.filter(id=12).update(display=False)
+        # Снят с показа после построения индекса
+        assert list(index_search('кабель')) == []
@@ -5,11 +5,13 @@ from store.views import (
     ProductDetailView,
     GroupDetailView,
     CartView,
+    CartBadgeView,
     AddToCartView,
     DeleteFromCartView,
     ChangeQTYView,
     MakeOrderView,
     ProductSearchView,
+    AutocompleteView,
     ProductListView,
     EmailView, OrderView,
 )
@@ -17,10 +19,12 @@ from store.views import (
 urlpatterns = [
     path('', GroupListView.as_view(), name='group_list'),
     path('search/', ProductSearchView.as_view(), name='search'),
+    path('autocomplete/', AutocompleteView.as_view(), name='autocomplete'),
     path('product/<int:pk>/', ProductDetailView.as_view(), name='product_detail'),
     path('group/<int:pk>/', GroupDetailView.as_view(), name='group_detail'),
     path('category/<int:pk>/', ProductListView.as_view(), name='category_detail'),
     path('cart/', CartView.as_view(), name='cart'),
+    path('cart/badge/', CartBadgeView.as_view(), name='cart_badge'),
     path('add-to-cart/<int:pk>/', AddToCartView.as_view(), name='add_to_cart'),
     path('remove-from-cart/<int:pk>/', DeleteFromCartView.as_view(), name='delete_from_cart'),
     path('change-qty/<int:pk>/', ChangeQTYView.as_view(), name='change_qty'),
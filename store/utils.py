@@ -1,33 +1,93 @@
+import glob
+import hashlib
 import os
 import random
+import re
 import string
-from ecommerce.settings import MEDIA_ROOT
+from decimal import Decimal
 
+CENT = Decimal('0.01')
+
+
+# Имена файлов изображений строятся из хэша содержимого (image_hash):
+# файл никогда не перезаписывается, и браузеры могут кэшировать его навсегда.
+# Неиспользуемые файлы удаляет задача collect_media_garbage
 def path_and_rename(instance, filename):
-    ext = filename.split('.')[-1]
-    filename = f'{instance.category.pk}_{instance.pk}.{ext}'
-    os.remove(os.path.join(MEDIA_ROOT, filename))
-    return f'{filename}'
+    ext = filename.split('.')[-1].lower()
+    return f'{instance.image_hash}.{ext}'
 
 
 def group_image(instance, filename):
-    ext = filename.split('.')[-1]
-    filename = f'group_{instance.pk}.{ext}'
-    try:
-        os.remove(os.path.join(MEDIA_ROOT, filename))
-    except:
-        pass
-    return f'{filename}'
+    ext = filename.split('.')[-1].lower()
+    return f'group_{instance.image_hash}.{ext}'
 
 
 def category_image(instance, filename):
-    ext = filename.split('.')[-1]
-    filename = f'catetory_{instance.pk}.{ext}'
+    ext = filename.split('.')[-1].lower()
+    return f'category_{instance.image_hash}.{ext}'
+
+
+def reuse_stored_file(field_file):
+    """Файл с тем же именем, а значит и содержимым, уже сохранён - не пишем его заново"""
+    name = field_file.field.generate_filename(field_file.instance, field_file.name)
+    if field_file.storage.exists(name):
+        field_file.name = name
+        field_file._committed = True
+
+
+def file_hash(file):
+    """Хэш содержимого загруженного файла, 16 hex-символов"""
+    digest = hashlib.blake2b(digest_size=8)
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(*values):
+    data = '\x1f'.join(str(value) for value in values)
+    return hashlib.blake2b(data.encode(), digest_size=8).hexdigest()
+
+
+def product_fingerprint(category_id, title, article, price):
+    """
+    Отпечаток полей товара из выгрузки АТОЛ. Один для импорта и для
+    Product.save: правка этих полей в админке меняет отпечаток
+    """
+    return fingerprint(int(category_id), title, article,
+                       Decimal(str(price)).quantize(CENT))
+
+
+# Кириллические буквы, которые в артикулах набирают вместо латинских
+ARTICLE_LOOKALIKES = str.maketrans('АВЕКМНОРСТХУ', 'ABEKMHOPCTXY')
+
+
+def normalize_article(article):
+    """
+    Ключ артикула для точного поиска: 'ВА47-29', 'ba 47 29' и 'BA4729'
+    дают один ключ 'ba4729'
+    """
+    article = article.upper().replace('Ё', 'Е').translate(ARTICLE_LOOKALIKES)
+    return re.sub(r'[\W_]+', '', article).lower()
+
+
+def memory_usage(pid='self'):
+    """
+    Текущий RSS процесса и его дочерних процессов в байтах (Linux, /proc).
+    В отличие от ru_maxrss - сейчас, а не пик за всю жизнь процесса.
+    """
     try:
-        os.remove(os.path.join(MEDIA_ROOT, filename))
-    except:
-        pass
-    return f'{filename}'
+        with open(f'/proc/{pid}/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+    for path in glob.glob(f'/proc/{pid}/task/*/children'):
+        try:
+            with open(path) as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        rss += sum(memory_usage(child) for child in children)
+    return rss
 
 
 def get_random_session():
@@ -1,3 +1,4 @@
+import re
 from datetime import datetime, timedelta
 
 from django.contrib import messages
@@ -6,14 +7,20 @@ from django.contrib.auth.models import User
 from django.contrib.auth import login, authenticate
 from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponseRedirect, HttpResponse
-from django.shortcuts import render
+from django.http import HttpResponseRedirect, HttpResponse, FileResponse, Http404, \
+    JsonResponse
+from django.shortcuts import render, get_object_or_404
 from django.views.generic import DetailView, View, ListView
+from django.views.static import serve
 from django.urls import reverse
+from django.utils.cache import add_never_cache_headers
 
 from ecommerce import settings
 from .forms import LoginForm, RegistrationForm, OrderForm
-from .mixins import CartMixin
+from .autocomplete import get_suggestions
+from .images import resized_image
+from .search import search_products, article_search
+from .mixins import CartMixin, KeysetPaginationMixin, PageCacheMixin
 from .models import Group, Category, Customer, OrderProduct, \
     Product, Order, Article
 from .tasks import send_confirmation_email, send_order_email, \
@@ -25,7 +32,7 @@ class MyQ(Q):
     default = 'OR'
 
 
-class WelcomeView(CartMixin, View):
+class WelcomeView(PageCacheMixin, CartMixin, View):
 
     def get(self, request, *args, **kwargs):
         groups = Group.objects.filter(start_page=True).order_by('name')
@@ -40,7 +47,7 @@ class WelcomeView(CartMixin, View):
         return render(request, 'favourites_list.html', context)
 
 
-class GroupListView(CartMixin, View):
+class GroupListView(PageCacheMixin, CartMixin, View):
     model = Group
 
     def get(self, request, *args, **kwargs):
@@ -54,7 +61,9 @@ class GroupListView(CartMixin, View):
         return render(request, 'group_list.html', context)
 
 
-class ProductDetailView(CartMixin, DetailView):
+class ProductDetailView(PageCacheMixin, CartMixin, DetailView):
+    # Снятый с показа товар не ищется и не выводится в списках, но его
+    # страница открывается - по ссылкам из корзины и истории заказов
     model = Product
     template_name = 'item_detail.html'
 
@@ -68,45 +77,54 @@ class ProductDetailView(CartMixin, DetailView):
         return context
 
 
-class ProductListView(CartMixin, ListView):
+class ProductListView(PageCacheMixin, CartMixin, KeysetPaginationMixin, ListView):
     model = Product
     template_name = 'product_list.html'
     paginate_by = 50
+    page_cache_query = ('page', 'cursor')
+    page_cache_session = ('view', 'pager')
 
     def get_queryset(self):
-        pk = self.kwargs.get('pk')
-        object_list = Product.objects.filter(category_id=pk)
+        self.category = get_object_or_404(Category.objects.select_related('parent'),
+                                          pk=self.kwargs.get('pk'))
+        object_list = Product.objects.filter(category=self.category, display=True) \
+            .order_by('title', 'id')
         return object_list
 
+    def get_paginate_count(self):
+        # Счётчик категории вместо COUNT(*) на каждый запрос
+        return self.category.display_count
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['cart'] = self.cart
         context['articles'] = self.articles
-        context['category'] = Category.objects.get(pk=self.kwargs.get('pk'))
+        context['category'] = self.category
 
+        # В сессию пишется только выбор посетителя, не значения по умолчанию:
+        # иначе каждый анонимный посетитель получал бы свою сессию и страницу
+        # вне общего кэша (PageCacheMixin)
         view = self.request.GET.get('view') \
                or self.request.session.get('view') or 'list'
-        if view:
+        if 'view' in self.request.GET:
             self.request.session['view'] = view
         context['view'] = view
-
-        pager = self.paginate_by or int(self.request.session.get('pager'))
-        context['pager'] = pager
-        if pager:
-            self.request.session['pager'] = pager
+        context['pager'] = self.paginate_by
 
         return context
 
     def get_paginate_by(self, queryset):
-        pager = int(self.request.GET.get('pager') or 0) \
-                or self.request.session.get('pager')
+        pager = int(self.request.GET.get('pager') or 0)
         if pager:
             self.request.session['pager'] = pager
+        pager = pager or self.request.session.get('pager')
+        if pager:
             self.paginate_by = pager
-        return pager
+        # Без настройки в сессии - по умолчанию, а не весь список без страниц
+        return self.paginate_by
 
 
-class GroupDetailView(CartMixin, DetailView):
+class GroupDetailView(PageCacheMixin, CartMixin, DetailView):
     model = Group
     queryset = Group.objects.all()
     context_object_name = 'group'
@@ -114,7 +132,7 @@ class GroupDetailView(CartMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        group = self.get_object()
+        group = self.object
         context['cart'] = self.cart
         context['group_name'] = group.name
         context['categories'] = Category.objects.filter(
@@ -124,10 +142,23 @@ class GroupDetailView(CartMixin, DetailView):
         return context
 
 
-class ProductSearchView(CartMixin, ListView):
+class ProductSearchView(PageCacheMixin, CartMixin, KeysetPaginationMixin, ListView):
     model = Product
     template_name = 'product_search.html'
     paginate_by = 50
+    page_cache_query = ('p', 'page', 'cursor')
+    page_cache_session = ('view', 'pager')
+
+    def get(self, request, *args, **kwargs):
+        # Запрос - известный артикул: один товар открывается сразу, у общего
+        # артикула показываются только его товары, без полнотекстового поиска
+        self.article_matches = article_search(request.GET.get('p'))
+        found = list(self.article_matches[:2])
+        if len(found) == 1:
+            return HttpResponseRedirect(found[0].get_absolute_url())
+        if not found:
+            self.article_matches = None
+        return super().get(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -136,30 +167,54 @@ class ProductSearchView(CartMixin, ListView):
         context['cart'] = self.cart
         context['articles'] = self.articles
 
+        # Как в ProductListView: в сессию - только выбор посетителя
         view = self.request.GET.get('view') or self.request.session.get('view')
-        if view:
+        if 'view' in self.request.GET:
             self.request.session['view'] = view
         context['view'] = view
-
-        pager = self.paginate_by or self.request.session.get('pager')
-        context['pager'] = pager
-        if pager:
-            self.request.session['pager'] = pager
+        context['pager'] = self.paginate_by
         return context
 
     def get_queryset(self):
+        if self.article_matches is not None:
+            return self.article_matches
         query = self.request.GET.get('p')
-        object_list = Product.objects.filter(
-            Q(title__icontains=query) | Q(article__icontains=query)
-        )
-        return object_list
+        return search_products(query)
 
     def get_paginate_by(self, queryset):
         pager = self.request.GET.get('pager') or self.request.session.get('pager')
         if pager:
             self.request.session['pager'] = pager
             self.paginate_by = pager
-        return pager
+        # Без настройки в сессии - по умолчанию, а не весь список без страниц
+        return self.paginate_by
+
+
+class AutocompleteView(View):
+    """Подсказки для строки поиска: товары, артикулы и категории по началу слова"""
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        try:
+            limit = min(int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT)),
+                        settings.AUTOCOMPLETE_LIMIT)
+        except ValueError:
+            limit = settings.AUTOCOMPLETE_LIMIT
+        suggestions = get_suggestions().suggest(query, max(limit, 1))
+        return JsonResponse(dict(query=query, **suggestions))
+
+
+class CartBadgeView(CartMixin, View):
+    """Значок корзины для страниц из общего кэша (PageCacheMixin)"""
+
+    def get(self, request, *args, **kwargs):
+        response = JsonResponse({
+            'count': self.cart.products.count() if self.cart else 0,
+            'total': f'{self.cart.total_price_net:.0f}'
+            if self.cart and self.cart.total_price_net else '',
+        })
+        add_never_cache_headers(response)
+        return response
 
 
 class AddToCartView(CartMixin, View):
@@ -573,3 +628,42 @@ class EmailView(LoginRequiredMixin, CartMixin, View):
             )
         except Exception:
             return HttpResponse(status=404)
+
+
+# Имя из хэша содержимого (store.utils.path_and_rename и др.), в том числе
+# card/, thumb/ и variants/<хэш>_<ширина>
+HASHED_MEDIA = re.compile(r'(^|/)(group_|category_)?[0-9a-f]{16}(_\d+)?\.\w+$')
+
+
+def serve_media(request, path, document_root=None):
+    r"""
+    /media/ без nginx. Файлы с хэшем в имени не меняются, их можно кэшировать
+    навсегда. В nginx то же самое: location ~ "[0-9a-f]{16}(_\d+)?\.\w+$"
+    { add_header Cache-Control "public, max-age=31536000, immutable"; }
+    """
+    response = serve(request, path, document_root)
+    if HASHED_MEDIA.search(path):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def resized_media(request, width, height, name):
+    """Уменьшенная копия изображения, размеры - только из IMAGE_RESIZE_SIZES"""
+    if (width, height) not in settings.IMAGE_RESIZE_SIZES:
+        raise Http404
+    # Копию могла удалить задача evict_resized_images между построением и
+    # открытием: тогда строим ещё раз
+    for attempt in range(2):
+        try:
+            file = open(resized_image(name, width, height), 'rb')
+            break
+        except FileNotFoundError:
+            continue
+        except OSError:
+            raise Http404
+    else:
+        raise Http404
+    response = FileResponse(file)
+    if HASHED_MEDIA.search(name):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response